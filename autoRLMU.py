@@ -1,9 +1,23 @@
-from paddleocr import PaddleOCR
-from fitz import Rect, Page, Point, Document, TEXT_ALIGN_RIGHT
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from fitz import Rect, Page, Point, Document, Pixmap, TEXT_ALIGN_RIGHT, csGRAY, csRGB
 from PIL import Image, ImageDraw
+from typing import Iterable, Iterator
 import numpy as np
 import cv2
 import re
+import threading
+from debug_artifacts import DebugArtifactWriter, get_debug_writer
+from free_space import FreeSpaceLocator
+from image_preprocessing import ImagePreprocessor, get_image_preprocessor, map_ocr_result
+from layout_classifier import LayoutGuess
+from layout_templates import LayoutTemplate, LayoutTemplateStore, get_image_hash, get_layout_templates
+from ocr_cache import OcrCache, get_file_hash, get_ocr_cache
+from ocr_engine import OcrEngine, crop_text_box, get_ocr_engine, sort_text_boxes
+from pdf_saver import PdfSaver, SaveReport, get_pdf_saver
+from preflight import PREFLIGHT_DONE, PreflightChecker, PreflightResult
+from stage_metrics import StageMetrics
 
 
 class NoDPIError(Exception):
@@ -14,12 +28,60 @@ class NoNeedToRedlineError(Exception):
     pass
 
 
-class AnnotationMakerBase:
+class MemoryBudgetError(Exception):
+    pass
+
+
+# what the ocr of the layout template regions gives when they miss some texts, the whole crop rectangle
+# must be ocr-ed then; an empty list is a crop with no texts in it
+_TEMPLATE_MISS = object()
+
+
+class _NoDebugDraw:
+    # stands in for ImageDraw when the debug images are off, so nothing is drawn
+    def rectangle(self, *args, **kwargs) -> None:
+        return
+
+
+class PageRedlineResult:
+    # the outcome of redlining one page of a document, page_number starts from 0
+    def __init__(self, page_number: int, success: bool, error_description: str, log: str, stats: dict):
+        self.page_number = page_number
+        self.success = success
+        self.error_description = error_description
+        self.log = log
+        # make_redline statistics of the page, i.e. the DPI which finally succeeded
+        self.stats = stats
+
+
+class AnnotationMakerBase(ABC):
     _NODE_TEXTS = ('NODE', 'NCDE', 'N0DE')
     _FCS_TEXT_TO_FIND = ('FCS07', 'FCSO7', 'FSC07')
     _FCS_TEXT_TO_REPLACE_WITH = 'FCS14'
-
-    def __init__(self):
+    # the FCS text the analysis takes, the text layer is used only if it has one
+    _FCS_REGEX = re.compile(r'^(FCS|FSC)\d\d\d\d')
+    # words of the text layer closer than this share of the text height are joined into one block like the ocr does
+    _TEXT_LAYER_JOIN_GAP = 1.0
+    # and the ocr usually reads narrower gaps than this share of the text height without a space
+    _TEXT_LAYER_SPACE_GAP = 0.3
+    # 'full' recognizes all the detected text boxes, 'targeted' - only the ones which may hold the FCS/NODE texts
+    _OCR_MODES = ('full', 'targeted')
+    # the ocr drops the texts read with a lower score, the targeted ocr does the same
+    _OCR_DROP_SCORE = 0.5
+    # the shapes of the text boxes the FCS and NODE texts may be in, the heights are in points (pixels at dpi 72)
+    _CANDIDATE_MIN_ASPECT = 1.2
+    _CANDIDATE_MAX_ASPECT = 15
+    _CANDIDATE_MIN_HEIGHT_72 = 4
+    _CANDIDATE_MAX_HEIGHT_72 = 24
+    # the regions of a layout template are padded by this many points around the texts found in them
+    _TEMPLATE_REGION_MARGIN_72 = 24
+    # the regions are not worth ocr-ing apart if they cover more of the crop rectangle than this share
+    _TEMPLATE_MAX_AREA_SHARE = 0.5
+    # the DPI of the thumbnail of the crop rectangle the layout fingerprint is taken of
+    _FINGERPRINT_DPI = 12
+    _STAMP_IMAGE_PATH = 'images/RLMU_Stamp.png'
+
+    def __init__(self, ocr_config: dict | None = None):
         # pix.page.get_pixmap without specifying DPI or matrix returns image with dpi 72
         # so crop rectangtle coordinates (based on dpi==72) and zoom factor are recaculated every DPI set
         # default DPI for the class is 150        
@@ -42,8 +104,64 @@ class AnnotationMakerBase:
         self._doc: Document | None = None
         self._page: Page | None = None
         self._log: list[str] = []
-        # need to run only once to download and load model into memory
-        self._ocr: PaddleOCR.ocr = PaddleOCR(use_angle_cls=True, lang='en', show_log=False)
+        # the process-wide debug writer is used, unless another one is set
+        self._debug_writer: DebugArtifactWriter | None = None
+        # the folder for the debug images of the current document, None if the document is not debugged
+        self._debug_dir: str | None = None
+        # the process-wide ocr cache is used, unless another one is set
+        self._ocr_cache: OcrCache | None = None
+        self._pdf_content_hash: str = ''
+        self._no_need_to_crop = False
+        self._ocr_mode = 'full'
+        # the ocr data prepared by the batched ocr of many documents, waiting for make_redline to take it
+        self._preset_ocr_data: dict[tuple, list] = dict()
+        # the pdf opened by prepare_ocr_ahead, make_redline of the same pdf goes on with the open document,
+        # so the file is hashed, copied for the incremental save and counted by the debug sampling only once
+        self._prepared_pdf_path: str | None = None
+        # ocr scores of the FCS and NODE texts found by the last analysis
+        self._found_confidences: list[float] = list()
+        # statistics of the last make_redline call, i.e. the DPI which finally succeeded
+        self._run_stats: dict = dict()
+        # the results of the pages redlined by the last make_redline call and whether the document was saved
+        self._page_results: list[PageRedlineResult] = list()
+        self._is_saved = False
+        # the pre-flight check of the last make_redline call, None if it was not asked for
+        self._preflight: PreflightResult | None = None
+        # the process-wide saver is used, unless another one is set
+        self._pdf_saver: PdfSaver | None = None
+        self._save_report: SaveReport | None = None
+        # the lock the caller holds around make_redline to keep the PyMuPDF calls apart, None if there is none
+        self._fitz_lock: threading.Lock | None = None
+        # the time and memory every stage of the last make_redline call took
+        self._metrics = StageMetrics()
+        # the memory-lean mode renders the page for the stamp in grayscale, renders the crop apart from the page
+        # and drops every image as soon as its stage is done
+        self._is_memory_lean = False
+        # the most the images of a document may take at once in bytes, None means no limit
+        self._memory_budget: int | None = None
+        self._image_memory_peak = 0
+        # the images are numpy views over the samples of these pixmaps, so the pixmaps live as long as the images
+        self._pixmaps: dict[str, Pixmap] = dict()
+        # regions (x0, y0, x1, y1) of the rotated page with dpi 72 to put the stamp to first, and the page margin
+        self._stamp_preferred_regions_72: list[tuple[float, float, float, float]] = list()
+        self._stamp_margin_72: float = 0
+        # the process-wide layout templates are used, unless other ones are set
+        self._layout_templates: LayoutTemplateStore | None = None
+        # the layout key and the thumbnail hash of the current page, taken once per rotation
+        self._layout_fingerprint: tuple[str, int] | None = None
+        # the template the current page matches and the images of its regions with their offsets in the crop
+        self._layout_template: LayoutTemplate | None = None
+        self._region_images: list[tuple[float, float, np.ndarray]] = list()
+        # the pages whose template regions missed some texts in the ocr done ahead, by the preset ocr data key,
+        # they are not tried again when the page is redlined
+        self._layout_template_misses: set[tuple] = set()
+        # the process-wide preprocessing of the ocr input is used, unless another one is set
+        self._preprocessor: ImagePreprocessor | None = None
+        # every page is turned by its number of times 90 degrees clockwise as soon as the document is opened,
+        # i.e. as the layout classifier tells for that page, the pages past the list are not turned
+        self._page_rotation_turns: list[int] = list()
+        # the model is loaded only once per process and shared by all the makers with the same configuration
+        self._ocr: OcrEngine = get_ocr_engine(ocr_config)
 
     def __del__(self):
         if self._doc is not None:
@@ -54,10 +172,14 @@ class AnnotationMakerBase:
             raise NoDPIError("DPI must be set before working with images")
         return (p1[0] + self._CROP_X0, p1[1] + self._CROP_Y0), (p2[0] + self._CROP_X0, p2[1] + self._CROP_Y0)
 
-    def _set_dpi(self, dpi: int) -> None:
-        if isinstance(dpi, int) and 72 <= dpi <= 600:
+    # dpi is used for the ocr of the crop rectangle, page_dpi - for the whole page image used to place the stamp
+    def _set_dpi(self, dpi: int, page_dpi: int | None = None) -> None:
+        page_dpi = dpi if page_dpi is None else page_dpi
+        if all(isinstance(value, int) and 72 <= value <= 600 for value in (dpi, page_dpi)):
             self._DPI = dpi
             self._PDF_ZOOM_FACTOR = self._DPI / 72
+            self._PAGE_DPI = page_dpi
+            self._PAGE_ZOOM_FACTOR = self._PAGE_DPI / 72
             self._CROP_X0 = self._CROP_X0_72 * self._PDF_ZOOM_FACTOR
             self._CROP_Y0 = self._CROP_Y0_72 * self._PDF_ZOOM_FACTOR
             self._CROP_X1 = self._CROP_X1_72 * self._PDF_ZOOM_FACTOR
@@ -86,6 +208,12 @@ class AnnotationMakerBase:
         self._is_dpi_set = False
         return
 
+    def set_stamp_placement(self, preferred_regions: list[tuple[float, float, float, float]] | None = None,
+                            margin: float = 0):
+        self._stamp_preferred_regions_72 = list() if preferred_regions is None else list(preferred_regions)
+        self._stamp_margin_72 = margin
+        return
+
     def _get_rect_from_xywh(self, top_left_x: float, top_left_y: float,
                             rect_width: float, rect_height: float) -> Rect:
         tl_point = Point(top_left_x, top_left_y)
@@ -103,15 +231,22 @@ class AnnotationMakerBase:
         br_point = Point(tl_point[0] + rect_width, tl_point[1] + rect_height)
         return Rect(tl_point, br_point)
 
-    def _get_pdfed_rect(self, x0: float, y0: float, x1: float, y1: float) -> Rect:
+    # the coordinates are in pixels of the ocr DPI, unless another zoom factor is given
+    def _get_pdfed_rect(self, x0: float, y0: float, x1: float, y1: float, zoom_factor: float | None = None) -> Rect:
         if not self._is_dpi_set:
             raise NoDPIError("DPI must be set before working with images")
-        width = (x1 - x0) / self._PDF_ZOOM_FACTOR
-        height = (y1 - y0) / self._PDF_ZOOM_FACTOR
-        x = x0 / self._PDF_ZOOM_FACTOR
-        y = y0 / self._PDF_ZOOM_FACTOR
+        zoom_factor = self._PDF_ZOOM_FACTOR if zoom_factor is None else zoom_factor
+        width = (x1 - x0) / zoom_factor
+        height = (y1 - y0) / zoom_factor
+        x = x0 / zoom_factor
+        y = y0 / zoom_factor
         return self._get_rect_from_xywh(x, y, width, height)
 
+    # converts a rectangle in pixels of the ocr DPI into pixels of the page image, which may have a lower DPI
+    def _get_page_image_rect(self, x0: float, y0: float, x1: float, y1: float) -> tuple[float, float, float, float]:
+        scale = self._PAGE_ZOOM_FACTOR / self._PDF_ZOOM_FACTOR
+        return x0 * scale, y0 * scale, x1 * scale, y1 * scale
+
     def _set_error(self, error_descr):
         self._error_description = error_descr
         self._append_msg_to_log(f'{self._error_description}, aborting...')
@@ -127,28 +262,281 @@ class AnnotationMakerBase:
     def get_log(self) -> str:
         return '\r\n'.join(self._log)
 
+    def get_run_stats(self) -> dict:
+        return dict(self._run_stats)
+
+    def get_page_results(self) -> list[PageRedlineResult]:
+        return list(self._page_results)
+
+    def get_stage_metrics(self) -> dict[str, dict[str, float]]:
+        return self._metrics.as_dict()
+
+    # how long the annotated pdf of the last make_redline call took to save and its size, None if not saved
+    def get_save_report(self) -> SaveReport | None:
+        return self._save_report
+
+    # the DPIs to try one by one: only the given one, or the adaptive ones from the cheapest to the most expensive
+    def _start_run_stats(self, dpi: int, adaptive_dpis: tuple[int, ...] | None) -> list[int]:
+        dpis = [dpi] if not adaptive_dpis else sorted(adaptive_dpis)
+        self._run_stats = {'dpis_tried': list(), 'dpi': None, 'min_confidence': None, 'found_texts': 0}
+        return dpis
+
+    def _get_min_confidence(self) -> float:
+        return min(self._found_confidences, default=0.0)
+
+    # returns True if the found texts are read reliably enough at the current DPI, otherwise the DPI is raised
+    def _is_confident(self, min_confidence: float, is_last_dpi: bool) -> bool:
+        self._run_stats['min_confidence'] = self._get_min_confidence()
+        self._run_stats['found_texts'] = len(self._found_confidences)
+        if is_last_dpi or self._get_min_confidence() >= min_confidence:
+            return True
+        self._append_msg_to_log(f'The lowest OCR confidence {self._get_min_confidence():.2f} at DPI {self._DPI} '
+                                f'is below {min_confidence:.2f}, trying a higher DPI...')
+        return False
+
     def _append_msg_to_log(self, message: str) -> None:
         print(message)
         self._log.append(message)
 
+    def set_ocr_cache(self, ocr_cache: OcrCache | None) -> None:
+        self._ocr_cache = ocr_cache
+        return
+
+    def set_debug_writer(self, debug_writer: DebugArtifactWriter | None) -> None:
+        self._debug_writer = debug_writer
+        return
+
+    def set_pdf_saver(self, pdf_saver: PdfSaver | None) -> None:
+        self._pdf_saver = pdf_saver
+        return
+
+    # make_redline must be called holding the lock, it is let go while the ocr runs, as the ocr does not touch
+    # PyMuPDF, so the other threads read and render their drawings meanwhile
+    def set_fitz_lock(self, fitz_lock: 'threading.Lock | None') -> None:
+        self._fitz_lock = fitz_lock
+        return
+
+    @contextmanager
+    def _fitz_lock_released(self) -> Iterator[None]:
+        if self._fitz_lock is None:
+            yield
+            return
+        self._fitz_lock.release()
+        try:
+            yield
+        finally:
+            self._fitz_lock.acquire()
+
+    def set_layout_templates(self, layout_templates: LayoutTemplateStore | None) -> None:
+        self._layout_templates = layout_templates
+        return
+
+    def set_preprocessor(self, preprocessor: ImagePreprocessor | None) -> None:
+        self._preprocessor = preprocessor
+        return
+
+    def set_page_rotation_turns(self, turns: list[int]) -> None:
+        self._page_rotation_turns = [page_turns % 4 for page_turns in turns]
+        return
+
+    # takes the crop rectangle the layout classifier tells for the first page and the rotation it tells for every
+    # page, the maker itself is chosen by the caller; a layout which is not recognized changes nothing
+    def set_layout_guesses(self, guesses: list[LayoutGuess]) -> None:
+        if guesses and guesses[0].crop_rectangle_wh is not None:
+            self.set_crop_rectangle_wh(*guesses[0].crop_rectangle_wh)
+        self.set_page_rotation_turns([guess.rotation_turns for guess in guesses])
+        for page_number, guess in enumerate(guesses):
+            page_name = f' of page {page_number + 1}' if len(guesses) > 1 else ''
+            self._append_msg_to_log(f'Layout classification{page_name}: {guess}')
+        return
+
+    def set_memory_lean(self, is_memory_lean: bool = True) -> None:
+        self._is_memory_lean = is_memory_lean
+        return
+
+    # budget_mb is the most the page images of a document may take at once, None means no limit;
+    # the page image for the stamp gets a lower DPI to fit, a crop which does not fit fails the page
+    def set_memory_budget(self, budget_mb: float | None) -> None:
+        self._memory_budget = None if budget_mb is None else int(budget_mb * 1024 * 1024)
+        return
+
+    def _is_debugging(self) -> bool:
+        return self._debug_dir is not None
+
+    def _get_debug_draw(self, image: Image) -> ImageDraw.ImageDraw | _NoDebugDraw:
+        return ImageDraw.Draw(image) if self._is_debugging() else _NoDebugDraw()
+
+    # the image is encoded and written in the background, only if the document is debugged
+    def _save_debug_image(self, file_name: str, image: Image) -> None:
+        if self._is_debugging():
+            # the pages of a multi-page document share its folder
+            if self._doc.page_count > 1:
+                file_name = f'page{self._page.number + 1}_{file_name}'
+            self._debug_writer.save(self._debug_dir, file_name, image)
+        return
+
+    @staticmethod
+    def _get_annotated_path(pdf_path: str) -> str:
+        return pdf_path[:-4] + '_annotated' + pdf_path[-4:]
+
+    # classifies the drawing as done, needs_work or unknown from its annotations, embedded images and text layer
+    # and the annotated pdf written before, without rendering anything; it takes milliseconds
+    def preflight(self, pdf_path: str) -> PreflightResult:
+        checker = PreflightChecker(self._FCS_TEXT_TO_REPLACE_WITH, self._FCS_TEXT_TO_FIND, self._STAMP_IMAGE_PATH)
+        return checker.check(pdf_path, self._get_annotated_path(pdf_path))
+
+    def get_preflight_result(self) -> PreflightResult | None:
+        return self._preflight
+
+    # returns True if the pre-flight check finds the drawing redlined already, it is not opened then
+    def _is_skipped_as_redlined(self) -> bool:
+        with self._metrics.measure('preflight'):
+            self._preflight = self.preflight(self._pdf_path)
+        if self._preflight.state != PREFLIGHT_DONE:
+            self._append_msg_to_log(f'Pre-flight check of {self._pdf_path}: {self._preflight}')
+            return False
+        self._append_msg_to_log(f'{self._pdf_path} is skipped, it is redlined already: {self._preflight.reason}')
+        self._run_stats = {'preflight': self._preflight.as_dict()}
+        return True
+
     # opens the doc from file path, returns False if failed
     def _open_doc(self) -> bool:
         assert self._pdf_path != '', "pdf path cannot be empty"
         # add '_annotated' to the file name
-        self._pdf_path_annotated = self._pdf_path[:-4] + '_annotated' + self._pdf_path[-4:]
+        self._pdf_path_annotated = self._get_annotated_path(self._pdf_path)
         # open the pdf file
         self._append_msg_to_log(f'Opening {self._pdf_path}...')
-        try:
-            self._doc = Document(self._pdf_path)
-        except Exception as e:
-            self._set_error(f'{self._pdf_path} cannot be open: {str(e)}')
-            return False
+        if self._doc is not None:
+            self._doc.close()
+            self._doc = None
+        if self._debug_writer is None:
+            self._debug_writer = get_debug_writer()
+        self._debug_dir = self._debug_writer.start_document(self._pdf_path)
+        if self._ocr_cache is None:
+            self._ocr_cache = get_ocr_cache()
+        if self._pdf_saver is None:
+            self._pdf_saver = get_pdf_saver()
+        if self._layout_templates is None:
+            self._layout_templates = get_layout_templates()
+        if self._preprocessor is None:
+            self._preprocessor = get_image_preprocessor()
+        with self._metrics.measure('open'):
+            try:
+                self._doc = Document(self._pdf_saver.get_open_path(self._pdf_path, self._pdf_path_annotated))
+            except Exception as e:
+                self._set_error(f'{self._pdf_path} cannot be open: {str(e)}')
+                return False
 
-        # load the only page
-        self._page = self._doc.load_page(0)
+            # the pages are turned before anything is rendered or read ahead from them
+            for page, turns in zip(self._doc, self._page_rotation_turns):
+                if turns:
+                    page.set_rotation((page.rotation + turns * 90) % 360)
+            # load the first page
+            self._page = self._doc.load_page(0)
+            # the cached ocr results are looked up by the file content, so renamed or copied files still hit
+            self._pdf_content_hash = get_file_hash(self._pdf_path) if self._ocr_cache is not None else ''
         self._clear_error()
         return True
 
+    # makes the page current, the images and texts left from the previous page are dropped
+    def _load_page(self, page_number: int) -> None:
+        if self._doc.page_count > 1:
+            self._append_msg_to_log(f'Redlining page {page_number + 1} of {self._doc.page_count}...')
+        self._page = self._doc.load_page(page_number)
+        self._drop_page_images()
+        self._ocr_result_data = []
+        self._layout_fingerprint = None
+        self._layout_template = None
+        self._clear_error()
+        return
+
+    def _drop_page_images(self) -> None:
+        self._page_pillow_image = None
+        self._page_pillow_image_cropped = None
+        self._page_opencv_image = None
+        self._cropped_page_opencv_image = None
+        self._region_images = list()
+        self._pixmaps.clear()
+        return
+
+    # the images the maker holds, the same image may be in the list twice
+    def _get_held_images(self) -> list:
+        return [self._page_pillow_image, self._page_pillow_image_cropped, self._page_opencv_image,
+                self._cropped_page_opencv_image]
+
+    # the memory taken by the pixmaps and the images which are not views over them
+    def _get_image_memory(self) -> int:
+        memory = sum(len(pix.samples_mv) for pix in self._pixmaps.values())
+        for image in {id(image): image for image in self._get_held_images() if image is not None}.values():
+            if isinstance(image, np.ndarray):
+                memory += image.nbytes if image.flags.owndata else 0
+            else:
+                memory += image.width * image.height * len(image.getbands())
+        return memory
+
+    def _update_image_memory_peak(self) -> None:
+        self._image_memory_peak = max(self._image_memory_peak, self._get_image_memory())
+        return
+
+    # the size of the image of the clip rectangle of the rotated page with dpi 72, or of the whole page
+    def _get_render_size(self, dpi: int, clip: Rect | None = None, channels: int = 3) -> int:
+        rect = self._page.rect if clip is None else clip
+        return int(rect.width * dpi / 72) * int(rect.height * dpi / 72) * channels
+
+    def _check_memory_budget(self, image_size: int, image_name: str) -> None:
+        if self._memory_budget is None:
+            return
+        memory = self._get_image_memory()
+        if memory + image_size > self._memory_budget:
+            raise MemoryBudgetError(f'The {image_name} image needs {image_size / 1024 / 1024:.1f} MB with '
+                                    f'{memory / 1024 / 1024:.1f} MB already in use, the memory budget is '
+                                    f'{self._memory_budget / 1024 / 1024:.1f} MB')
+        return
+
+    # lowers the page DPI if the page image for the stamp does not fit the memory budget,
+    # the stamp is placed as well on a coarser image
+    def _fit_page_dpi_to_budget(self, channels: int) -> None:
+        if self._memory_budget is None:
+            return
+        available = self._memory_budget - self._get_image_memory()
+        page_size = self._get_render_size(self._PAGE_DPI, channels=channels)
+        if page_size <= available:
+            return
+        page_dpi = int(self._PAGE_DPI * (max(available, 0) / page_size) ** 0.5)
+        if page_dpi < 72:
+            # the page image cannot fit, the check fails the page
+            return
+        self._append_msg_to_log(f'WARNING: the page image is rendered with DPI {page_dpi} instead of '
+                                f'{self._PAGE_DPI} to fit the memory budget')
+        self._set_dpi(self._DPI, page_dpi)
+        return
+
+    # the page is rendered straight into a numpy array over the pixmap samples, the pixmap is kept under the name;
+    # clip is in the coordinates of the rotated page with dpi 72, only this part of the page is rendered
+    def _render_array(self, name: str, dpi: int | None = None, clip: Rect | None = None,
+                      gray: bool = False) -> np.ndarray:
+        if not self._is_dpi_set:
+            raise NoDPIError("DPI must be set before working with images")
+        dpi = self._DPI if dpi is None else dpi
+        # the image being replaced is freed first
+        self._pixmaps.pop(name, None)
+        self._check_memory_budget(self._get_render_size(dpi, clip, 1 if gray else 3), name)
+        with self._metrics.measure('render'):
+            pix = self._page.get_pixmap(dpi=dpi, clip=clip, colorspace=csGRAY if gray else csRGB)
+        self._pixmaps[name] = pix
+        image = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+        return image[:, :, 0] if pix.n == 1 else image
+
+    # the page for the stamp is rendered in grayscale in the memory-lean mode, the debug images need the colors
+    def _is_page_gray(self) -> bool:
+        return self._is_memory_lean and not self._is_debugging()
+
+    # the pillow images are only drawn on for the debug images
+    def _get_pillow_image(self, image: np.ndarray | None) -> Image.Image | None:
+        if image is None or not self._is_debugging():
+            return None
+        return Image.fromarray(np.ascontiguousarray(image))
+
     # to prevent bad things happening like a stamp outside of pages
     def _wrap_page_content(self) -> None:
         if self._page.is_wrapped:
@@ -179,88 +567,745 @@ class AnnotationMakerBase:
         #
         # doc.ez_save("output.pdf")
 
-    def _get_pics_from_page(self, no_need_to_crop=False):
+    # page_image is the page already rendered with the current rotation and page DPI, it is rendered if None;
+    # the cropped image is not needed if the ocr data is already known and no debug images are drawn
+    def _get_pics_from_page(self, no_need_to_crop=False, page_image: np.ndarray | None = None,
+                            need_cropped_image=True):
         if not self._is_dpi_set:
             raise NoDPIError("DPI must be set before working with images")
 
-        pix = self._page.get_pixmap(dpi=self._DPI)
-
-        # converting page into pillow format
-        self._page_pillow_image = Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+        # will be used to find empty space on the page
+        if page_image is None:
+            self._fit_page_dpi_to_budget(1 if self._is_page_gray() else 3)
+            page_image = self._render_array('page', self._PAGE_DPI, gray=self._is_page_gray())
+        self._page_opencv_image = page_image
+        self._page_pillow_image = self._get_pillow_image(page_image)
 
         # save page image for debug purposes
-        self._page_pillow_image.save('images/img_original.png', format='PNG')
+        self._save_debug_image('img_original.png', self._page_pillow_image)
+
+        if not need_cropped_image:
+            self._page_pillow_image_cropped = None
+            if no_need_to_crop:
+                self._set_whole_page_crop()
+            self._cropped_page_opencv_image = None
+            self._update_image_memory_peak()
+            return
+        # the grayscale page image cannot be ocr-ed, so the crop is rendered apart from it in the memory-lean mode
+        is_page_usable = self._PAGE_DPI == self._DPI and page_image.ndim == 3
+        # the crop includes rendering the crop rectangle, if it is rendered apart from the page
+        with self._metrics.measure('crop'):
+            if no_need_to_crop:
+                if is_page_usable:
+                    self._cropped_page_opencv_image = page_image
+                else:
+                    self._cropped_page_opencv_image = self._render_array('crop', self._DPI)
+                self._CROP_X0, self._CROP_Y0 = 0, 0
+                self._CROP_X1 = self._cropped_page_opencv_image.shape[1]
+                self._CROP_Y1 = self._cropped_page_opencv_image.shape[0]
+            elif is_page_usable:
+                # cropping the right part of the page image
+                self._cropped_page_opencv_image = self._cut_padded(page_image, int(self._CROP_X0),
+                                                                   int(self._CROP_Y0), int(self._CROP_X1),
+                                                                   int(self._CROP_Y1))
+            else:
+                # the page image has a lower DPI, so only the crop rectangle is rendered with the ocr DPI
+                self._cropped_page_opencv_image = self._render_crop()
+            self._page_pillow_image_cropped = self._get_pillow_image(self._cropped_page_opencv_image)
+        self._update_image_memory_peak()
+        return
 
-        # will be used to find empty space on the page
-        self._page_opencv_image: np.ndarray = np.asarray(self._page_pillow_image)
+    # cuts the box out of the image, the part of the box outside the image is black, as the PIL crop makes it
+    @staticmethod
+    def _cut_padded(image: np.ndarray, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        cut = np.zeros((max(y1 - y0, 0), max(x1 - x0, 0)) + image.shape[2:], dtype=image.dtype)
+        part = image[max(y0, 0):max(y1, 0), max(x0, 0):max(x1, 0)]
+        cut[max(-y0, 0):max(-y0, 0) + part.shape[0], max(-x0, 0):max(-x0, 0) + part.shape[1]] = part
+        return cut
+
+    # renders the crop rectangle with the ocr DPI; the crop rectangle may stick out of the page,
+    # i.e. the page of the old maker turned on its side, its part off the page is black then
+    def _render_crop(self) -> np.ndarray:
+        crop_rect = Rect(self.get_crop_rectangle())
+        on_page_rect = crop_rect & self._page.rect
+        if on_page_rect == crop_rect:
+            return self._render_array('crop', self._DPI, clip=crop_rect)
+        if on_page_rect.is_empty:
+            image, offset_x, offset_y = np.zeros((0, 0, 3), dtype=np.uint8), 0, 0
+        else:
+            image = self._render_array('crop', self._DPI, clip=on_page_rect)
+            offset_x = int((on_page_rect.x0 - crop_rect.x0) * self._PDF_ZOOM_FACTOR)
+            offset_y = int((on_page_rect.y0 - crop_rect.y0) * self._PDF_ZOOM_FACTOR)
+        width = int(self._CROP_X1) - int(self._CROP_X0)
+        height = int(self._CROP_Y1) - int(self._CROP_Y0)
+        return self._cut_padded(image, -offset_x, -offset_y, width - offset_x, height - offset_y)
+
+    # there is nothing to ocr if the crop rectangle lies outside the page
+    def _is_crop_off_page(self) -> bool:
+        return not self._no_need_to_crop and (Rect(self.get_crop_rectangle()) & self._page.rect).is_empty
+
+    # touches only the cropped image and the ocr engine, so it may run on another thread than the PyMuPDF calls;
+    # returns _TEMPLATE_MISS if the regions of the layout template are ocr-ed and miss some texts
+    def _ocr_image(self) -> list | object:
+        inference_times = self._ocr.get_thread_inference_times()
+        with self._metrics.measure('ocr'):
+            if self._region_images:
+                ocr_result_data = self._ocr_layout_regions()
+            elif self._ocr_mode == 'targeted':
+                ocr_result_data = self._ocr_cropped_image_targeted()
+            else:
+                image, to_original = self._preprocess_image(self._cropped_page_opencv_image)
+                # as there is only one image, the result contains only one element, None if there are no texts
+                ocr_result_data = map_ocr_result(self._ocr.ocr(image, cls=True)[0] or [], to_original)
+        # the ocr is split into the detection and the recognition, the angle classification goes with the latter
+        for kind, elapsed in self._ocr.get_thread_inference_times().items():
+            elapsed -= inference_times.get(kind, 0.0)
+            self._metrics.add('ocr_detection' if kind == 'detection' else 'ocr_recognition', elapsed)
+        return ocr_result_data
+
+    # returns the image the ocr gets and the matrix taking its pixels back to the ones of the given image;
+    # the cropped image itself is not changed, the annotations and the debug images are drawn on it
+    def _preprocess_image(self, image: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        preprocessor = self._preprocessor if self._preprocessor is not None else ImagePreprocessor()
+        with self._metrics.measure('preprocess'):
+            return preprocessor.process(image)
+
+    def _is_layout_text(self, text: str) -> bool:
+        return (text[:5] in self._FCS_TEXT_TO_FIND or text[:5] == self._FCS_TEXT_TO_REPLACE_WITH or
+                text[:4] in self._NODE_TEXTS)
+
+    # the boxes of the texts the analysis found, in the cropped image pixels
+    def _get_found_text_boxes(self) -> list[list[list[float]]]:
+        return [block[0] for block in self._ocr_result_data if self._is_layout_text(block[1][0])]
+
+    def _get_layout_fingerprint(self) -> tuple[str, int]:
+        crop_rect = self.get_crop_rectangle()
+        layout_key = LayoutTemplateStore.get_layout_key(type(self).__name__, (self._page.rect.width,
+                                                                               self._page.rect.height),
+                                                        self._page.rotation, crop_rect)
+        if self._layout_fingerprint is None or self._layout_fingerprint[0] != layout_key:
+            thumbnail = self._render_array('fingerprint', self._FINGERPRINT_DPI, clip=Rect(crop_rect), gray=True)
+            self._layout_fingerprint = layout_key, get_image_hash(thumbnail)
+            self._pixmaps.pop('fingerprint', None)
+        return self._layout_fingerprint
+
+    # finds the layout template of the page and gets the images of its regions: they are cut from the cropped
+    # image if it is rendered already, otherwise only the regions are rendered; returns False if there is
+    # no template worth using
+    def _prepare_layout_regions(self) -> bool:
+        self._layout_template = None
+        self._region_images = list()
+        if self._layout_templates is None or self._no_need_to_crop:
+            return False
+        if self._get_preset_ocr_data_key() in self._layout_template_misses:
+            self._layout_template_misses.discard(self._get_preset_ocr_data_key())
+            return False
+        template = self._layout_templates.find(*self._get_layout_fingerprint())
+        if template is None:
+            return False
+        crop_x0, crop_y0, crop_x1, crop_y1 = self.get_crop_rectangle()
+        regions = [(max(x0, crop_x0), max(y0, crop_y0), min(x1, crop_x1), min(y1, crop_y1))
+                   for x0, y0, x1, y1 in template.regions]
+        regions = [region for region in regions if region[0] < region[2] and region[1] < region[3]]
+        regions_area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions)
+        if not regions or regions_area > self._TEMPLATE_MAX_AREA_SHARE * (crop_x1 - crop_x0) * (crop_y1 - crop_y0):
+            return False
+
+        with self._metrics.measure('crop'):
+            for index, (x0, y0, x1, y1) in enumerate(regions):
+                # the region in the cropped image pixels
+                offset_x = int((x0 - crop_x0) * self._PDF_ZOOM_FACTOR)
+                offset_y = int((y0 - crop_y0) * self._PDF_ZOOM_FACTOR)
+                if self._cropped_page_opencv_image is not None:
+                    image = np.ascontiguousarray(self._cropped_page_opencv_image[
+                        offset_y:int((y1 - crop_y0) * self._PDF_ZOOM_FACTOR),
+                        offset_x:int((x1 - crop_x0) * self._PDF_ZOOM_FACTOR)])
+                else:
+                    image = self._render_array(f'region{index}', self._DPI, clip=Rect(x0, y0, x1, y1))
+                self._region_images.append((offset_x, offset_y, image))
+        self._layout_template = template
+        self._update_image_memory_peak()
+        self._append_msg_to_log(f'The page matches a layout template, {len(regions)} of its regions are ocr-ed '
+                                f'instead of the crop rectangle')
+        return True
+
+    # ocr-s the regions of the layout template, returns _TEMPLATE_MISS if they miss some of the texts the template
+    # was recorded with, then the whole crop rectangle must be ocr-ed
+    def _ocr_layout_regions(self) -> list | object:
+        ocr_result_data = list()
+        for offset_x, offset_y, region_image in self._region_images:
+            image, to_original = self._preprocess_image(region_image)
+            for box, text_and_score in map_ocr_result(self._ocr.ocr(image, cls=True)[0] or [], to_original):
+                ocr_result_data.append([[[x + offset_x, y + offset_y] for x, y in box], text_and_score])
+        text_count = sum(self._is_layout_text(block[1][0]) for block in ocr_result_data)
+        is_hit = text_count >= self._layout_template.text_count
+        self._layout_templates.add_result(self._layout_template, is_hit)
+        if not is_hit:
+            self._append_msg_to_log(f'The layout template regions gave {text_count} of '
+                                    f'{self._layout_template.text_count} FCS/NODE texts, the whole crop rectangle '
+                                    f'is ocr-ed')
+            return _TEMPLATE_MISS
+        # the analysis relies on the blocks going in the same order as the full ocr returns them
+        box_order = {id(box): index for index, box in enumerate(sort_text_boxes([block[0]
+                                                                                 for block in ocr_result_data]))}
+        return sorted(ocr_result_data, key=lambda block: box_order[id(block[0])])
+
+    # remembers the regions the texts were found in, so the later drawings of the same layout ocr only them
+    def _record_layout_template(self) -> None:
+        if self._layout_templates is None or self._no_need_to_crop:
+            return
+        boxes = self._get_found_text_boxes()
+        if not boxes:
+            return
+        margin = self._TEMPLATE_REGION_MARGIN_72
+        regions = list()
+        for box in boxes:
+            # from the cropped image pixels to the rotated page with dpi 72
+            xs = [self._CROP_X0_72 + point[0] / self._PDF_ZOOM_FACTOR for point in box]
+            ys = [self._CROP_Y0_72 + point[1] / self._PDF_ZOOM_FACTOR for point in box]
+            regions.append((min(xs) - margin, min(ys) - margin, max(xs) + margin, max(ys) + margin))
+        text_count = sum(self._is_layout_text(block[1][0]) for block in self._ocr_result_data)
+        self._layout_templates.record(*self._get_layout_fingerprint(), regions, text_count)
+        return
 
+    def _ocr_cropped_image(self):
+        with self._fitz_lock_released():
+            self._ocr_result_data = self._ocr_image()
+        self._append_msg_to_log(f'The crop rectangle is ocr-ed, {len(self._ocr_result_data)} text blocks found')
+        if self._ocr_cache is not None:
+            self._ocr_cache.put(self._get_ocr_cache_key(), self._ocr_result_data)
+        return
+
+    def _is_candidate_box(self, box: list[list[float]]) -> bool:
+        width = max(point[0] for point in box) - min(point[0] for point in box)
+        height = max(point[1] for point in box) - min(point[1] for point in box)
+        if height <= 0:
+            return False
+        return (self._CANDIDATE_MIN_ASPECT <= width / height <= self._CANDIDATE_MAX_ASPECT and
+                self._CANDIDATE_MIN_HEIGHT_72 <= height / self._PDF_ZOOM_FACTOR <= self._CANDIDATE_MAX_HEIGHT_72)
+
+    # the boxes to recognize after the candidates are read, i.e. the node numbers under the NODE text
+    def _get_follow_up_boxes(self, boxes: list[list[list[float]]], ocr_result_data: list) -> list[list[list[float]]]:
+        return []
+
+    # recognizes the boxes of many documents with one recognizer call, returns the ocr blocks of every document;
+    # the boxes are in the pixels of the images, one image per document
+    @staticmethod
+    def _recognize_pooled(makers: list['AnnotationMakerBase'], images: list[np.ndarray],
+                          boxes_per_maker: list[list]) -> list[list]:
+        line_images = [crop_text_box(image, box) for image, boxes in zip(images, boxes_per_maker) for box in boxes]
+        texts = makers[0]._ocr.recognize(line_images) if line_images else []
+        ocr_data_per_maker = list()
+        position = 0
+        for maker, boxes in zip(makers, boxes_per_maker):
+            maker_texts = texts[position:position + len(boxes)]
+            position += len(boxes)
+            ocr_data_per_maker.append([[box, text_and_score] for box, text_and_score in zip(boxes, maker_texts)
+                                       if text_and_score[1] >= maker._OCR_DROP_SCORE])
+        return ocr_data_per_maker
+
+    # ocr of the cropped images of many documents sharing one ocr engine: the detection runs image by image,
+    # the recognition of the text lines of all the documents is pooled, so the fixed cost of a recognizer call
+    # is paid once per batch; the targeted makers recognize only their candidate and follow-up boxes;
+    # the detection and the recognition see the preprocessed images, the boxes are mapped back to the cropped ones
+    @staticmethod
+    def _ocr_batched(makers: list['AnnotationMakerBase']) -> list[list]:
+        preprocessed = [maker._preprocess_image(maker._cropped_page_opencv_image) for maker in makers]
+        images = [image for image, _ in preprocessed]
+        boxes_per_maker = [sort_text_boxes(maker._ocr.detect(image)) for maker, image in zip(makers, images)]
+        first_boxes_per_maker = [[box for box in boxes if maker._ocr_mode == 'full' or maker._is_candidate_box(box)]
+                                 for maker, boxes in zip(makers, boxes_per_maker)]
+        first_data_per_maker = AnnotationMakerBase._recognize_pooled(makers, images, first_boxes_per_maker)
+
+        follow_up_boxes_per_maker = list()
+        for maker, boxes, first_boxes, first_data in zip(makers, boxes_per_maker, first_boxes_per_maker,
+                                                         first_data_per_maker):
+            first_box_ids = {id(box) for box in first_boxes}
+            other_boxes = [box for box in boxes if id(box) not in first_box_ids]
+            follow_up_boxes_per_maker.append(maker._get_follow_up_boxes(other_boxes, first_data)
+                                             if maker._ocr_mode == 'targeted' else [])
+        follow_up_data_per_maker = AnnotationMakerBase._recognize_pooled(makers, images, follow_up_boxes_per_maker)
+
+        ocr_data_per_maker = list()
+        for maker, (_, to_original), boxes, first_boxes, follow_up_boxes, first_data, follow_up_data in zip(
+                makers, preprocessed, boxes_per_maker, first_boxes_per_maker, follow_up_boxes_per_maker,
+                first_data_per_maker, follow_up_data_per_maker):
+            if maker._ocr_mode == 'targeted':
+                maker._append_msg_to_log(f'{len(first_boxes) + len(follow_up_boxes)} of {len(boxes)} detected text '
+                                         f'boxes were recognized')
+            # the analysis relies on the blocks going in the same order as the full ocr returns them
+            box_order = {id(box): index for index, box in enumerate(boxes)}
+            ocr_data_per_maker.append(map_ocr_result(sorted(first_data + follow_up_data,
+                                                            key=lambda block: box_order[id(block[0])]), to_original))
+        return ocr_data_per_maker
+
+    # two-stage ocr: the text boxes are detected first, but only the ones which may hold the FCS and NODE texts
+    # are recognized, as the recognition takes most of the time on dense drawings
+    def _ocr_cropped_image_targeted(self) -> list:
+        return self._ocr_batched([self])[0]
+
+    def _get_ocr_cache_key(self) -> str:
+        crop_rect = None if self._no_need_to_crop else self.get_crop_rectangle()
+        # the targeted ocr returns only a part of the texts and the preprocessing changes them,
+        # so their results are kept apart
+        model_version = f'{self._ocr.get_model_version()} {self._ocr_mode}'
+        if self._preprocessor is not None and self._preprocessor.get_steps():
+            model_version += f' {self._preprocessor}'
+        return OcrCache.get_key(self._pdf_content_hash, self._page.number, crop_rect, self._DPI,
+                                self._page.rotation, model_version)
+
+    def _get_preset_ocr_data_key(self) -> tuple:
+        crop_rect = None if self._no_need_to_crop else self.get_crop_rectangle()
+        return self._page.number, self._DPI, self._page.rotation, crop_rect, self._ocr_mode
+
+    # returns True if the ocr data of the crop rectangle is prepared by the batched ocr or found in the cache
+    def _load_ocr_data_from_cache(self) -> bool:
+        ocr_result_data = self._preset_ocr_data.pop(self._get_preset_ocr_data_key(), None)
+        if ocr_result_data is not None:
+            self._ocr_result_data = ocr_result_data
+            self._append_msg_to_log(f'The OCR result is taken from the OCR done ahead, {len(ocr_result_data)} '
+                                    f'text blocks')
+            return True
+        if self._ocr_cache is None:
+            return False
+        ocr_result_data = self._ocr_cache.get(self._get_ocr_cache_key())
+        if ocr_result_data is None:
+            return False
+        self._ocr_result_data = ocr_result_data
+        self._append_msg_to_log(f'The OCR result is taken from the cache, {len(ocr_result_data)} text blocks')
+        return True
+
+    # gets the text blocks of the crop rectangle from the cache, the text layer or by ocr and renders the page;
+    # the crop rectangle is rendered only for the ocr or to draw the debug images on
+    def _prepare_ocr_data(self, no_need_to_crop=False, use_text_layer=True) -> None:
+        self._no_need_to_crop = no_need_to_crop
         if no_need_to_crop:
-            self._page_pillow_image_cropped = self._page_pillow_image
-            self._CROP_X0, self._CROP_Y0 = 0, 0
-            self._CROP_X1, self._CROP_Y1 = pix.width, pix.height
+            self._set_whole_page_crop()
+        is_off_page = self._is_crop_off_page()
+        if is_off_page:
+            self._append_msg_to_log(f'The crop rectangle is outside the page, no texts are found')
+            self._ocr_result_data = list()
+        has_texts = (is_off_page or self._load_ocr_data_from_cache() or
+                     (use_text_layer and self._read_text_layer_measured()))
+        # the page image is rendered anyway, the stamp is placed on it
+        self._get_pics_from_page(no_need_to_crop, need_cropped_image=not has_texts or self._is_debugging())
+        if not has_texts:
+            self._get_ocr_data()
+        # the analysis works on the texts, the cropped image is kept only to draw the debug images on
+        if not self._is_debugging():
+            self._cropped_page_opencv_image = None
+            self._pixmaps.pop('crop', None)
+        return
+
+    # opens the document and renders the crop rectangle for the ocr done ahead of make_redline with redline_kwargs,
+    # i.e. batched across documents or on a pipeline stage of its own; the ocr is done for the first DPI
+    # make_redline is going to try; returns False if the document cannot be opened or does not need the ocr:
+    # it is cached, has a text layer, is going to be turned before the ocr or is skipped as redlined already;
+    # with use_layout_template only the regions of the layout template the page matches are rendered
+    def prepare_ocr_ahead(self, pdf_path: str, use_layout_template=True, **redline_kwargs) -> bool:
+        if not self._is_ocr_prefetchable(**redline_kwargs):
+            return False
+        if redline_kwargs.get('skip_redlined') and self.preflight(pdf_path).state == PREFLIGHT_DONE:
+            return False
+        adaptive_dpis = redline_kwargs.get('adaptive_dpis')
+        dpi = min(adaptive_dpis) if adaptive_dpis else redline_kwargs.get('dpi', 150)
+        self._prepared_pdf_path = None
+        if not self._set_pdf_path(pdf_path) or not self._open_doc():
+            return False
+        self._prepared_pdf_path = pdf_path
+        try:
+            return self._prepare_page_ocr(dpi, redline_kwargs.get('no_need_to_crop', False),
+                                          redline_kwargs.get('use_text_layer', True),
+                                          redline_kwargs.get('ocr_mode', 'full'), use_layout_template)
+        except MemoryBudgetError:
+            # make_redline ocr-s the document itself, with a smaller image or failing with the error
+            self._drop_page_images()
+            return False
+
+    # ocr-s the crop rectangle rendered by prepare_ocr_ahead, does not touch PyMuPDF, so it may run on any thread;
+    # returns _TEMPLATE_MISS if the regions of the layout template miss some texts, make_redline ocr-s the crop
+    # itself then; the result is only passed back to set_ocr_ahead_result
+    def run_ocr_ahead(self) -> list | object:
+        return self._ocr_image()
+
+    # keeps the result of the ocr done ahead for make_redline, which renders what it needs itself
+    def set_ocr_ahead_result(self, ocr_result_data: list | object) -> None:
+        if ocr_result_data is _TEMPLATE_MISS:
+            self._layout_template_misses.add(self._get_preset_ocr_data_key())
+            self._drop_page_images()
+            return
+        self._preset_ocr_data[self._get_preset_ocr_data_key()] = ocr_result_data
+        # the regions of a layout template are only a part of the crop, so they are not cached as the crop
+        if self._ocr_cache is not None and self._layout_template is None:
+            self._ocr_cache.put(self._get_ocr_cache_key(), ocr_result_data)
+        self._drop_page_images()
+        return
+
+    # renders the crop rectangle of the current page for the ocr done apart from make_redline, or only the regions
+    # of the layout template; returns False if the page does not need the ocr: it is cached, has a text layer
+    # or its crop rectangle is off the page
+    def _prepare_page_ocr(self, dpi: int, no_need_to_crop=False, use_text_layer=True, ocr_mode='full',
+                          use_layout_template=True) -> bool:
+        self._set_dpi(dpi)
+        self._no_need_to_crop = no_need_to_crop
+        self._ocr_mode = ocr_mode
+        if no_need_to_crop:
+            self._set_whole_page_crop()
+        if self._is_crop_off_page() or self._load_ocr_data_from_cache():
+            return False
+        if use_text_layer and self._read_text_layer_measured():
+            return False
+        if use_layout_template and self._prepare_layout_regions():
+            return True
+        if no_need_to_crop:
+            self._cropped_page_opencv_image = self._render_array('crop', self._DPI)
         else:
-            # cropping the right part of the page image
-            self._page_pillow_image_cropped = self._page_pillow_image.crop(
-                (int(self._CROP_X0), int(self._CROP_Y0),
-                 int(self._CROP_X1), int(self._CROP_Y1)))
+            self._cropped_page_opencv_image = self._render_crop()
+        self._update_image_memory_peak()
+        return True
 
-        # converting the pillow image into nampy array
-        self._cropped_page_opencv_image: np.ndarray = np.asarray(self._page_pillow_image_cropped)
+    # redlines many documents with the ocr batched across them, returns whether every document is redlined;
+    # the documents are processed in chunks of batch_size, so only so many cropped images are kept in memory
+    @classmethod
+    def make_redlines(cls, pdf_paths: list[str], batch_size: int = 8, ocr_config: dict | None = None,
+                      crop_rectangle_wh: tuple[float, float, float, float] | None = None, is_memory_lean=False,
+                      memory_budget_mb: float | None = None,
+                      **redline_kwargs) -> list[tuple[bool, 'AnnotationMakerBase']]:
+        results = list()
+        for chunk_start in range(0, len(pdf_paths), batch_size):
+            chunk_paths = pdf_paths[chunk_start:chunk_start + batch_size]
+            makers = [cls(ocr_config) for _ in chunk_paths]
+            for maker in makers:
+                if crop_rectangle_wh is not None:
+                    maker.set_crop_rectangle_wh(*crop_rectangle_wh)
+                maker.set_memory_lean(is_memory_lean)
+                maker.set_memory_budget(memory_budget_mb)
+
+            makers_to_ocr = [maker for maker, pdf_path in zip(makers, chunk_paths)
+                             if maker.prepare_ocr_ahead(pdf_path, use_layout_template=False, **redline_kwargs)]
+            if makers_to_ocr:
+                for maker, ocr_result_data in zip(makers_to_ocr, cls._ocr_batched(makers_to_ocr)):
+                    maker.set_ocr_ahead_result(ocr_result_data)
+
+            for maker, pdf_path in zip(makers, chunk_paths):
+                results.append((maker.make_redline(pdf_path, **redline_kwargs), maker))
+        return results
+
+    # True if the first ocr of a page can be done ahead, before the page is redlined with these layout options
+    def _is_ocr_prefetchable(self, **layout_options) -> bool:
+        return True
 
-        # *************** test of image preparation, may worsen the ocr result *******************
-        # self._cropped_page_opencv_image = cv2.cvtColor(self._cropped_page_opencv_image, cv2.COLOR_BGR2GRAY)
-        # cv2.imwrite(f'images/img_pre-processed_1_{self._DPI}.png', self._cropped_page_opencv_image)
-        # threshold the image using Otsu's thresholding method
-        # self._cropped_page_opencv_image = cv2.threshold(self._cropped_page_opencv_image, 0, 255, \
-        #                                                 cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
-        # cv2.imwrite(f'images/img_pre-processed_2_{self._DPI}.png', self._cropped_page_opencv_image)
-        # kernel = np.ones((2, 2), np.uint8)
-        # self._cropped_page_opencv_image = cv2.dilate(temp_image, kernel, iterations=1)
-        # *************** test of image preparation, may worsen the ocr result *******************
+    # renders the crop rectangle of the page and starts its ocr on the executor thread,
+    # returns None if the page does not need the ocr: it is cached or has a text layer;
+    # the page is read by a maker of its own, so the current page of this one stays untouched
+    def _start_page_ocr(self, executor: ThreadPoolExecutor, page_number: int, dpi: int, no_need_to_crop: bool,
+                        use_text_layer: bool) -> tuple['AnnotationMakerBase', tuple, str | None, Future] | None:
+        page_reader = type(self)(self._ocr.get_config())
+        page_reader.set_crop_rectangle(*self.get_crop_rectangle())
+        page_reader.set_ocr_cache(self._ocr_cache)
+        page_reader.set_layout_templates(self._layout_templates)
+        page_reader.set_preprocessor(self._preprocessor)
+        page_reader._pdf_content_hash = self._pdf_content_hash
+        # the page may be ocr-ed already by the batched ocr of many documents
+        page_reader._preset_ocr_data = dict(self._preset_ocr_data)
+        page_reader._is_memory_lean = self._is_memory_lean
+        page_reader._memory_budget = self._memory_budget
+        page_reader._page = self._doc.load_page(page_number)
+        try:
+            if not page_reader._prepare_page_ocr(dpi, no_need_to_crop, use_text_layer, self._ocr_mode):
+                return None
+        except MemoryBudgetError:
+            # the page is ocr-ed when it is redlined, then its image gets smaller or the page fails with the error
+            return None
+        # PyMuPDF is not thread safe, so everything which reads the page is done here and the thread only ocr-s;
+        # the regions of a layout template are only a part of the crop, so they are not cached as the crop
+        is_cached = self._ocr_cache is not None and page_reader._layout_template is None
+        cache_key = page_reader._get_ocr_cache_key() if is_cached else None
+        return (page_reader, page_reader._get_preset_ocr_data_key(), cache_key,
+                executor.submit(page_reader._ocr_image))
+
+    # waits for the ocr started by _start_page_ocr, its result is taken by make_redline instead of the ocr of the page
+    def _finish_page_ocr(self, page_ocr: tuple['AnnotationMakerBase', tuple, str | None, Future]) -> None:
+        page_reader, preset_key, cache_key, future = page_ocr
+        with self._fitz_lock_released():
+            ocr_result_data = future.result()
+        # the regions of a layout template missed some texts, the page is ocr-ed when it is redlined then
+        if ocr_result_data is _TEMPLATE_MISS:
+            self._layout_template_misses.add(preset_key)
+        else:
+            self._preset_ocr_data[preset_key] = ocr_result_data
+            if cache_key is not None:
+                self._ocr_cache.put(cache_key, ocr_result_data)
+        self._log += page_reader._log
+        self._metrics.merge(page_reader._metrics)
+        # the crop of the next page was held together with the images of this one
+        self._image_memory_peak = max(self._image_memory_peak, page_reader._image_memory_peak)
+        return
 
+    # redlines the pages of the document one by one and yields the result of every page, pages=None means all of them;
+    # the document is saved once, after the last page; while a page is analyzed and annotated the next one
+    # is already ocr-ed in the background, so only two pages are kept in memory, however many the document has;
+    # with skip_redlined the drawings the pre-flight check finds redlined already are not even opened,
+    # no page result is yielded for them and make_redline returns True
+    def redline_pages(self, pdf_path: str, pages: Iterable[int] | None = None, dpi=150, no_need_to_crop=False,
+                      use_text_layer=True, stamp_dpi: int | None = None, adaptive_dpis: tuple[int, ...] | None = None,
+                      min_confidence: float = 0.8, ocr_mode='full', skip_redlined=False,
+                      **layout_options) -> Iterator[PageRedlineResult]:
+        assert ocr_mode in self._OCR_MODES, f"ocr_mode must be one of {self._OCR_MODES}"
+        self._ocr_mode = ocr_mode
+        self._page_results = list()
+        self._is_saved = False
+        self._save_report = None
+        self._preflight = None
+        # the document opened by prepare_ocr_ahead is redlined as it is, its open and render stay in the metrics
+        is_prepared = self._doc is not None and self._prepared_pdf_path == pdf_path
+        self._prepared_pdf_path = None
+        if not is_prepared:
+            self._metrics = StageMetrics()
+            self._image_memory_peak = 0
+        if not self._set_pdf_path(pdf_path):
+            return
+        if skip_redlined and self._is_skipped_as_redlined():
+            self._clear_error()
+            return
+        if is_prepared:
+            self._clear_error()
+        elif not self._open_doc():
+            return
+
+        page_numbers = list(range(self._doc.page_count)) if pages is None else list(pages)
+        # the background ocr is done for the first DPI the page is going to be tried with
+        first_dpi = min(adaptive_dpis) if adaptive_dpis else dpi
+        is_prefetching = self._is_ocr_prefetchable(**layout_options)
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='page-ocr') as executor:
+            next_page_ocr = None
+            if is_prefetching and page_numbers:
+                next_page_ocr = self._start_page_ocr(executor, page_numbers[0], first_dpi, no_need_to_crop,
+                                                     use_text_layer)
+            for index, page_number in enumerate(page_numbers):
+                page_ocr = next_page_ocr
+                next_page_ocr = None
+                # the next page is rendered while the ocr of this one is still running
+                if is_prefetching and index + 1 < len(page_numbers):
+                    next_page_ocr = self._start_page_ocr(executor, page_numbers[index + 1], first_dpi,
+                                                         no_need_to_crop, use_text_layer)
+                log_start = len(self._log)
+                self._load_page(page_number)
+                if page_ocr is not None:
+                    self._finish_page_ocr(page_ocr)
+                try:
+                    success = self._redline_page(dpi, no_need_to_crop, use_text_layer, stamp_dpi, adaptive_dpis,
+                                                 min_confidence, **layout_options)
+                except MemoryBudgetError as e:
+                    self._set_error(str(e))
+                    success = False
+                self._run_stats['image_memory_peak'] = self._image_memory_peak
+                page_result = PageRedlineResult(page_number, success, self.get_error_description(),
+                                                '\r\n'.join(self._log[log_start:]), self.get_run_stats())
+                self._page_results.append(page_result)
+                yield page_result
+        # the page images are not needed any more
+        self._drop_page_images()
+        if self._is_memory_lean or self._memory_budget is not None:
+            self._append_msg_to_log(f'The page images took {self._image_memory_peak / 1024 / 1024:.1f} MB at most')
+
+        failed_results = [result for result in self._page_results if not result.success]
+        if len(failed_results) < len(self._page_results):
+            self._append_msg_to_log(f'Saving the annotated pdf and closing the document...')
+            try:
+                with self._metrics.measure('save'):
+                    self._save_report = self._pdf_saver.save(self._doc, self._pdf_path_annotated)
+                self._is_saved = True
+            except Exception as e:
+                # the saver has closed the document already if it got to it, the working copy must go anyway
+                self._pdf_saver.discard(self._doc)
+                self._set_error(f'Error while saving the annotated pdf: {str(e)}')
+                return
+            finally:
+                self._doc = None
+            self._append_msg_to_log(f'The {self._save_report}')
+            self._run_stats['save'] = self._save_report.as_dict()
+        else:
+            self._pdf_saver.discard(self._doc)
+            self._doc = None
+        if len(failed_results) == 1 and len(page_numbers) == 1:
+            self._error_description = failed_results[0].error_description
+        elif failed_results:
+            self._error_description = '; '.join(f'page {result.page_number + 1}: {result.error_description}'
+                                                for result in failed_results)
         return
 
-    def _ocr_cropped_image(self):
-        result = self._ocr.ocr(self._cropped_page_opencv_image, cls=True)
+    # writes the annotated pdf a deferred saver kept in memory, returns whether the document is redlined;
+    # it does not touch PyMuPDF, so the file may be written on another thread while the next document is redlined
+    def write_deferred_pdf(self) -> bool:
+        if self._pdf_saver is None or not self._pdf_saver.has_pending_writes():
+            return self._is_redlined()
+        try:
+            with self._metrics.measure('write'):
+                write_time = self._pdf_saver.write_pending()
+        except Exception as e:
+            self._is_saved = False
+            self._set_error(f'Error while writing the annotated pdf: {str(e)}')
+            return False
+        self._append_msg_to_log(f'The annotated pdf is written in {write_time:.3f} s')
+        self._save_report.save_time += write_time
+        self._run_stats['save'] = self._save_report.as_dict()
+        return self._is_redlined()
+
+    # returns True if every page is redlined and the document is saved, or it was redlined already
+    def _is_redlined(self) -> bool:
+        if self._preflight is not None and self._preflight.state == PREFLIGHT_DONE:
+            return True
+        return self._is_saved and all(result.success for result in self._page_results)
+
+    # analyzes and annotates the current page, returns False if failed
+    @abstractmethod
+    def _redline_page(self, dpi: int, no_need_to_crop: bool, use_text_layer: bool, stamp_dpi: int | None,
+                      adaptive_dpis: tuple[int, ...] | None, min_confidence: float, **layout_options) -> bool:
+        pass
+
+    def _get_page_rect_rotated(self, rect: Rect) -> Rect:
+        # text extraction works with the unrotated page, the images and the crop rectangle - with the rotated one
+        rotated_rect = rect * self._page.rotation_matrix
+        rotated_rect.normalize()
+        return rotated_rect
+
+    def _is_line_horizontal(self, line_dir: tuple[float, float]) -> bool:
+        # the ocr reads only the lines that are horizontal on the rotated page, so the text layer should do the same
+        origin = Point(0, 0) * self._page.rotation_matrix
+        direction = Point(line_dir) * self._page.rotation_matrix - origin
+        return direction.x > 0.9
+
+    def _split_text_line(self, chars: list[tuple[str, Rect]]) -> list[tuple[str, Rect]]:
+        # the ocr returns one box for the words standing close to each other and separate boxes for distant ones
+        text_boxes = list()
+        text, text_rect = '', None
+        for char, char_rect in chars:
+            # spaces are judged by the actual gaps between the visible characters
+            if char.isspace():
+                continue
+            if text_rect is not None:
+                gap = char_rect.x0 - text_rect.x1
+                if gap > char_rect.height * self._TEXT_LAYER_JOIN_GAP:
+                    text_boxes.append((text, text_rect))
+                    text, text_rect = '', None
+                elif gap > char_rect.height * self._TEXT_LAYER_SPACE_GAP:
+                    text += ' '
+            text += char
+            text_rect = Rect(char_rect) if text_rect is None else text_rect | char_rect
+        if text_rect is not None:
+            text_boxes.append((text, text_rect))
+        return text_boxes
+
+    # reads the words inside the crop rectangle from the pdf text layer, returns False if there is no usable text:
+    # the scanned drawings often have a text layer made by the ocr of the scanner, too noisy to rely on,
+    # so it is used only if it has the FCS text the analysis looks for
+    def _read_text_layer(self) -> bool:
+        if not self._is_dpi_set:
+            raise NoDPIError("DPI must be set before working with images")
+
+        crop_rect = Rect(self._CROP_X0 / self._PDF_ZOOM_FACTOR, self._CROP_Y0 / self._PDF_ZOOM_FACTOR,
+                         self._CROP_X1 / self._PDF_ZOOM_FACTOR, self._CROP_Y1 / self._PDF_ZOOM_FACTOR)
+        clip = crop_rect * self._page.derotation_matrix
+        clip.normalize()
+        text_data = self._page.get_text('rawdict', clip=clip)
+
+        text_layer_data = list()
+        for block in text_data['blocks']:
+            for line in block.get('lines', []):
+                if not self._is_line_horizontal(line['dir']):
+                    continue
+                chars = [(char['c'], self._get_page_rect_rotated(Rect(char['bbox'])))
+                         for span in line['spans'] for char in span['chars']]
+                for text, text_rect in self._split_text_line(chars):
+                    # the same format as the ocr result has: four corners in cropped image pixels, text and score
+                    x0 = text_rect.x0 * self._PDF_ZOOM_FACTOR - self._CROP_X0
+                    y0 = text_rect.y0 * self._PDF_ZOOM_FACTOR - self._CROP_Y0
+                    x1 = text_rect.x1 * self._PDF_ZOOM_FACTOR - self._CROP_X0
+                    y1 = text_rect.y1 * self._PDF_ZOOM_FACTOR - self._CROP_Y0
+                    text_layer_data.append([[[x0, y0], [x1, y0], [x1, y1], [x0, y1]], (text, 1.0)])
+
+        if not any(char.isalnum() for block in text_layer_data for char in block[1][0]):
+            return False
+        if not any(self._FCS_REGEX.match(block[1][0]) for block in text_layer_data):
+            self._append_msg_to_log(f'The text layer has {len(text_layer_data)} text blocks, but no FCS text, '
+                                    f'OCR is used instead')
+            return False
 
-        # as there is only one page, the result contains only one element
-        self._ocr_result_data = result[0]
+        # the ocr returns blocks from top to bottom and from left to right, the analysis relies on it
+        text_layer_data.sort(key=lambda block: (block[0][0][1], block[0][0][0]))
+        self._ocr_result_data = text_layer_data
+        return True
+
+    # drawings coming from CAD have a real text layer, reading it takes milliseconds instead of seconds of OCR
+    def _read_text_layer_measured(self) -> bool:
+        with self._metrics.measure('text_layer'):
+            has_text_layer = self._read_text_layer()
+        if has_text_layer:
+            self._append_msg_to_log(f'The text layer is used instead of OCR, {len(self._ocr_result_data)} '
+                                    f'text blocks found')
+        return has_text_layer
+
+    # the crop rectangle of no_need_to_crop, in the pixels of the ocr DPI
+    def _set_whole_page_crop(self) -> None:
+        self._CROP_X0, self._CROP_Y0 = 0, 0
+        self._CROP_X1 = self._page.rect.width * self._PDF_ZOOM_FACTOR
+        self._CROP_Y1 = self._page.rect.height * self._PDF_ZOOM_FACTOR
+        return
+
+    # ocr-s the crop rectangle, or only the regions of the layout template if the page matches one
+    def _get_ocr_data(self) -> None:
+        if self._prepare_layout_regions():
+            with self._fitz_lock_released():
+                ocr_result_data = self._ocr_image()
+            self._region_images = list()
+            if ocr_result_data is not _TEMPLATE_MISS:
+                self._ocr_result_data = ocr_result_data
+                return
+        self._layout_template = None
+        self._ocr_cropped_image()
         return
 
     # returns False if failed
 
+    # adds the FCS and node annotations and the stamp to the current page
+    def _annotate_page(self) -> None:
+        self._record_layout_template()
+        with self._metrics.measure('annotation'):
+            self._wrap_page_content()
+            self._add_fcs_annotations()
+            self._add_node_annotations()
+        self._add_stamp()
+        # the page images are of no use after the stamp is placed
+        if self._is_memory_lean:
+            self._drop_page_images()
+        return
+
     def _add_stamp(self):
         # defining static coordinates for the stamp is a bad idea, because the stamp may overlap with useful info
         # stamp_rect = (1400, 1000, 1800, 1200)
         # instead, we find an empty space for the stamp!
-        grayed_page_image = cv2.cvtColor(self._page_opencv_image, cv2.COLOR_BGR2GRAY)
-
-        # create a grayscale image 200x400
-        empty_template = np.zeros([int(200 * self._DPI / 150), int(400 * self._DPI / 150), 1],
-                                  dtype=np.uint8)
-        # fill with 254 color (255 is white in grayscale), for some reason it is the prevailing color
-        empty_template.fill(254)
-        # getting width and height to calculate the rectangle later
-        template_h, template_w = empty_template.shape[0:2]
-
-        # finding an empty space
-        match_method = cv2.TM_SQDIFF
-        res = cv2.matchTemplate(grayed_page_image, empty_template, match_method)
-        # cv2.normalize(res, res, 0, 1, cv2.NORM_MINMAX, -1) # it seems like it is not needed
-        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res, None)
-        if match_method in (cv2.TM_SQDIFF, cv2.TM_SQDIFF_NORMED):
-            location = min_loc
-        else:
-            location = max_loc
-
-        # calculating the stamp rectangle coordinates
-        bottom_right = (location[0] + template_w, location[1] + template_h)
-        stamp_rect = (location, bottom_right)
-        stamp_rect = self._get_pdfed_rect(*stamp_rect[0], *stamp_rect[1])
+        # the stamp is 400x200 pixels at dpi 150
+        stamp_width, stamp_height = 400 * self._PAGE_DPI / 150, 200 * self._PAGE_DPI / 150
+        with self._metrics.measure('stamp_search'):
+            locator = FreeSpaceLocator(self._page_opencv_image)
+            # the stamp must not cover the annotations just added
+            locator.exclude([tuple(self._get_page_rect_rotated(annot.rect) * self._PAGE_ZOOM_FACTOR)
+                             for annot in self._page.annots()])
+            preferred_regions = [tuple(coordinate * self._PAGE_ZOOM_FACTOR for coordinate in region)
+                                 for region in self._stamp_preferred_regions_72]
+            stamp_rect = locator.find(stamp_width, stamp_height,
+                                      margin=self._stamp_margin_72 * self._PAGE_ZOOM_FACTOR,
+                                      preferred_regions=preferred_regions)
+        if stamp_rect is None:
+            self._append_msg_to_log(f'WARNING: there is no space for the stamp on the page')
+            return
+        stamp_rect = self._get_pdfed_rect(*stamp_rect, zoom_factor=self._PAGE_ZOOM_FACTOR)
 
         # adding the stamp
-        self._page.insert_image(stamp_rect, filename='images/RLMU_Stamp.png', keep_proportion=True,
-                                overlay=True, rotate=self._page.rotation)
+        with self._metrics.measure('annotation'):
+            self._page.insert_image(stamp_rect, filename=self._STAMP_IMAGE_PATH, keep_proportion=True,
+                                    overlay=True, rotate=self._page.rotation)
         return
 
     def _set_pdf_path(self, pdf_path) -> bool:
@@ -274,25 +1319,105 @@ class AnnotationMakerBase:
 
 
 class AnnotationMakerOld(AnnotationMakerBase):
-    def __init__(self):
-        super().__init__()
+    _FCS_REGEX = re.compile(r'^FCS\d\d\d\d$')
+    # the orientation guess works on a thumbnail of this DPI and classifies this many of the longest text boxes
+    _ORIENTATION_GUESS_DPI = 100
+    _ORIENTATION_GUESS_BOXES = 20
+
+    def __init__(self, ocr_config: dict | None = None):
+        super().__init__(ocr_config)
         self._CROP_X0_72 = 989
         self._CROP_Y0_72 = 62
         self._CROP_X1_72 = 1152
         self._CROP_Y1_72 = 624
         self._tries_to_ocr: int = 4  # one initial try + 3 tries after rotation by 90 degrees
         self._node_number_rects = list()
+        # the page is rendered once, the other orientations are made by rotating the pixels in memory
+        self._rendered_page_image: np.ndarray | None = None
+        self._rendered_page_rotation: int = 0
+
+    def _get_held_images(self) -> list:
+        return super()._get_held_images() + [self._rendered_page_image]
+
+    def _render_rotated_page(self) -> None:
+        if self._rendered_page_image is None:
+            self._fit_page_dpi_to_budget(1 if self._is_page_gray() else 3)
+            self._rendered_page_image = self._render_array('rendered_page', self._PAGE_DPI, gray=self._is_page_gray())
+            self._rendered_page_rotation = self._page.rotation
+        return
+
+    def _get_pics_from_page(self, no_need_to_crop=False, page_image: np.ndarray | None = None,
+                            need_cropped_image=True):
+        if page_image is None:
+            self._render_rotated_page()
+            # the page rotation is clockwise, so is np.rot90 with the negative number of turns,
+            # the turned page is a view, no pixels are copied
+            turns = (self._page.rotation - self._rendered_page_rotation) // 90 % 4
+            page_image = np.rot90(self._rendered_page_image, k=-turns)
+        super()._get_pics_from_page(no_need_to_crop, page_image, need_cropped_image)
+        return
+
+    # guesses how many clockwise turns by 90 degrees make the text upright:
+    # text boxes taller than wide mean the page lies on its side, the angle classifier tells upside down text
+    def _guess_rotation_turns(self) -> int:
+        self._render_rotated_page()
+
+        # the detection on a thumbnail is enough to tell the orientation of the text boxes
+        scale = min(1.0, self._ORIENTATION_GUESS_DPI / self._PAGE_DPI)
+        thumbnail = cv2.resize(self._rendered_page_image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        # the ocr models take color images only
+        if thumbnail.ndim == 2:
+            thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_GRAY2RGB)
+        with self._fitz_lock_released():
+            boxes = self._ocr.detect(thumbnail)
+        if not boxes:
+            return 0
+        sizes = [(box[2][0] - box[0][0], box[2][1] - box[0][1]) for box in boxes]
+        vertical_boxes = sum(1 for width, height in sizes if height > 1.5 * width)
+        horizontal_boxes = sum(1 for width, height in sizes if width > 1.5 * height)
+        turns = 1 if vertical_boxes > horizontal_boxes else 0
+
+        # the longest boxes are the most reliable ones for the classifier, they are cut from the full resolution image
+        text_lines = list()
+        longest_boxes = sorted(boxes, key=lambda b: -max(b[2][0] - b[0][0], b[2][1] - b[0][1]))
+        for box in longest_boxes[:self._ORIENTATION_GUESS_BOXES]:
+            x0, y0 = int(min(point[0] for point in box) / scale), int(min(point[1] for point in box) / scale)
+            x1, y1 = int(max(point[0] for point in box) / scale), int(max(point[1] for point in box) / scale)
+            text_line = self._rendered_page_image[max(y0, 0):y1, max(x0, 0):x1]
+            if text_line.size > 0:
+                text_line = np.ascontiguousarray(np.rot90(text_line, k=-turns))
+                text_lines.append(cv2.cvtColor(text_line, cv2.COLOR_GRAY2RGB) if text_line.ndim == 2 else text_line)
+        with self._fitz_lock_released():
+            labels = [label for label, _ in self._ocr.classify(text_lines)]
+        if labels.count('180') > len(labels) / 2:
+            turns += 2
+        return turns % 4
+
+    def _get_follow_up_boxes(self, boxes: list[list[list[float]]], ocr_result_data: list) -> list[list[list[float]]]:
+        # the node numbers are short, so they are not candidates, but they are in the column under the NODE text
+        follow_up_boxes = list()
+        for node_box, (text, _) in ocr_result_data:
+            if text not in self._NODE_TEXTS:
+                continue
+            # the same bounds as the analysis uses
+            node_text_x0, node_text_x2, node_text_y2 = node_box[0][0], node_box[2][0] + 15, node_box[2][1]
+            follow_up_boxes += [box for box in boxes if node_text_x0 < box[1][0] < node_text_x2 and
+                                box[1][1] > node_text_y2 and box not in follow_up_boxes]
+        return follow_up_boxes
 
     def _analyze_ocred_data(self) -> bool:
         assert self._ocr_result_data is not [], "cannot ocr empty data"
 
         fcs_rect = list()
         node_text_rect = list()
+        # the node numbers found at another rotation or DPI are of no use
+        self._node_number_rects = list()
+        self._found_confidences = list()
 
         # preparing to draw on the cropped image
-        draw = ImageDraw.Draw(self._page_pillow_image_cropped)
+        draw = self._get_debug_draw(self._page_pillow_image_cropped)
 
-        fcs_regex = re.compile(r"^FCS\d\d\d\d$")
+        fcs_regex = self._FCS_REGEX
         # checking every block of text
         for block in self._ocr_result_data:
             # draw a RED rectangle for ALL texts found
@@ -302,8 +1427,9 @@ class AnnotationMakerOld(AnnotationMakerBase):
                 self._append_msg_to_log(f'Exception while drawing a rectangle: {str(e)}')
             # saving coordinates for later
             coordinates: list[list[float: 2]: 4] = block[0]
-            # saving text for later
+            # saving text and its ocr score for later
             text: str = block[1][0]
+            score = float(block[1][1])
             # print(f"{text=}")
 
             # checking first five symbols for the desired text ('FCS07' in our case)
@@ -312,6 +1438,7 @@ class AnnotationMakerOld(AnnotationMakerBase):
                 if matching_result is not None:
                     # saving coordinates of the desired text ('FCS07' in our case)
                     fcs_rect: list[list[float: 2]: 4] = coordinates
+                    self._found_confidences.append(score)
                     self._append_msg_to_log(f'{text} was found in {fcs_rect}')
 
                     # as we found the FCS text, there is no need to rotate the page and searching the text again
@@ -329,6 +1456,7 @@ class AnnotationMakerOld(AnnotationMakerBase):
             if text in self._NODE_TEXTS:
                 # saving the 'NODE' text coordinates for later
                 node_text_rect = coordinates
+                self._found_confidences.append(score)
                 self._append_msg_to_log(f'NODE was found in {node_text_rect}')
 
                 self._node_text_x0 = coordinates[0][0]
@@ -346,17 +1474,18 @@ class AnnotationMakerOld(AnnotationMakerBase):
                     self._node_number_rects.append(coordinates)
                     # forming the new node number text
                     self._new_node_number_text = str(int(text) + 1)
+                    self._found_confidences.append(score)
                     self._append_msg_to_log(f'NODE number {str(int(text))} was found in {coordinates}')
 
         if not node_text_rect:
             self._append_msg_to_log(f'NODE was NOT found')
 
-        self._page_pillow_image_cropped.save('images/img_cropped.png', format='PNG')
+        self._save_debug_image('img_cropped.png', self._page_pillow_image_cropped)
 
         # if the FCS text was not found, rotate the page and decrement the number of tries left
         if not fcs_rect:
             self._append_msg_to_log(f'{self._FCS_TEXT_TO_FIND} was NOT found')
-            self._page.set_rotation(self._page.rotation + 90)
+            self._page.set_rotation((self._page.rotation + 90) % 360)
             self._tries_to_ocr -= 1
             self._append_msg_to_log(f'Rotating the page, {self._tries_to_ocr} tries left...')
             # if no tries left - quit the script
@@ -384,10 +1513,11 @@ class AnnotationMakerOld(AnnotationMakerBase):
         self._fcs_found_text_rect = self._get_pdfed_rect(*fcs_top_left, *fcs_bottom_right)
 
         # drawing on the page image and saving it for debug purposes
-        draw = ImageDraw.Draw(self._page_pillow_image)
-        draw.rectangle((self._CROP_X0, self._CROP_Y0, self._CROP_X1, self._CROP_Y1), outline='red', width=5)
-        draw.rectangle(tuple(fcs_top_left + fcs_bottom_right), outline='blue', width=2)
-        self._page_pillow_image.save('images/img_original_marked.png', format='PNG')
+        draw = self._get_debug_draw(self._page_pillow_image)
+        draw.rectangle(self._get_page_image_rect(self._CROP_X0, self._CROP_Y0, self._CROP_X1, self._CROP_Y1),
+                       outline='red', width=5)
+        draw.rectangle(self._get_page_image_rect(*fcs_top_left, *fcs_bottom_right), outline='blue', width=2)
+        self._save_debug_image('img_original_marked.png', self._page_pillow_image)
 
         self._page.add_line_annot((self._fcs_found_text_rect[0], self._fcs_found_text_rect[1]),
                                   (self._fcs_found_text_rect[2], self._fcs_found_text_rect[3]))
@@ -397,7 +1527,7 @@ class AnnotationMakerOld(AnnotationMakerBase):
 
     # adding NODE annotations into pdf
     def _add_node_annotations(self):
-        draw = ImageDraw.Draw(self._page_pillow_image)
+        draw = self._get_debug_draw(self._page_pillow_image)
         for nn in self._node_number_rects:
             # calculating Node numbers coordinates
             # noinspection PyTypeChecker
@@ -412,53 +1542,87 @@ class AnnotationMakerOld(AnnotationMakerBase):
             nn_new_y1: float = nn_new_y0 + (nn_bottom_right[1] - nn_top_left[1]) + 10
             nn_new_text_rect: Rect = self._get_pdfed_rect(nn_new_x0, nn_new_y0, nn_new_x1, nn_new_y1)
             node_number_text_rect: Rect = self._get_pdfed_rect(*nn_top_left, *nn_bottom_right)
-            draw.rectangle(tuple(nn_top_left + nn_bottom_right), outline='orange', width=2)
+            draw.rectangle(self._get_page_image_rect(*nn_top_left, *nn_bottom_right), outline='orange', width=2)
 
             # adding Node numbers annotations into pdf
             self._page.add_line_annot((node_number_text_rect[0], node_number_text_rect[1]),
                                       (node_number_text_rect[2], node_number_text_rect[3]))
             self._page.add_freetext_annot(nn_new_text_rect, self._new_node_number_text, text_color=(255, 0, 0),
                                           border_color=None, rotate=self._page.rotation, fontsize=8)
-        self._page_pillow_image.save('images/img_original_marked.png', format='PNG')
+        self._save_debug_image('img_original_marked.png', self._page_pillow_image)
         return
 
-    def make_redline(self, pdf_path: str, dpi=150, no_need_to_crop=False, tries_to_rotate=3) -> bool:
-        assert 0 <= tries_to_rotate < 4, "tries_to_rotate must be 0, 1, 2, or 3"
+    def _drop_page_images(self) -> None:
+        super()._drop_page_images()
+        self._rendered_page_image = None
+        return
 
-        if not self._set_pdf_path(pdf_path):
-            return False
-        if not self._open_doc():
-            return False
+    # the node numbers are under the NODE text, their regions are needed as well
+    def _get_found_text_boxes(self) -> list[list[list[float]]]:
+        return super()._get_found_text_boxes() + list(self._node_number_rects)
 
-        self._set_dpi(dpi)
+    # the orientation guess turns the page before the ocr, so the ocr done ahead would be of no use
+    def _is_ocr_prefetchable(self, guess_rotation=False, **layout_options) -> bool:
+        return not guess_rotation
+
+    def _redline_page(self, dpi: int, no_need_to_crop: bool, use_text_layer: bool, stamp_dpi: int | None,
+                      adaptive_dpis: tuple[int, ...] | None, min_confidence: float, tries_to_rotate=3,
+                      guess_rotation=False) -> bool:
+        assert 0 <= tries_to_rotate < 4, "tries_to_rotate must be 0, 1, 2, or 3"
+        dpis = self._start_run_stats(dpi, adaptive_dpis)
         ocr_success = False
-        self._tries_to_ocr = tries_to_rotate + 1
-        while self._tries_to_ocr > 0:
-            self._get_pics_from_page(no_need_to_crop)
-            self._ocr_cropped_image()
-            ocr_success = self._analyze_ocred_data()
+        for dpi_index, attempt_dpi in enumerate(dpis):
+            self._set_dpi(attempt_dpi, stamp_dpi)
+            self._run_stats['dpis_tried'].append(attempt_dpi)
+            self._rendered_page_image = None
+            if guess_rotation and dpi_index == 0:
+                # starting from the most likely orientation, the others are still tried if the FCS text is not found
+                with self._metrics.measure('orientation'):
+                    turns = self._guess_rotation_turns()
+                if turns:
+                    self._append_msg_to_log(f'The page seems to be rotated, starting with {turns * 90} degrees more')
+                    self._page.set_rotation((self._page.rotation + turns * 90) % 360)
+            start_rotation = self._page.rotation
+            self._tries_to_ocr = tries_to_rotate + 1
+            while self._tries_to_ocr > 0:
+                self._prepare_ocr_data(no_need_to_crop, use_text_layer)
+                with self._metrics.measure('analysis'):
+                    ocr_success = self._analyze_ocred_data()
+
+            is_last_dpi = dpi_index == len(dpis) - 1
+            if ocr_success and self._is_confident(min_confidence, is_last_dpi):
+                break
+            if not ocr_success and not is_last_dpi:
+                self._append_msg_to_log(f'Nothing was found at DPI {attempt_dpi}, trying a higher DPI...')
+                self._page.set_rotation(start_rotation)
 
         if not ocr_success:
             return False
-        self._wrap_page_content()
-        self._add_fcs_annotations()
-        self._add_node_annotations()
-        self._add_stamp()
-
-        self._append_msg_to_log(f'Saving the annotated pdf and closing the document...')
-        try:
-            self._doc.save(self._pdf_path_annotated)
-        except Exception as e:
-            self._append_msg_to_log(f'Error while saving the annotated pdf: {str(e)}')
-            return False
+        self._run_stats['dpi'] = self._DPI
         self._clear_error()
-        # returns True if success, otherwise False
+        self._annotate_page()
         return True
 
+    # adaptive_dpis, i.e. (150, 200, 300), starts with the cheapest DPI and raises it only if the FCS text is not found
+    # or the found texts have the ocr score below min_confidence, dpi is ignored then;
+    # pages=None redlines all the pages of the document, see redline_pages to get the results page by page
+    def make_redline(self, pdf_path: str, dpi=150, no_need_to_crop=False, tries_to_rotate=3,
+                     use_text_layer=True, guess_rotation=False, stamp_dpi: int | None = None,
+                     adaptive_dpis: tuple[int, ...] | None = None, min_confidence: float = 0.8,
+                     ocr_mode='full', pages: Iterable[int] | None = None, skip_redlined=False) -> bool:
+        for _ in self.redline_pages(pdf_path, pages, dpi, no_need_to_crop, use_text_layer, stamp_dpi, adaptive_dpis,
+                                    min_confidence, ocr_mode, skip_redlined, tries_to_rotate=tries_to_rotate,
+                                    guess_rotation=guess_rotation):
+            pass
+        # returns True if success, otherwise False
+        return self._is_redlined()
+
 
 class AnnotationMakerNew(AnnotationMakerBase):
-    def __init__(self):
-        super().__init__()
+    _FCS_REGEX = re.compile(r"^(FCS|FSC)\d\d(\d\d)-?(\d\d)-?(\d\d).*$")
+
+    def __init__(self, ocr_config: dict | None = None):
+        super().__init__(ocr_config)
         self._CROP_X0_72 = 730
         self._CROP_Y0_72 = 12
         self._CROP_X1_72 = 1176
@@ -472,11 +1636,19 @@ class AnnotationMakerNew(AnnotationMakerBase):
     def _analyze_ocred_data(self, need_fcs_check=True) -> bool:
         assert self._ocr_result_data is not [], "cannot ocr empty data"
 
-        fcs_regex = re.compile(r"^(FCS|FSC)\d\d(\d\d)-?(\d\d)-?(\d\d).*$")
+        # the texts found at another DPI are of no use
+        self._fcs_new_texts = list()
+        self._fcs_rects = list()
+        self._node_rects = list()
+        self._node_text_lengths = list()
+        self._new_node_numbers = list()
+        self._found_confidences = list()
+
+        fcs_regex = self._FCS_REGEX
         node_regex = re.compile(r"^N[O0C]DE\s*(\d{1,2})\s*$")
 
         # preparing to draw on the cropped image
-        draw = ImageDraw.Draw(self._page_pillow_image_cropped)
+        draw = self._get_debug_draw(self._page_pillow_image_cropped)
 
         # checking every block of text
         for block in self._ocr_result_data:
@@ -487,8 +1659,9 @@ class AnnotationMakerNew(AnnotationMakerBase):
                 self._append_msg_to_log(f'Exception while drawing a rectangle: {str(e)}')
             # saving coordinates for later
             coordinates: list[list[float, float]:4] = block[0]
-            # saving text for later
+            # saving text and its ocr score for later
             text: str = block[1][0]
+            score = float(block[1][1])
             # print(f"{text=}")
 
             if text[:5] == self._FCS_TEXT_TO_REPLACE_WITH and len(self._fcs_rects) == 0:
@@ -505,6 +1678,7 @@ class AnnotationMakerNew(AnnotationMakerBase):
                     replaced_with = f"{fcs_name}-{new_fcs_node_number}-{matching_result.group(4)}"
                     self._fcs_new_texts.append(replaced_with)
                     self._fcs_rects.append(fcs_rect)
+                    self._found_confidences.append(score)
                     self._append_msg_to_log(f'{text} was found in {fcs_rect}')
                 try:
                     draw.rectangle(tuple(fcs_rect[0] + fcs_rect[2]), outline='blue', width=2)
@@ -521,13 +1695,14 @@ class AnnotationMakerNew(AnnotationMakerBase):
                     self._node_rects.append(node_rect)
                     self._new_node_numbers.append(new_node_number)
                     self._node_text_lengths.append(len(text))
+                    self._found_confidences.append(score)
                     self._append_msg_to_log(f'{text} was found in {node_rect}, {node_number=}')
                     try:
                         draw.rectangle(tuple(node_rect[0] + node_rect[2]), outline='green', width=2)
                     except Exception as e:
                         self._append_msg_to_log(f'Exception while drawing a rectangle: {str(e)}')
 
-        self._page_pillow_image_cropped.save('images/img_cropped.png', format='PNG')
+        self._save_debug_image('img_cropped.png', self._page_pillow_image_cropped)
 
         if len(self._fcs_rects) > 0:
             if len(self._fcs_rects) != len(self._node_rects):
@@ -543,15 +1718,17 @@ class AnnotationMakerNew(AnnotationMakerBase):
 
     def _add_fcs_annotations(self) -> None:
         # preparing to draw on the page image for debug purposes
-        draw = ImageDraw.Draw(self._page_pillow_image)
-        draw.rectangle((self._CROP_X0, self._CROP_Y0, self._CROP_X1, self._CROP_Y1), outline='red', width=5)
+        draw = self._get_debug_draw(self._page_pillow_image)
+        draw.rectangle(self._get_page_image_rect(self._CROP_X0, self._CROP_Y0, self._CROP_X1, self._CROP_Y1),
+                       outline='red', width=5)
 
         # for each found FCS rectangle and text
         for fcs_rect, fcs_text in zip(self._fcs_rects, self._fcs_new_texts):
             # calculating absolute page coordinates for a line annotation
             fcs_page_line_top_left, fcs_page_line_bottom_right = self._get_points_from_cropped(fcs_rect[0], fcs_rect[2])
             # drawing a blue rectangle on the page image for debug purposes
-            draw.rectangle(tuple(fcs_page_line_top_left + fcs_page_line_bottom_right), outline='blue', width=2)
+            draw.rectangle(self._get_page_image_rect(*fcs_page_line_top_left, *fcs_page_line_bottom_right),
+                           outline='blue', width=2)
             # calculating page coordinates for a text annotation
             # x0_new = 2*x0-x1-5, y0, # x1_new = x0-5, y1
             fcs_text_page_top_left = (2 * fcs_page_line_top_left[0] - fcs_page_line_bottom_right[0] - 5,
@@ -575,7 +1752,7 @@ class AnnotationMakerNew(AnnotationMakerBase):
                 self._append_msg_to_log(f'WARNING: failed to add an FCS text annotation: {str(e)}')
 
         # saving the image for debug purposes
-        self._page_pillow_image.save('images/img_original_marked.png', format='PNG')
+        self._save_debug_image('img_original_marked.png', self._page_pillow_image)
         return
 
     # adding NODE annotations into pdf
@@ -597,38 +1774,44 @@ class AnnotationMakerNew(AnnotationMakerBase):
                 self._append_msg_to_log(f'WARNING: failed to add a node number annotation: {str(e)}')
         return
 
-    def make_redline(self, pdf_path: str, dpi=150, no_need_to_crop=False, need_fcs_check=True) -> bool:
-        if not self._set_pdf_path(pdf_path):
-            return False
-
-        if not self._open_doc():
-            return False
-
+    def _redline_page(self, dpi: int, no_need_to_crop: bool, use_text_layer: bool, stamp_dpi: int | None,
+                      adaptive_dpis: tuple[int, ...] | None, min_confidence: float, need_fcs_check=True) -> bool:
         ocr_success = False
-        self._set_dpi(dpi)
-        super()._get_pics_from_page(no_need_to_crop)
-        super()._ocr_cropped_image()
-        try:
-            ocr_success = self._analyze_ocred_data(need_fcs_check)
-        except NoNeedToRedlineError as e:
-            self._set_error(str(e))
-            return False
+        dpis = self._start_run_stats(dpi, adaptive_dpis)
+        for dpi_index, attempt_dpi in enumerate(dpis):
+            self._set_dpi(attempt_dpi, stamp_dpi)
+            self._run_stats['dpis_tried'].append(attempt_dpi)
+            super()._prepare_ocr_data(no_need_to_crop, use_text_layer)
+            try:
+                with self._metrics.measure('analysis'):
+                    ocr_success = self._analyze_ocred_data(need_fcs_check)
+            except NoNeedToRedlineError as e:
+                self._set_error(str(e))
+                return False
+
+            is_last_dpi = dpi_index == len(dpis) - 1
+            if ocr_success and self._is_confident(min_confidence, is_last_dpi):
+                break
+            if not ocr_success and not is_last_dpi:
+                self._append_msg_to_log(f'Nothing was found at DPI {attempt_dpi}, trying a higher DPI...')
 
         if not ocr_success:
             self._set_error(f'No FCS text thats suits the template was found')
             return False
+        self._run_stats['dpi'] = self._DPI
 
-        self._wrap_page_content()
-        self._add_fcs_annotations()
-        self._add_node_annotations()
-        self._add_stamp()
-
-        self._append_msg_to_log(f'Saving the annotated pdf and closing the document...')
-        try:
-            self._doc.save(self._pdf_path_annotated)
-        except Exception as e:
-            self._append_msg_to_log(f'Error while saving the annotated pdf: {str(e)}')
-            return False
+        self._annotate_page()
         self._clear_error()
-
         return True
+
+    # adaptive_dpis, i.e. (150, 200, 300), starts with the cheapest DPI and raises it only if the FCS text is not found
+    # or the found texts have the ocr score below min_confidence, dpi is ignored then;
+    # pages=None redlines all the pages of the document, see redline_pages to get the results page by page
+    def make_redline(self, pdf_path: str, dpi=150, no_need_to_crop=False, need_fcs_check=True,
+                     use_text_layer=True, stamp_dpi: int | None = None,
+                     adaptive_dpis: tuple[int, ...] | None = None, min_confidence: float = 0.8,
+                     ocr_mode='full', pages: Iterable[int] | None = None, skip_redlined=False) -> bool:
+        for _ in self.redline_pages(pdf_path, pages, dpi, no_need_to_crop, use_text_layer, stamp_dpi, adaptive_dpis,
+                                    min_confidence, ocr_mode, skip_redlined, need_fcs_check=need_fcs_check):
+            pass
+        return self._is_redlined()
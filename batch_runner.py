@@ -0,0 +1,253 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator
+import functools
+import itertools
+import os
+from autoRLMU import AnnotationMakerBase, AnnotationMakerOld, AnnotationMakerNew
+from debug_artifacts import configure_debug_artifacts
+from ocr_cache import configure_ocr_cache
+from image_preprocessing import configure_image_preprocessing
+from layout_classifier import get_layout_classifier
+from layout_templates import configure_layout_templates
+from ocr_engine import get_ocr_registry
+from pdf_saver import configure_pdf_saver
+from preflight import PREFLIGHT_DONE
+from redline_pipeline import PipelineItem, RedlinePipeline, fitz_lock
+from resource_governor import ResourceGovernor, apply_memory_limit
+from stage_metrics import configure_profiling, profile_document, set_memory_tracking
+
+
+MAKER_CLASSES = {'old': AnnotationMakerOld, 'new': AnnotationMakerNew}
+# 'auto' lets the layout classifier pick the maker, the crop rectangle and the rotation of every drawing,
+# so the options of its jobs must suit both makers
+AUTO_MAKER = 'auto'
+MAKER_CHOICES = (*MAKER_CLASSES, AUTO_MAKER)
+# the maker of the drawings whose layout is not recognized
+DEFAULT_MAKER = 'old'
+# with many workers the pipelined jobs are dealt out in chunks of this size,
+# long enough for the stages to overlap and short enough to keep the workers busy till the end
+PIPELINE_CHUNK_SIZE = 8
+
+
+class RedlineJob:
+    # everything a worker process needs to redline one row of the check sheet, must stay picklable
+    def __init__(self, row: int, pdf_path: str, maker: str = DEFAULT_MAKER, dpi: int = 150,
+                 crop_rectangle_wh: tuple[float, float, float, float] | None = None,
+                 ocr_config: dict | None = None, options: dict | None = None, is_memory_lean: bool = False,
+                 memory_budget_mb: float | None = None):
+        assert maker in MAKER_CHOICES, f"maker must be one of {MAKER_CHOICES}"
+        self.row = row
+        self.pdf_path = pdf_path
+        self.maker = maker
+        self.dpi = dpi
+        self.crop_rectangle_wh = crop_rectangle_wh
+        self.ocr_config = ocr_config
+        # the page images are rendered gray and dropped early, and the document may not take more than the budget
+        self.is_memory_lean = is_memory_lean
+        self.memory_budget_mb = memory_budget_mb
+        # other keyword arguments of make_redline, i.e. stamp_dpi
+        self.options = dict() if options is None else options
+
+
+class RedlineResult:
+    def __init__(self, row: int, pdf_path: str, success: bool, result: str, log: str, stats: dict | None = None,
+                 metrics: dict | None = None):
+        self.row = row
+        self.pdf_path = pdf_path
+        self.success = success
+        self.result = result
+        self.log = log
+        # make_redline statistics, i.e. the DPI which finally succeeded
+        self.stats = dict() if stats is None else stats
+        # wall time, CPU time and peak memory of every stage
+        self.metrics = dict() if metrics is None else metrics
+
+    def as_dict(self) -> dict:
+        return {'row': self.row, 'pdf_path': self.pdf_path, 'success': self.success, 'result': self.result,
+                'log': self.log, 'stats': self.stats, 'metrics': self.metrics}
+
+
+def get_default_workers() -> int:
+    return max(1, (os.cpu_count() or 1) - 1)
+
+
+def _create_maker(job: RedlineJob) -> AnnotationMakerBase:
+    if job.maker != AUTO_MAKER:
+        loop_drawing = MAKER_CLASSES[job.maker](job.ocr_config)
+    else:
+        # the pipeline creates the makers on a thread of its own, while its other stages work with PyMuPDF
+        # the first page tells the maker and the crop rectangle, every page is turned by its own guess
+        try:
+            with fitz_lock:
+                guesses = get_layout_classifier().classify_pages(job.pdf_path)
+        except Exception:
+            # make_redline reports the drawing which cannot be opened itself
+            guesses = list()
+        maker = guesses[0].maker if guesses and guesses[0].is_recognized() else DEFAULT_MAKER
+        loop_drawing = MAKER_CLASSES[maker](job.ocr_config)
+        loop_drawing.set_layout_guesses(guesses)
+    # the crop rectangle given for the job wins over the one of the layout
+    if job.crop_rectangle_wh is not None:
+        loop_drawing.set_crop_rectangle_wh(*job.crop_rectangle_wh)
+    loop_drawing.set_memory_lean(job.is_memory_lean)
+    loop_drawing.set_memory_budget(job.memory_budget_mb)
+    return loop_drawing
+
+
+# the text the check sheet gets for the drawing
+def _get_result_text(loop_drawing: AnnotationMakerBase, is_redlined_successfully: bool) -> str:
+    if not is_redlined_successfully:
+        return loop_drawing.get_error_description()
+    preflight = loop_drawing.get_preflight_result()
+    if preflight is not None and preflight.state == PREFLIGHT_DONE:
+        return 'Skipped, redlined already'
+    return 'Success'
+
+
+def redline_job(job: RedlineJob) -> RedlineResult:
+    loop_drawing = _create_maker(job)
+    try:
+        with profile_document(job.pdf_path):
+            is_redlined_successfully = loop_drawing.make_redline(job.pdf_path, dpi=job.dpi, **job.options)
+        result = _get_result_text(loop_drawing, is_redlined_successfully)
+    except Exception as e:
+        # one broken drawing must not take the whole batch down
+        is_redlined_successfully = False
+        result = f'Unexpected error: {str(e)}'
+    return RedlineResult(job.row, job.pdf_path, is_redlined_successfully, result, loop_drawing.get_log(),
+                         loop_drawing.get_run_stats(), loop_drawing.get_stage_metrics())
+
+
+# redlines the jobs of the same maker and settings with the text line recognition pooled across the documents
+def redline_jobs(jobs: list[RedlineJob]) -> list[RedlineResult]:
+    job = jobs[0]
+    if job.maker == AUTO_MAKER:
+        # the drawings of one group may need different makers, so the ocr is not pooled for them
+        return [redline_job(j) for j in jobs]
+    try:
+        redlines = MAKER_CLASSES[job.maker].make_redlines([j.pdf_path for j in jobs], batch_size=len(jobs),
+                                                          ocr_config=job.ocr_config,
+                                                          crop_rectangle_wh=job.crop_rectangle_wh,
+                                                          is_memory_lean=job.is_memory_lean,
+                                                          memory_budget_mb=job.memory_budget_mb, dpi=job.dpi,
+                                                          **job.options)
+    except Exception:
+        # the drawing which broke the batch is not known, so every job is redlined on its own
+        return [redline_job(j) for j in jobs]
+    return [RedlineResult(j.row, j.pdf_path, is_redlined_successfully,
+                          _get_result_text(loop_drawing, is_redlined_successfully), loop_drawing.get_log(),
+                          loop_drawing.get_run_stats(), loop_drawing.get_stage_metrics())
+            for j, (is_redlined_successfully, loop_drawing) in zip(jobs, redlines)]
+
+
+# redlines the jobs with the reading, rendering, ocr, annotating and writing of consecutive drawings overlapped
+def redline_jobs_pipelined(jobs: Iterable[RedlineJob], queue_size: int = 2) -> Iterator[RedlineResult]:
+    # the makers are created as the pipeline takes the jobs, so only the drawings in the pipeline hold memory
+    items = (PipelineItem(_create_maker(job), job.pdf_path, dict(job.options, dpi=job.dpi), job) for job in jobs)
+    for item in RedlinePipeline(queue_size).run(items):
+        loop_drawing = item.maker
+        if item.error is not None:
+            result = f'Unexpected error: {item.error}'
+        else:
+            result = _get_result_text(loop_drawing, item.success)
+        yield RedlineResult(item.tag.row, item.pdf_path, item.success, result, loop_drawing.get_log(),
+                            loop_drawing.get_run_stats(), loop_drawing.get_stage_metrics())
+    return
+
+
+def _redline_chunk_pipelined(jobs: list[RedlineJob], queue_size: int) -> list[RedlineResult]:
+    return list(redline_jobs_pipelined(jobs, queue_size))
+
+
+# groups the consecutive jobs which can share the batched ocr, no group is bigger than batch_size
+def _group_jobs(jobs: list[RedlineJob], batch_size: int) -> list[list[RedlineJob]]:
+    def get_settings(job: RedlineJob) -> tuple:
+        return (job.maker, job.dpi, job.crop_rectangle_wh, repr(job.ocr_config), repr(sorted(job.options.items())),
+                job.is_memory_lean, job.memory_budget_mb)
+
+    groups = list()
+    for _, same_jobs in itertools.groupby(jobs, key=get_settings):
+        same_jobs = list(same_jobs)
+        groups.extend(same_jobs[i:i + batch_size] for i in range(0, len(same_jobs), batch_size))
+    return groups
+
+
+# sets up the process to redline the jobs with the same settings, i.e. a worker of run_batch or the redline service
+def init_worker(ocr_config: dict | None, debug_mode: str, ocr_cache_path: str | None,
+                 ocr_cache_size_mb: float, save_strategy: str, atomic_save: bool, track_memory: bool,
+                 profile_pattern: str | None, layout_templates_path: str | None = None,
+                 preprocessing: tuple[str, ...] = (), governor: ResourceGovernor | None = None) -> None:
+    # the threads are limited before the model is loaded, paddle and its thread pools take them when they start
+    if governor is not None:
+        for warning in governor.apply():
+            print(f'Resource limits: {warning}')
+    # every worker loads its own engine once and keeps it warm for all the rows it gets
+    get_ocr_registry().warm_up([ocr_config])
+    if governor is not None:
+        for message in apply_memory_limit():
+            print(f'Resource limits: {message}')
+    # the debug images of every document go to its own folder, so the workers do not overwrite each other
+    configure_debug_artifacts(debug_mode)
+    # all the workers share one cache file, sqlite takes care of the concurrent writes
+    configure_ocr_cache(ocr_cache_path, ocr_cache_size_mb)
+    configure_pdf_saver(save_strategy, atomic_save)
+    set_memory_tracking(track_memory)
+    configure_profiling(profile_pattern)
+    # the templates are shared the same way as the cache, the layouts learned by one worker help the others
+    configure_layout_templates(layout_templates_path)
+    configure_image_preprocessing(preprocessing)
+    return
+
+
+def run_batch(jobs: Iterable[RedlineJob], workers: int | None = None, ocr_config: dict | None = None,
+              debug_mode: str = 'off', ocr_cache_path: str | None = None,
+              ocr_cache_size_mb: float = 256, ocr_batch_size: int = 1, save_strategy: str = 'full',
+              atomic_save: bool = False, track_memory: bool = False,
+              profile_pattern: str | None = None, pipeline_queue_size: int = 0,
+              layout_templates_path: str | None = None, preprocessing: tuple[str, ...] = (),
+              threads_per_worker: int | None = None, pin_workers: bool = False,
+              memory_limit_mb: float | None = None) -> Iterator[RedlineResult]:
+    # yields the results in the order of the jobs, even though the jobs are processed in parallel;
+    # with ocr_batch_size > 1 a worker gets up to that many jobs at once and pools their text line recognition;
+    # with pipeline_queue_size > 0 the stages of consecutive jobs overlap instead, the ocr is not batched then;
+    # threads_per_worker, pin_workers and memory_limit_mb limit every worker, see ResourceGovernor
+    jobs = list(jobs)
+    workers = workers or get_default_workers()
+    worker_settings = (ocr_config, debug_mode, ocr_cache_path, ocr_cache_size_mb, save_strategy, atomic_save,
+                       track_memory, profile_pattern, layout_templates_path, tuple(preprocessing))
+    is_governed = threads_per_worker is not None or pin_workers or memory_limit_mb is not None
+
+    def get_governor(pool_size: int) -> ResourceGovernor | None:
+        return ResourceGovernor(pool_size, threads_per_worker, pin_workers, memory_limit_mb) if is_governed else None
+
+    if pipeline_queue_size > 0 and workers == 1:
+        init_worker(*worker_settings, get_governor(1))
+        yield from redline_jobs_pipelined(jobs, pipeline_queue_size)
+        return
+    if pipeline_queue_size > 0:
+        tasks = [jobs[i:i + PIPELINE_CHUNK_SIZE] for i in range(0, len(jobs), PIPELINE_CHUNK_SIZE)]
+        run_task = functools.partial(_redline_chunk_pipelined, queue_size=pipeline_queue_size)
+    elif ocr_batch_size > 1:
+        tasks, run_task = _group_jobs(jobs, ocr_batch_size), redline_jobs
+    else:
+        tasks, run_task = jobs, redline_job
+    are_tasks_grouped = pipeline_queue_size > 0 or ocr_batch_size > 1
+    if workers == 1 or len(tasks) <= 1:
+        init_worker(*worker_settings, get_governor(1))
+        results = map(run_task, tasks)
+        yield from _flatten_results(results) if are_tasks_grouped else results
+        return
+
+    pool_size = min(workers, len(tasks))
+    with ProcessPoolExecutor(max_workers=pool_size, initializer=init_worker,
+                             initargs=(*worker_settings, get_governor(pool_size))) as executor:
+        # chunksize=1 keeps the load balanced, the drawings differ a lot in processing time
+        results = executor.map(run_task, tasks, chunksize=1)
+        yield from _flatten_results(results) if are_tasks_grouped else results
+    return
+
+
+def _flatten_results(results: Iterable[list[RedlineResult]]) -> Iterator[RedlineResult]:
+    for group_results in results:
+        yield from group_results
+    return
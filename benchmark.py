@@ -0,0 +1,367 @@
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from autoRLMU import AnnotationMakerNew, AnnotationMakerOld
+from image_preprocessing import PREPROCESSING_STEPS, configure_image_preprocessing
+from ocr_engine import DEFAULT_OCR_BACKEND, DEFAULT_OCR_CONFIG, OCR_BACKENDS, get_backend_config, get_ocr_registry
+from stage_metrics import STAGES, set_memory_tracking
+
+try:
+    import resource
+except ImportError:
+    # there is no resource module on Windows, psutil is used there if it is installed
+    resource = None
+
+
+# the old drawings in the frame of the new ones have their title block table here
+_OLD_IN_NEW_FRAME_CROP = (762, 107, 157, 646)
+# the drawings of example_pdfs with the maker each of them is redlined with and its crop rectangle (x0, y0, w, h),
+# None is the default crop of the maker; new7.pdf is the same file as new_type_old_in_reality.pdf, so it is left out
+CORPUS = {
+    'old': [('1.pdf', None), ('2.pdf', None), ('3.pdf', None), ('4.pdf', None), ('6.pdf', None), ('7.pdf', None),
+            ('8.pdf', None), ('4000-T-01-34-D-4000-01-E#XB.pdf', None), ('4000-T-01-37-D-0015-02-E#XB.pdf', None),
+            ('4000-T-61-30-D-4903-79-E#XB.pdf', None), ('new_type_old_in_reality.pdf', _OLD_IN_NEW_FRAME_CROP),
+            ('new8.pdf', _OLD_IN_NEW_FRAME_CROP), ('new9.pdf', _OLD_IN_NEW_FRAME_CROP)],
+    'new': [('new1.pdf', None), ('new_type.pdf', None), ('new_type_1.pdf', None), ('new_type_2.pdf', None)],
+}
+MAKER_CLASSES = {'old': AnnotationMakerOld, 'new': AnnotationMakerNew}
+DEFAULT_DPIS = (150, 200, 300)
+# the preprocessing steps every maker and DPI is run with, 'none' is the plain cropped image
+DEFAULT_PREPROCESSING = ('none',)
+# a stage is slower than the baseline only if both the share and the time are above these
+DEFAULT_THRESHOLD = 0.2
+MIN_REGRESSION_TIME = 0.005
+
+
+class RecordingOcrEngine:
+    # passes the calls to the real engine and remembers their results, so they can be replayed later
+    #
+    # the results are keyed by the document, the kind of the call, the image size and the number of such calls,
+    # so the key does not depend on the exact pixels and survives changes in the rendering or preprocessing
+    def __init__(self, engine):
+        self._engine = engine
+        self._document = ''
+        self._counters: dict[str, int] = dict()
+        self._recording: dict[str, object] = dict()
+        self._lock = threading.Lock()
+
+    def start_document(self, document: str) -> None:
+        self._document = document
+        self._counters = dict()
+        return
+
+    def _get_key(self, kind: str, images: list) -> str:
+        shapes = ';'.join('x'.join(str(size) for size in image.shape[:2]) for image in images)
+        with self._lock:
+            key = f'{self._document}|{kind}|{shapes}'
+            number = self._counters.get(key, 0)
+            self._counters[key] = number + 1
+        return f'{key}|{number}'
+
+    def _record(self, kind: str, images: list, result):
+        self._recording[self._get_key(kind, images)] = result
+        return result
+
+    def get_recording(self) -> dict[str, object]:
+        return dict(self._recording)
+
+    def get_config(self) -> dict:
+        return self._engine.get_config()
+
+    def get_model_version(self) -> str:
+        return self._engine.get_model_version()
+
+    def get_thread_inference_times(self) -> dict[str, float]:
+        return self._engine.get_thread_inference_times()
+
+    def get_stats(self) -> dict:
+        return self._engine.get_stats()
+
+    def ocr(self, image, cls: bool = True) -> list:
+        return self._record('ocr', [image], self._engine.ocr(image, cls))
+
+    def detect(self, image) -> list:
+        return self._record('detect', [image], self._engine.detect(image))
+
+    def classify(self, images: list) -> list:
+        return self._record('classify', images, self._engine.classify(images))
+
+    def recognize(self, images: list, cls: bool = True) -> list:
+        return self._record('recognize', images, self._engine.recognize(images, cls))
+
+
+class ReplayOcrEngine(RecordingOcrEngine):
+    # gives back the recorded results instead of running the model, so the stages around the ocr are measured
+    # the same way on any machine, even without paddle; a call which was not recorded gets an empty result
+    def __init__(self, recording: dict[str, object], config: dict):
+        super().__init__(None)
+        self._recording = recording
+        self._config = dict(config)
+        self._misses = 0
+
+    def _replay(self, kind: str, images: list, empty_result):
+        result = self._recording.get(self._get_key(kind, images))
+        if result is None:
+            self._misses += 1
+            return empty_result
+        return result
+
+    def get_misses(self) -> int:
+        return self._misses
+
+    def get_config(self) -> dict:
+        return dict(self._config)
+
+    def get_model_version(self) -> str:
+        return 'replay'
+
+    def get_thread_inference_times(self) -> dict[str, float]:
+        return dict()
+
+    def get_stats(self) -> dict:
+        return {'misses': self._misses}
+
+    def ocr(self, image, cls: bool = True) -> list:
+        return self._replay('ocr', [image], [[]])
+
+    def detect(self, image) -> list:
+        return self._replay('detect', [image], [])
+
+    def classify(self, images: list) -> list:
+        return self._replay('classify', images, [['0', 0.0]] * len(images))
+
+    def recognize(self, images: list, cls: bool = True) -> list:
+        return self._replay('recognize', images, [['', 0.0]] * len(images))
+
+
+def get_peak_rss_mb() -> float | None:
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS tells bytes, Linux - kilobytes
+        return peak_rss / 1024 / 1024 if sys.platform == 'darwin' else peak_rss / 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().peak_wset / 1024 / 1024
+
+
+# the name of a run of the maker with the DPI, the preprocessing steps and the ocr backend,
+# i.e. old@150/gray+trim or old@150:rapidocr, the default backend is not named
+def get_configuration_name(maker: str, dpi: int, preprocessing: tuple[str, ...] = (),
+                           backend: str = DEFAULT_OCR_BACKEND) -> str:
+    name = f'{maker}@{dpi}' + (f"/{'+'.join(preprocessing)}" if preprocessing else '')
+    return name if backend == DEFAULT_OCR_BACKEND else f'{name}:{backend}'
+
+
+# tells the drawings, makers and crops a result is of, the results over another corpus are not comparable
+def get_corpus_id(corpus: list[tuple[str, tuple | None]]) -> str:
+    return hashlib.sha1(json.dumps([[file_name, crop] for file_name, crop in corpus]).encode('utf-8')).hexdigest()[:12]
+
+
+# 'gray+binarize' -> ('gray', 'binarize'), 'none' -> ()
+def parse_preprocessing(configuration: str) -> tuple[str, ...]:
+    if configuration == 'none':
+        return ()
+    steps = tuple(configuration.split('+'))
+    for step in steps:
+        if step not in PREPROCESSING_STEPS:
+            raise ValueError(f"{step} is not a preprocessing step, they are {PREPROCESSING_STEPS}")
+    return steps
+
+
+# redlines the drawings with one maker, DPI, preprocessing and ocr backend, runs in a process of its own,
+# so the peak memory is of this run only
+def _run_configuration(maker: str, dpi: int, corpus: list[tuple[str, tuple | None]], replay: dict | None,
+                       record: bool, track_memory: bool, preprocessing: tuple[str, ...] = (),
+                       ocr_config: dict | None = None, name: str = '') -> dict:
+    if replay is not None:
+        engine = ReplayOcrEngine(replay, dict(DEFAULT_OCR_CONFIG, **(ocr_config or dict())))
+        get_ocr_registry().register(ocr_config, engine)
+    elif record:
+        engine = RecordingOcrEngine(get_ocr_registry().get_engine(ocr_config))
+        get_ocr_registry().register(ocr_config, engine)
+    else:
+        engine = None
+        # the model load is not a part of any drawing
+        get_ocr_registry().warm_up([ocr_config])
+    model_load_time = get_ocr_registry().get_engine(ocr_config).get_stats().get('load_time')
+    set_memory_tracking(track_memory)
+    configure_image_preprocessing(preprocessing)
+
+    documents = list()
+    for pdf_path, crop_rectangle_wh in corpus:
+        if engine is not None:
+            # the preprocessed images may keep the size of the plain ones, so their results are recorded apart
+            engine.start_document(f'{name}/{os.path.basename(pdf_path)}')
+        loop_drawing = MAKER_CLASSES[maker](ocr_config)
+        if crop_rectangle_wh is not None:
+            loop_drawing.set_crop_rectangle_wh(*crop_rectangle_wh)
+        started_at = time.perf_counter()
+        success = loop_drawing.make_redline(pdf_path, dpi=dpi)
+        run_stats = loop_drawing.get_run_stats()
+        documents.append({'pdf_path': os.path.basename(pdf_path), 'success': success,
+                          'wall_time': time.perf_counter() - started_at, 'stages': loop_drawing.get_stage_metrics(),
+                          'found_texts': run_stats.get('found_texts', 0),
+                          'min_confidence': run_stats.get('min_confidence')})
+    return {'documents': documents, 'peak_rss_mb': get_peak_rss_mb(), 'model_load_time': model_load_time,
+            'recording': engine.get_recording() if record else dict(),
+            'replay_misses': engine.get_misses() if replay is not None else 0}
+
+
+# sums the documents of a configuration up: the mean time of every stage per document, the throughput,
+# the share of the drawings redlined and the FCS/NODE texts found, which tell what the preprocessing costs the ocr
+def summarize(run: dict) -> dict:
+    documents = run['documents']
+    wall_time = sum(document['wall_time'] for document in documents)
+    confidences = [document['min_confidence'] for document in documents if document.get('min_confidence') is not None]
+    stages = dict()
+    for stage in STAGES:
+        stage_times = [document['stages'][stage]['wall_time'] for document in documents
+                       if stage in document['stages']]
+        if stage_times:
+            stages[stage] = sum(stage_times) / len(documents)
+    return {'documents': len(documents), 'succeeded': sum(document['success'] for document in documents),
+            'wall_time': wall_time, 'mean_wall_time': wall_time / max(len(documents), 1),
+            'throughput': len(documents) / wall_time if wall_time else 0.0, 'peak_rss_mb': run['peak_rss_mb'],
+            'hit_rate': sum(document['success'] for document in documents) / max(len(documents), 1),
+            'found_texts': sum(document.get('found_texts', 0) for document in documents),
+            'mean_min_confidence': sum(confidences) / len(confidences) if confidences else None,
+            'model_load_time': run.get('model_load_time'), 'stages': stages}
+
+
+# returns the regressions of the results against the baseline, an empty list if there are none
+def compare(results: dict, baseline: dict, threshold: float = DEFAULT_THRESHOLD) -> list[str]:
+    regressions = list()
+    for name, summary in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if base.get('corpus') != summary.get('corpus'):
+            regressions.append(f'{name}: the baseline is of another corpus or other crops, record it again')
+            continue
+        if summary['succeeded'] < base['succeeded']:
+            regressions.append(f"{name}: {summary['succeeded']} drawings redlined, {base['succeeded']} in the baseline")
+        if summary['found_texts'] < base.get('found_texts', 0):
+            regressions.append(f"{name}: {summary['found_texts']} FCS/NODE texts found, {base['found_texts']} "
+                               f"in the baseline")
+        timings = [('mean_wall_time', summary['mean_wall_time'], base['mean_wall_time'])]
+        timings += [(stage, time_spent, base['stages'].get(stage)) for stage, time_spent in summary['stages'].items()]
+        for timing, time_spent, base_time in timings:
+            if base_time is None:
+                continue
+            if time_spent > base_time * (1 + threshold) and time_spent - base_time > MIN_REGRESSION_TIME:
+                regressions.append(f'{name} {timing}: {time_spent:.3f} s, {base_time:.3f} s in the baseline '
+                                   f'(+{(time_spent / base_time - 1) * 100 if base_time else float("inf"):.0f}%)')
+    return regressions
+
+
+def format_results(results: dict) -> str:
+    lines = list()
+    for name, summary in results.items():
+        peak_rss = 'n/a' if summary['peak_rss_mb'] is None else f"{summary['peak_rss_mb']:.0f} MB"
+        lines.append(f"{name}: {summary['succeeded']}/{summary['documents']} redlined, "
+                     f"{summary['mean_wall_time']:.3f} s per drawing, {summary['throughput']:.2f} drawings/s, "
+                     f"peak RSS {peak_rss}")
+        min_confidence = summary.get('mean_min_confidence')
+        lines.append(f"    FCS/NODE hit rate {summary['hit_rate'] * 100:.0f}%, {summary['found_texts']} texts found, "
+                     f"mean lowest confidence {'n/a' if min_confidence is None else f'{min_confidence:.3f}'}")
+        if summary.get('model_load_time') is not None:
+            lines.append(f"    OCR model loaded in {summary['model_load_time']:.2f} s")
+        lines += [f'    {stage:<16}{time_spent:>10.4f} s' for stage, time_spent in summary['stages'].items()]
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the redlining of the example drawings')
+    parser.add_argument('--corpus', default='example_pdfs')
+    parser.add_argument('--dpis', default=','.join(str(dpi) for dpi in DEFAULT_DPIS),
+                        help='comma separated DPIs to run every maker with')
+    parser.add_argument('--makers', default='old,new')
+    parser.add_argument('--preprocessing', default=','.join(DEFAULT_PREPROCESSING),
+                        help=f"comma separated preprocessing to run every maker and DPI with, each one 'none' or "
+                             f"steps of {'+'.join(PREPROCESSING_STEPS)}, i.e. none,gray,gray+binarize+trim")
+    parser.add_argument('--backends', default=DEFAULT_OCR_BACKEND,
+                        help=f"comma separated OCR backends to run every configuration with, "
+                             f"of {','.join(OCR_BACKENDS)}")
+    parser.add_argument('--ocr-models', default=None, metavar='DIR',
+                        help='folder with the models of the backends other than paddle, i.e. the quantized ones')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=None, metavar='PATH',
+                        help='results of an earlier run to compare with, the exit code is 1 if anything got slower')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='the share a stage may get slower than the baseline by')
+    parser.add_argument('--record-ocr', default=None, metavar='PATH', help='save the OCR results to replay later')
+    parser.add_argument('--replay-ocr', default=None, metavar='PATH',
+                        help='take the OCR results from a recording instead of running the model')
+    parser.add_argument('--track-memory', action='store_true', help='measure the peak memory of every stage')
+    args = parser.parse_args()
+    try:
+        preprocessings = [parse_preprocessing(configuration) for configuration in args.preprocessing.split(',')]
+        # the default backend keeps its default models, so the others are compared with it
+        ocr_configs = dict()
+        for backend in args.backends.split(','):
+            models_dir = None if backend == DEFAULT_OCR_BACKEND else args.ocr_models
+            ocr_configs[backend] = get_backend_config(backend, models_dir)
+    except ValueError as e:
+        parser.error(str(e))
+
+    replay = None
+    if args.replay_ocr is not None:
+        with open(args.replay_ocr, encoding='utf-8') as file:
+            replay = json.load(file)
+
+    # the annotated drawings are written next to the source ones, so the corpus is copied not to touch the repo
+    work_dir = tempfile.mkdtemp(prefix='redline_benchmark_')
+    results, recording = dict(), dict()
+    try:
+        # every configuration starts in a fresh process, so they do not share the warm caches or the memory peak
+        context = multiprocessing.get_context('spawn')
+        for maker in args.makers.split(','):
+            corpus = list()
+            for file_name, crop_rectangle_wh in CORPUS[maker]:
+                pdf_path = os.path.join(work_dir, file_name)
+                shutil.copyfile(os.path.join(args.corpus, file_name), pdf_path)
+                corpus.append((pdf_path, crop_rectangle_wh))
+            for dpi in (int(dpi) for dpi in args.dpis.split(',')):
+                for preprocessing, (backend, ocr_config) in itertools.product(preprocessings, ocr_configs.items()):
+                    name = get_configuration_name(maker, dpi, preprocessing, backend)
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                        run = executor.submit(_run_configuration, maker, dpi, corpus, replay,
+                                              args.record_ocr is not None, args.track_memory, preprocessing,
+                                              ocr_config, name).result()
+                    results[name] = dict(summarize(run), corpus=get_corpus_id(CORPUS[maker]))
+                    recording.update(run['recording'])
+                    if run['replay_misses']:
+                        print(f"WARNING: {run['replay_misses']} OCR calls of {name} were not in the recording")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(format_results(results))
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+    if args.record_ocr is not None:
+        with open(args.record_ocr, 'w', encoding='utf-8') as file:
+            json.dump(recording, file, default=float)
+
+    if args.baseline is not None:
+        with open(args.baseline, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regressions against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+from PIL import Image
+import atexit
+import hashlib
+import os
+import queue
+import threading
+
+
+DEBUG_MODES = ('off', 'sampled', 'full')
+
+
+class DebugArtifactWriter:
+    # writes the debug images of the annotation makers to a folder per document
+    #
+    # 'off' - nothing is drawn or encoded at all, 'full' - every document is written,
+    # 'sampled' - only every sample_every-th document is written;
+    # the images are encoded and written on a background thread, so the redlining does not wait for PNG encoding
+    def __init__(self, mode: str = 'off', output_dir: str = 'images/debug', sample_every: int = 20,
+                 max_queued_images: int = 16):
+        assert mode in DEBUG_MODES, f"debug mode must be one of {DEBUG_MODES}"
+        assert sample_every >= 1, "sample_every must be positive"
+        self._mode = mode
+        self._output_dir = output_dir
+        self._sample_every = sample_every
+        self._documents_seen = 0
+        self._lock = threading.Lock()
+        # the queue is bounded, so a slow disk cannot make the pending images eat all the memory
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queued_images)
+        self._thread: threading.Thread | None = None
+        self._errors: list[str] = list()
+
+    def get_mode(self) -> str:
+        return self._mode
+
+    def is_enabled(self) -> bool:
+        return self._mode != 'off'
+
+    # returns the folder for the debug images of the document, or None if the document is not debugged
+    def start_document(self, pdf_path: str) -> str | None:
+        if self._mode == 'off':
+            return None
+        with self._lock:
+            self._documents_seen += 1
+            documents_seen = self._documents_seen
+        if self._mode == 'sampled' and (documents_seen - 1) % self._sample_every != 0:
+            return None
+        # the drawings of a batch often have the same file names in different folders, so the folder is told apart
+        # by a short hash of the absolute path
+        document_name = os.path.splitext(os.path.basename(pdf_path))[0]
+        path_hash = hashlib.sha1(os.path.abspath(pdf_path).encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self._output_dir, f'{document_name}_{path_hash}')
+
+    def _start_thread(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write_images, name='debug-artifact-writer',
+                                                daemon=True)
+                self._thread.start()
+        return
+
+    def _write_images(self) -> None:
+        while True:
+            file_path, image = self._queue.get()
+            try:
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                image.save(file_path, format='PNG')
+            except Exception as e:
+                self._errors.append(f'Cannot save {file_path}: {str(e)}')
+            finally:
+                self._queue.task_done()
+
+    # the image is copied, so the caller can go on drawing on it
+    def save(self, document_dir: str, file_name: str, image: Image) -> None:
+        self._start_thread()
+        self._queue.put((os.path.join(document_dir, file_name), image.copy()))
+        return
+
+    # waits until all the queued images are written
+    def flush(self) -> None:
+        if self._thread is not None:
+            self._queue.join()
+        return
+
+    def get_errors(self) -> list[str]:
+        return list(self._errors)
+
+
+_writer = DebugArtifactWriter()
+atexit.register(lambda: _writer.flush())
+
+
+def get_debug_writer() -> DebugArtifactWriter:
+    return _writer
+
+
+def configure_debug_artifacts(mode: str = 'off', output_dir: str = 'images/debug',
+                              sample_every: int = 20) -> DebugArtifactWriter:
+    # replaces the process-wide writer, the images queued by the previous one are written first
+    global _writer
+    _writer.flush()
+    _writer = DebugArtifactWriter(mode, output_dir, sample_every)
+    return _writer
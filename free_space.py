@@ -0,0 +1,80 @@
+import cv2
+import numpy as np
+
+
+class FreeSpaceLocator:
+    # finds the emptiest rectangle of the given size on a page image
+    #
+    # the page is binarized and downsampled into a grid of cells, each cell keeping its number of ink pixels;
+    # with a summed-area table of the grid the ink inside any rectangle costs four lookups,
+    # so all the possible positions are checked at once in O(number of cells)
+    def __init__(self, page_image: np.ndarray, cell_size: int = 4, ink_threshold: int = 200):
+        assert cell_size >= 1, "cell size must be positive"
+        self._cell_size = cell_size
+        gray = cv2.cvtColor(page_image, cv2.COLOR_RGB2GRAY) if page_image.ndim == 3 else page_image
+        # pixels darker than the threshold are ink, the rest is paper
+        ink = (gray < ink_threshold).astype(np.uint16)
+        rows, cols = ink.shape[0] // cell_size, ink.shape[1] // cell_size
+        ink = ink[:rows * cell_size, :cols * cell_size]
+        self._ink_cells = ink.reshape(rows, cell_size, cols, cell_size).sum(axis=(1, 3), dtype=np.int64)
+        self._excluded = np.zeros((rows, cols), dtype=bool)
+
+    def _get_cells(self, x0: float, y0: float, x1: float, y1: float) -> tuple[int, int, int, int]:
+        # converts a rectangle in page image pixels into the range of cells it touches
+        rows, cols = self._ink_cells.shape
+        col0 = min(max(int(x0 // self._cell_size), 0), cols)
+        row0 = min(max(int(y0 // self._cell_size), 0), rows)
+        col1 = min(max(int(-(-x1 // self._cell_size)), 0), cols)
+        row1 = min(max(int(-(-y1 // self._cell_size)), 0), rows)
+        return col0, row0, col1, row1
+
+    # rectangles in page image pixels the free space must not overlap, i.e. the annotations just added
+    def exclude(self, rects: list[tuple[float, float, float, float]]) -> None:
+        for rect in rects:
+            col0, row0, col1, row1 = self._get_cells(*rect)
+            self._excluded[row0:row1, col0:col1] = True
+        return
+
+    def _get_window_ink(self, width_cells: int, height_cells: int) -> np.ndarray:
+        # the amount of ink for every position of the window, excluded cells make the position unusable
+        ink_cells = np.where(self._excluded, np.iinfo(np.int32).max, self._ink_cells)
+        summed_area = cv2.integral(ink_cells.astype(np.float64))
+        return (summed_area[height_cells:, width_cells:] - summed_area[:-height_cells, width_cells:]
+                - summed_area[height_cells:, :-width_cells] + summed_area[:-height_cells, :-width_cells])
+
+    # returns the emptiest rectangle (x0, y0, x1, y1) in page image pixels, or None if it does not fit the page;
+    # a rectangle inside one of the preferred regions wins over the global one, if it is almost as empty
+    def find(self, width: float, height: float, margin: float = 0,
+             preferred_regions: list[tuple[float, float, float, float]] | None = None,
+             tolerance: float = 0.002) -> tuple[int, int, int, int] | None:
+        width_cells = max(int(-(-width // self._cell_size)), 1)
+        height_cells = max(int(-(-height // self._cell_size)), 1)
+        margin_cells = int(-(-margin // self._cell_size))
+        rows, cols = self._ink_cells.shape
+        if width_cells + 2 * margin_cells > cols or height_cells + 2 * margin_cells > rows:
+            return None
+
+        window_ink = self._get_window_ink(width_cells, height_cells)
+        # the positions too close to the page borders are not allowed
+        allowed = np.zeros(window_ink.shape, dtype=bool)
+        allowed[margin_cells:window_ink.shape[0] - margin_cells, margin_cells:window_ink.shape[1] - margin_cells] = True
+        window_ink = np.where(allowed, window_ink, np.inf)
+
+        best_row, best_col = np.unravel_index(np.argmin(window_ink), window_ink.shape)
+        if not np.isfinite(window_ink[best_row, best_col]):
+            return None
+        max_ink = window_ink[best_row, best_col] + tolerance * width_cells * height_cells * self._cell_size ** 2
+
+        for region in preferred_regions or []:
+            col0, row0, col1, row1 = self._get_cells(*region)
+            # the window must fit into the region completely
+            region_ink = window_ink[row0:row1 - height_cells + 1, col0:col1 - width_cells + 1]
+            if region_ink.size == 0:
+                continue
+            region_row, region_col = np.unravel_index(np.argmin(region_ink), region_ink.shape)
+            if region_ink[region_row, region_col] <= max_ink:
+                best_row, best_col = row0 + region_row, col0 + region_col
+                break
+
+        x0, y0 = int(best_col * self._cell_size), int(best_row * self._cell_size)
+        return x0, y0, x0 + int(width), y0 + int(height)
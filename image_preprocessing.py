@@ -0,0 +1,121 @@
+from typing import Iterable
+import cv2
+import numpy as np
+
+
+# the steps go in this order, whatever order they are given in
+PREPROCESSING_STEPS = ('gray', 'binarize', 'deskew', 'trim')
+
+
+class ImagePreprocessor:
+    # prepares the cropped image for the ocr, every step is done with whole-image numpy/OpenCV operations:
+    #
+    # gray     - the colors are dropped, the model still gets three equal channels,
+    # binarize - Otsu's threshold makes every pixel black or white, the scanning noise and the gray fills go away,
+    # deskew   - the image is turned by the angle of its long nearly horizontal lines, up to max_skew degrees,
+    # trim     - the blank margins are cut off, so the detection runs on fewer pixels;
+    #
+    # the texts found are in the pixels of the processed image, to_original takes them back to the cropped image
+    def __init__(self, steps: Iterable[str] = (), max_skew: float = 5.0, blank_level: int = 245,
+                 trim_margin: int = 8):
+        steps = set(steps)
+        assert steps <= set(PREPROCESSING_STEPS), f"preprocessing steps must be of {PREPROCESSING_STEPS}"
+        self._steps = tuple(step for step in PREPROCESSING_STEPS if step in steps)
+        self._max_skew = max_skew
+        # the pixels brighter than this are blank for the trim
+        self._blank_level = blank_level
+        self._trim_margin = trim_margin
+
+    def get_steps(self) -> tuple[str, ...]:
+        return self._steps
+
+    def __str__(self) -> str:
+        return '+'.join(self._steps) or 'none'
+
+    # returns the processed image and the 2x3 matrix taking its pixels back to the ones of the given image
+    def process(self, image: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        to_original = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+        if not self._steps:
+            return image, to_original
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        processed = gray if 'gray' in self._steps or 'binarize' in self._steps else image
+        if 'binarize' in self._steps:
+            processed = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+        if 'deskew' in self._steps:
+            angle = self._get_skew_angle(gray)
+            if angle != 0.0:
+                processed, gray, to_original = self._rotate(processed, gray, angle)
+        if 'trim' in self._steps:
+            processed, to_original = self._trim(processed, gray, to_original)
+        # the detection model takes three channels
+        if processed.ndim == 2:
+            processed = cv2.cvtColor(processed, cv2.COLOR_GRAY2RGB)
+        return np.ascontiguousarray(processed), to_original
+
+    # the median angle of the long nearly horizontal lines, i.e. the borders of the title block, in degrees
+    def _get_skew_angle(self, gray: np.ndarray) -> float:
+        edges = cv2.Canny(gray, 50, 150)
+        min_length = max(gray.shape[1] // 4, 20)
+        lines = cv2.HoughLinesP(edges, 1, np.pi / 360, threshold=min_length, minLineLength=min_length, maxLineGap=5)
+        if lines is None:
+            return 0.0
+        # the shape of the lines differs between the OpenCV versions
+        x1, y1, x2, y2 = lines.reshape(-1, 4).astype(np.float64).T
+        angles = np.degrees(np.arctan2(y2 - y1, x2 - x1))
+        # the lines going right to left get the same angle as the ones going left to right
+        angles = np.where(angles > 90, angles - 180, np.where(angles < -90, angles + 180, angles))
+        angles = angles[np.abs(angles) <= self._max_skew]
+        if angles.size == 0:
+            return 0.0
+        angle = float(np.median(angles))
+        # a turn of less than a tenth of a degree moves the texts by less than a pixel
+        return angle if abs(angle) >= 0.1 else 0.0
+
+    @staticmethod
+    def _rotate(processed: np.ndarray, gray: np.ndarray, angle: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        height, width = gray.shape[:2]
+        matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+        rotated = cv2.warpAffine(processed, matrix, (width, height), flags=cv2.INTER_LINEAR,
+                                 borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255))
+        rotated_gray = cv2.warpAffine(gray, matrix, (width, height), flags=cv2.INTER_LINEAR,
+                                      borderMode=cv2.BORDER_CONSTANT, borderValue=255)
+        return rotated, rotated_gray, cv2.invertAffineTransform(matrix)
+
+    def _trim(self, processed: np.ndarray, gray: np.ndarray,
+              to_original: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        ink = gray < self._blank_level
+        rows, columns = np.flatnonzero(ink.any(axis=1)), np.flatnonzero(ink.any(axis=0))
+        if rows.size == 0:
+            # a blank crop has nothing to ocr, it is left as it is
+            return processed, to_original
+        y0, y1 = max(rows[0] - self._trim_margin, 0), min(rows[-1] + 1 + self._trim_margin, gray.shape[0])
+        x0, x1 = max(columns[0] - self._trim_margin, 0), min(columns[-1] + 1 + self._trim_margin, gray.shape[1])
+        to_original = to_original.copy()
+        # the trimmed pixel (x, y) is (x + x0, y + y0) before the trim
+        to_original[:, 2] += to_original[:, :2] @ np.array([x0, y0], dtype=np.float64)
+        return processed[y0:y1, x0:x1], to_original
+
+
+# takes the boxes of the ocr result from the processed image back to the pixels of the cropped image
+def map_ocr_result(ocr_result_data: list, to_original: np.ndarray) -> list:
+    if np.array_equal(to_original, np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])):
+        return ocr_result_data
+    mapped = list()
+    for box, text_and_score in ocr_result_data:
+        points = np.hstack([np.array(box, dtype=np.float64), np.ones((len(box), 1))]) @ to_original.T
+        mapped.append([points.tolist(), text_and_score])
+    return mapped
+
+
+_preprocessor = ImagePreprocessor()
+
+
+def get_image_preprocessor() -> ImagePreprocessor:
+    return _preprocessor
+
+
+def configure_image_preprocessing(steps: Iterable[str] = ()) -> ImagePreprocessor:
+    # sets the process-wide preprocessing used by the annotation makers, no steps turn it off
+    global _preprocessor
+    _preprocessor = ImagePreprocessor(steps)
+    return _preprocessor
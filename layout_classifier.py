@@ -0,0 +1,279 @@
+from fitz import Document, Page, csGRAY
+import argparse
+import json
+import os
+import re
+import time
+import cv2
+import numpy as np
+
+
+# the references are built from a part of example_pdfs only, the others are held out to check the classifier with:
+# 2, 8, 4000-T-01-37-D-0015-02-E#XB, the 4000-T-01-30-D-4900 ones with test and bad stamp example (the same
+# drawing), new8, new7 with new_type_old_in_reality (the same file) and new_type_1; every one of them is told right
+# in all four orientations, see --check, and by its thumbnail alone too, when the text layer is not read
+DEFAULT_REFERENCES_PATH = 'layout_references.json'
+# the page is compared by a thumbnail of this DPI, shrunk to a grid of the ink density,
+# the drawings are landscape when upright, so is the grid
+_THUMBNAIL_DPI = 10
+_GRID_WIDTH = 32
+_GRID_HEIGHT = 24
+# a page less similar to every reference than this is not recognized; the held out drawings are 0.52 alike
+# to the right reference at least, pages which are not drawings of these layouts, i.e. the stamp, a page of text
+# or boxes drawn at random, are 0.24 alike at most, the threshold is about halfway between;
+# the drawings of the other maker or crop go up to 0.50, so they are told apart by the most similar reference,
+# not by the threshold
+DEFAULT_MIN_SIMILARITY = 0.35
+# the text layer tells the maker: the old drawings have the cabinet table with the MOD TYPE, SLOT and CHANNEL
+# cells, the new ones have the FCS texts with the node and the slot, i.e. FCS0721-03-07, as AnnotationMakerNew
+# reads them; the system cable numbers of the old drawings look the same, so the table goes first
+_OLD_TABLE_WORDS = ('MOD', 'SLOT', 'CHANNEL')
+_NEW_FCS_REGEX = re.compile(r'^(FCS|FSC)\d\d\d\d-?\d\d-?\d\d')
+
+
+def _get_page_thumbnail(page: Page) -> np.ndarray:
+    pix = page.get_pixmap(dpi=_THUMBNAIL_DPI, colorspace=csGRAY)
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width)
+
+
+# the ink density of the thumbnail turned by turns * 90 degrees clockwise, as set_rotation turns the page
+def _get_ink_grid(thumbnail: np.ndarray, turns: int) -> np.ndarray:
+    upright = np.rot90(thumbnail, k=-turns)
+    return cv2.resize(255 - upright, (_GRID_WIDTH, _GRID_HEIGHT), interpolation=cv2.INTER_AREA)
+
+
+# the grids are compared by the cosine similarity of their deviations from the mean ink,
+# so a lighter or a darker scan of the same layout still matches
+def _get_features(ink_grid: np.ndarray) -> np.ndarray:
+    features = ink_grid.astype(np.float32).ravel()
+    features -= features.mean()
+    return features / (np.linalg.norm(features) + 1e-9)
+
+
+class LayoutReference:
+    # a drawing whose maker and crop rectangle are known, the pages like it are redlined the same way
+    def __init__(self, name: str, maker: str, crop_rectangle_wh: tuple[float, float, float, float] | None,
+                 ink_grid: np.ndarray):
+        self.name = name
+        # 'old' or 'new'
+        self.maker = maker
+        # None means the default crop rectangle of the maker
+        self.crop_rectangle_wh = crop_rectangle_wh
+        # the ink density of the upright page
+        self.ink_grid = ink_grid
+        self.features = _get_features(ink_grid)
+
+    def as_dict(self) -> dict:
+        return {'name': self.name, 'maker': self.maker, 'crop_rectangle_wh': self.crop_rectangle_wh,
+                'ink_grid': self.ink_grid.tobytes().hex()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'LayoutReference':
+        ink_grid = np.frombuffer(bytes.fromhex(data['ink_grid']), dtype=np.uint8).reshape(_GRID_HEIGHT, _GRID_WIDTH)
+        crop_rectangle_wh = data.get('crop_rectangle_wh')
+        return cls(data['name'], data['maker'], None if crop_rectangle_wh is None else tuple(crop_rectangle_wh),
+                   ink_grid)
+
+
+class LayoutGuess:
+    def __init__(self, maker: str | None, crop_rectangle_wh: tuple[float, float, float, float] | None,
+                 rotation_turns: int, similarity: float, reference_name: str | None, is_text_layer_maker: bool,
+                 check_time: float):
+        # None if the layout is not recognized, the caller's maker is used then
+        self.maker = maker
+        self.crop_rectangle_wh = crop_rectangle_wh
+        # the page should be turned by this many times 90 degrees clockwise, as set_rotation does
+        self.rotation_turns = rotation_turns
+        self.similarity = similarity
+        self.reference_name = reference_name
+        # the maker is told by the text layer, not only by the thumbnail
+        self.is_text_layer_maker = is_text_layer_maker
+        self.check_time = check_time
+
+    def is_recognized(self) -> bool:
+        return self.maker is not None
+
+    def as_dict(self) -> dict:
+        return {'maker': self.maker, 'crop_rectangle_wh': self.crop_rectangle_wh,
+                'rotation_turns': self.rotation_turns, 'similarity': self.similarity,
+                'reference': self.reference_name, 'text_layer': self.is_text_layer_maker,
+                'check_time': self.check_time}
+
+    def __str__(self) -> str:
+        if not self.is_recognized():
+            return f'the layout is not recognized, the most similar drawing is {self.similarity:.2f} alike'
+        if self.reference_name is None:
+            return f'the {self.maker} maker is told by the text layer, the layout is not recognized'
+        told_by = 'the text layer and ' if self.is_text_layer_maker else ''
+        return (f'the {self.maker} maker is told by {told_by}the layout of {self.reference_name} '
+                f'({self.similarity:.2f} alike), turned by {self.rotation_turns * 90} degrees')
+
+
+class LayoutClassifier:
+    # tells which maker and crop rectangle a drawing needs and how it is likely turned before it is rendered
+    # for the ocr: a thumbnail of the first page with dpi 10 is compared with the reference drawings
+    # in the orientations a landscape drawing may be in, and the text layer, if there is one, tells the maker;
+    # it takes tens of milliseconds, against the whole ocr passes a wrong maker or rotation costs
+    def __init__(self, references: list[LayoutReference] | None = None,
+                 min_similarity: float = DEFAULT_MIN_SIMILARITY):
+        self._references = list() if references is None else references
+        self._min_similarity = min_similarity
+
+    @classmethod
+    def load(cls, references_path: str, min_similarity: float = DEFAULT_MIN_SIMILARITY) -> 'LayoutClassifier':
+        with open(references_path, encoding='utf-8') as file:
+            data = json.load(file)
+        return cls([LayoutReference.from_dict(reference) for reference in data['references']], min_similarity)
+
+    def save(self, references_path: str) -> None:
+        with open(references_path, 'w', encoding='utf-8') as file:
+            json.dump({'references': [reference.as_dict() for reference in self._references]}, file, indent=1)
+        return
+
+    def get_references(self) -> list[LayoutReference]:
+        return list(self._references)
+
+    # rotation_turns turn the page upright, the same as the ones classify returns for it
+    def add_reference(self, name: str, page: Page, maker: str,
+                      crop_rectangle_wh: tuple[float, float, float, float] | None = None,
+                      rotation_turns: int = 0) -> LayoutReference:
+        reference = LayoutReference(name, maker, crop_rectangle_wh,
+                                    _get_ink_grid(_get_page_thumbnail(page), rotation_turns))
+        self._references = [r for r in self._references if r.name != name] + [reference]
+        return reference
+
+    @staticmethod
+    def _get_text_layer_maker(page: Page) -> str | None:
+        words = {word[4] for word in page.get_text('words')}
+        if all(table_word in words for table_word in _OLD_TABLE_WORDS):
+            return 'old'
+        if any(_NEW_FCS_REGEX.match(word) for word in words):
+            return 'new'
+        return None
+
+    def classify_page(self, page: Page) -> LayoutGuess:
+        started_at = time.perf_counter()
+        thumbnail = _get_page_thumbnail(page)
+        # a portrait page is turned either way, a landscape one is upright or upside down
+        candidate_turns = (1, 3) if thumbnail.shape[0] > thumbnail.shape[1] else (0, 2)
+        text_layer_maker = self._get_text_layer_maker(page)
+        matches = list()
+        for turns in candidate_turns:
+            features = _get_features(_get_ink_grid(thumbnail, turns))
+            for reference in self._references:
+                if text_layer_maker is None or reference.maker == text_layer_maker:
+                    matches.append((float(features @ reference.features), turns, reference))
+        if not matches:
+            return LayoutGuess(text_layer_maker, None, 0, 0.0, None, text_layer_maker is not None,
+                               time.perf_counter() - started_at)
+        similarity, turns, reference = max(matches, key=lambda match: match[0])
+        if similarity < self._min_similarity:
+            # the text layer still tells the maker, but not the crop rectangle or the rotation
+            return LayoutGuess(text_layer_maker, None, 0, similarity, None, text_layer_maker is not None,
+                               time.perf_counter() - started_at)
+        return LayoutGuess(reference.maker, reference.crop_rectangle_wh, turns, similarity, reference.name,
+                           text_layer_maker is not None, time.perf_counter() - started_at)
+
+    def classify(self, pdf_path: str) -> LayoutGuess:
+        doc = Document(pdf_path)
+        try:
+            return self.classify_page(doc.load_page(0))
+        finally:
+            doc.close()
+
+    # the guess of every page, the pages of one document may be turned differently
+    def classify_pages(self, pdf_path: str) -> list[LayoutGuess]:
+        doc = Document(pdf_path)
+        try:
+            return [self.classify_page(page) for page in doc]
+        finally:
+            doc.close()
+
+
+_classifier: LayoutClassifier | None = None
+
+
+def get_layout_classifier() -> LayoutClassifier:
+    # the references shipped with the repo are loaded the first time they are needed
+    global _classifier
+    if _classifier is None:
+        _classifier = LayoutClassifier.load(DEFAULT_REFERENCES_PATH)
+    return _classifier
+
+
+def configure_layout_classifier(references_path: str = DEFAULT_REFERENCES_PATH,
+                                min_similarity: float = DEFAULT_MIN_SIMILARITY) -> LayoutClassifier:
+    # sets the process-wide classifier the 'auto' jobs pick their makers with
+    global _classifier
+    _classifier = LayoutClassifier.load(references_path, min_similarity)
+    return _classifier
+
+
+# classifies the drawings known to be redlined with the maker and the crop rectangle, when turned by rotation_turns,
+# turning them to every orientation; prints the guesses and returns how many are right of how many
+def _check_drawings(classifier: LayoutClassifier, pdf_paths: list[str], maker: str,
+                    crop_rectangle_wh: tuple[float, float, float, float] | None,
+                    rotation_turns: int) -> tuple[int, int]:
+    right, total = 0, 0
+    for pdf_path in pdf_paths:
+        doc = Document(pdf_path)
+        page = doc.load_page(0)
+        rotation = page.rotation
+        for extra_turns in range(4):
+            # the document is not saved, so turning the page does not change the file
+            page.set_rotation((rotation + extra_turns * 90) % 360)
+            guess = classifier.classify_page(page)
+            is_right = (guess.maker == maker and guess.crop_rectangle_wh == crop_rectangle_wh and
+                        guess.rotation_turns == (rotation_turns - extra_turns) % 4)
+            right += is_right
+            total += 1
+            print(f'{pdf_path} turned by {extra_turns * 90} degrees: {"right" if is_right else "WRONG"}, {guess}')
+        doc.close()
+    return right, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tells the maker, crop rectangle and rotation of the drawings '
+                                                 'by their layout, or adds reference drawings to tell them by')
+    parser.add_argument('pdf_paths', nargs='+')
+    parser.add_argument('--references', default=DEFAULT_REFERENCES_PATH)
+    parser.add_argument('--add', choices=('old', 'new'), default=None,
+                        help='add the drawings as references redlined with this maker instead of classifying them')
+    parser.add_argument('--check', choices=('old', 'new'), default=None,
+                        help='check the classifier on drawings not in the references, redlined with this maker')
+    parser.add_argument('--crop', default=None, metavar='X0,Y0,W,H',
+                        help='the crop rectangle the added or checked drawings need, the default one of the maker '
+                             'if not given')
+    parser.add_argument('--turns', type=int, default=0,
+                        help='how many times the added or checked drawings must be turned by 90 degrees clockwise '
+                             'to be upright')
+    args = parser.parse_args()
+    crop_rectangle_wh = None if args.crop is None else tuple(float(value) for value in args.crop.split(','))
+
+    if args.check is not None:
+        right, total = _check_drawings(LayoutClassifier.load(args.references), args.pdf_paths, args.check,
+                                       crop_rectangle_wh, args.turns)
+        print(f'{right} of {total} guesses are right')
+        return
+
+    if args.add is None:
+        classifier = LayoutClassifier.load(args.references)
+        for pdf_path in args.pdf_paths:
+            print(f'{pdf_path}: {classifier.classify(pdf_path)}')
+        return
+
+    try:
+        classifier = LayoutClassifier.load(args.references)
+    except FileNotFoundError:
+        classifier = LayoutClassifier()
+    for pdf_path in args.pdf_paths:
+        doc = Document(pdf_path)
+        classifier.add_reference(os.path.basename(pdf_path), doc.load_page(0), args.add,
+                                 crop_rectangle_wh, args.turns)
+        doc.close()
+    classifier.save(args.references)
+    print(f'{len(classifier.get_references())} references are in {args.references}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import json
+import sqlite3
+import threading
+import time
+import cv2
+import numpy as np
+
+
+# the size of the grayscale thumbnail the difference hash is taken of, 64 bits
+_HASH_WIDTH = 9
+_HASH_HEIGHT = 8
+
+
+def get_image_hash(image: np.ndarray) -> int:
+    # difference hash: every bit tells if a pixel of the thumbnail is brighter than its right neighbour,
+    # so it follows the lines and blocks of the title block and barely changes with the texts in it
+    thumbnail = cv2.resize(image, (_HASH_WIDTH, _HASH_HEIGHT), interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).flatten()
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+
+def _get_hash_distance(hash1: int, hash2: int) -> int:
+    return bin(hash1 ^ hash2).count('1')
+
+
+# unions the overlapping rectangles, so the regions do not get ocr-ed twice
+def merge_regions(regions: list[tuple[float, float, float, float]]) -> list[tuple[float, float, float, float]]:
+    merged = [tuple(region) for region in regions]
+    is_merging = True
+    while is_merging:
+        is_merging = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                a, b = merged[i], merged[j]
+                if a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]:
+                    merged[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del merged[j]
+                    is_merging = True
+                    break
+            if is_merging:
+                break
+    return sorted(merged, key=lambda region: (region[1], region[0]))
+
+
+class LayoutTemplate:
+    # where the FCS and NODE texts were found on the drawings of one title block
+    def __init__(self, template_id: int, image_hash: int, regions: list[tuple[float, float, float, float]],
+                 text_count: int):
+        self.template_id = template_id
+        self.image_hash = image_hash
+        # rectangles (x0, y0, x1, y1) of the rotated page with dpi 72, padded around the found texts
+        self.regions = regions
+        # the number of the FCS and NODE texts found, the regions must give back as many
+        self.text_count = text_count
+
+
+class LayoutTemplateStore:
+    # learns the layouts of the drawings: after a successful run the regions the FCS and NODE texts were found in
+    # are recorded for the layout fingerprint of the page, the later drawings with the same fingerprint
+    # ocr only these regions instead of the whole crop rectangle
+    #
+    # the fingerprint is the maker, the page size and rotation, the crop rectangle and the difference hash
+    # of a thumbnail of the crop rectangle; the hashes closer than max_hash_distance bits are the same layout
+    def __init__(self, db_path: str = 'layout_templates.sqlite', max_hash_distance: int = 10):
+        self._db_path = db_path
+        self._max_hash_distance = max_hash_distance
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        # several worker processes may share the file, sqlite serializes the writers
+        self._connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS layout_templates (id INTEGER PRIMARY KEY, '
+                                 'layout_key TEXT NOT NULL, image_hash TEXT NOT NULL, regions TEXT NOT NULL, '
+                                 'text_count INTEGER NOT NULL, hits INTEGER NOT NULL DEFAULT 0, '
+                                 'misses INTEGER NOT NULL DEFAULT 0, updated REAL NOT NULL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS layout_templates_key ON layout_templates (layout_key)')
+        self._connection.commit()
+
+    @staticmethod
+    def get_layout_key(maker_name: str, page_size: tuple[float, float], rotation: int,
+                       crop_rect: tuple[float, float, float, float]) -> str:
+        return json.dumps([maker_name, [round(size) for size in page_size], rotation,
+                           [round(coordinate, 2) for coordinate in crop_rect]])
+
+    def _find(self, layout_key: str, image_hash: int) -> LayoutTemplate | None:
+        closest, closest_distance = None, self._max_hash_distance + 1
+        for template_id, stored_hash, regions, text_count in self._connection.execute(
+                'SELECT id, image_hash, regions, text_count FROM layout_templates WHERE layout_key = ?',
+                (layout_key,)).fetchall():
+            distance = _get_hash_distance(image_hash, int(stored_hash, 16))
+            if distance < closest_distance:
+                closest = LayoutTemplate(template_id, int(stored_hash, 16), [tuple(r) for r in json.loads(regions)],
+                                         text_count)
+                closest_distance = distance
+        return closest
+
+    def find(self, layout_key: str, image_hash: int) -> LayoutTemplate | None:
+        with self._lock:
+            return self._find(layout_key, image_hash)
+
+    # adds the regions to the template of the layout, so the template covers all the drawings of the layout seen
+    def record(self, layout_key: str, image_hash: int, regions: list[tuple[float, float, float, float]],
+               text_count: int) -> None:
+        with self._lock:
+            template = self._find(layout_key, image_hash)
+            if template is None:
+                self._connection.execute('INSERT INTO layout_templates (layout_key, image_hash, regions, text_count, '
+                                         'updated) VALUES (?, ?, ?, ?, ?)',
+                                         (layout_key, f'{image_hash:016x}', json.dumps(merge_regions(regions)),
+                                          text_count, time.time()))
+            else:
+                self._connection.execute('UPDATE layout_templates SET regions = ?, text_count = ?, updated = ? '
+                                         'WHERE id = ?',
+                                         (json.dumps(merge_regions(template.regions + regions)),
+                                          max(template.text_count, text_count), time.time(), template.template_id))
+            self._connection.commit()
+        return
+
+    # counts whether the regions of the template gave back all the texts, a miss makes the whole crop ocr-ed
+    def add_result(self, template: LayoutTemplate, is_hit: bool) -> None:
+        with self._lock:
+            if is_hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+            column = 'hits' if is_hit else 'misses'
+            self._connection.execute(f'UPDATE layout_templates SET {column} = {column} + 1 WHERE id = ?',
+                                     (template.template_id,))
+            self._connection.commit()
+        return
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            templates = self._connection.execute('SELECT COUNT(*) FROM layout_templates').fetchone()[0]
+        return {'hits': self._hits, 'misses': self._misses, 'templates': templates}
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+        return
+
+
+_store: LayoutTemplateStore | None = None
+
+
+def get_layout_templates() -> LayoutTemplateStore | None:
+    return _store
+
+
+def configure_layout_templates(db_path: str | None) -> LayoutTemplateStore | None:
+    # sets the process-wide template store used by the annotation makers, None turns the templates off
+    global _store
+    if _store is not None:
+        _store.close()
+    _store = None if db_path is None else LayoutTemplateStore(db_path)
+    return _store
@@ -1,14 +1,20 @@
+import argparse
 import openpyxl as xl
 import os
-from autoRLMU import AnnotationMakerOld, AnnotationMakerNew
+from batch_runner import MAKER_CHOICES, RedlineJob, get_default_workers, run_batch
+from debug_artifacts import DEBUG_MODES
+from image_preprocessing import PREPROCESSING_STEPS
+from layout_templates import get_layout_templates
+from ocr_engine import DEFAULT_OCR_BACKEND, OCR_BACKENDS, get_backend_config, get_ocr_registry
+from pdf_saver import SAVE_STRATEGIES
+from redline_service import run_on_service
+from results_journal import ResultsJournal
+from stage_metrics import MetricsReport
 
 
-os.system("cls")
-wb = xl.load_workbook('loop_diagrams.xlsx')
-
-try:
-    sheet = wb['check_sheet']
-
+def collect_jobs(sheet, maker: str, dpi: int, options: dict | None = None, is_memory_lean: bool = False,
+                 memory_budget_mb: float | None = None, ocr_config: dict | None = None) -> list[RedlineJob]:
+    jobs = list()
     # for each row in 'check_sheet' sheet
     for row in range(2, sheet.max_row + 1):
         # if an empty row - stop
@@ -25,29 +31,196 @@ try:
         # loop = {"Doc Number": sheet.cell(row, 1).value, "Link": sheet.cell(row, 2).hyperlink.target}
         loop = {"Doc Number": sheet.cell(row, 1).value, "Link": sheet.cell(row, 2).value}
 
-        # creating object
-        pdf_path_annotated: str = f'pdfs/{loop["Doc Number"]}.pdf'
-        loop_drawing = AnnotationMakerOld()
-
-        # trying to make a redline, comment the cropping if no need
+        # trying to make a redline, pass crop_rectangle_wh if the standard crop does not fit
         # standard crop new for: x0=730 y0=12 w=446 h=698
-        # crop for small new:
-        # loop_drawing.set_crop_rectangle_wh(950, 30, 215, 650)
+        # crop for small new: (950, 30, 215, 650)
         # standard crop for old: x0=989 y0=62 w=163 h=562
-        # loop_drawing.set_crop_rectangle_wh(898, 30, 215, 650)
-        is_redlined_successfully = loop_drawing.make_redline(loop['Link'], dpi=300)
-        if is_redlined_successfully:
-            loop["Result"] = 'Success'
+        # crop for small old: (898, 30, 215, 650)
+        # old drawings in the frame of the new ones: (762, 107, 157, 646), --maker auto picks the crop by the layout
+        jobs.append(RedlineJob(row, loop['Link'], maker=maker, dpi=dpi, ocr_config=ocr_config, options=options,
+                               is_memory_lean=is_memory_lean, memory_budget_mb=memory_budget_mb))
+    return jobs
+
+
+# fills the rows redlined by a run which did not get to save the workbook, returns the number of rows filled
+def apply_journal(sheet, records: dict[int, dict]) -> int:
+    applied = 0
+    for row, record in records.items():
+        # the sheet may have been edited since, the result of another drawing must not land in the row
+        if sheet.cell(row, 2).value != record['pdf_path']:
+            continue
+        sheet.cell(row, 3).value = record['result']
+        sheet.cell(row, 4).value = record['log']
+        applied += 1
+    return applied
+
+
+def save_workbook(wb, workbook_path: str) -> bool:
+    try:
+        wb.save(workbook_path)
+    except Exception as e:
+        print(f'Cannot save the excel file: {str(e)}')
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Redlines the loop diagrams listed in the check sheet')
+    parser.add_argument('--workbook', default='loop_diagrams.xlsx')
+    parser.add_argument('--maker', choices=MAKER_CHOICES, default='old',
+                        help='auto picks the maker, the crop rectangle and the rotation of every drawing by its layout')
+    parser.add_argument('--dpi', type=int, default=300)
+    parser.add_argument('--adaptive-dpi', default=None, metavar='DPIS',
+                        help='comma separated DPIs, i.e. 150,200,300: a higher DPI is used only if the lower one fails')
+    parser.add_argument('--min-confidence', type=float, default=0.8,
+                        help='the lowest OCR score of the FCS/NODE texts accepted in the adaptive DPI mode')
+    parser.add_argument('--ocr-mode', choices=('full', 'targeted'), default='full',
+                        help='targeted recognizes only the detected text boxes shaped like the FCS/NODE texts')
+    parser.add_argument('--stamp-dpi', type=int, default=None,
+                        help='render the whole page with this lower DPI to place the stamp, only the crop gets --dpi')
+    parser.add_argument('--debug', choices=DEBUG_MODES, default='off',
+                        help='write the debug images of every document (full) or of some of them (sampled)')
+    parser.add_argument('--ocr-cache', default=None, metavar='PATH',
+                        help='sqlite file to keep the OCR results in, re-runs over unchanged drawings skip the OCR')
+    parser.add_argument('--ocr-cache-size-mb', type=float, default=256)
+    parser.add_argument('--workers', type=int, default=1,
+                        help=f'number of worker processes, 0 means one per core ({get_default_workers()} here)')
+    parser.add_argument('--ocr-batch', type=int, default=1, metavar='N',
+                        help='redline up to N drawings together, recognizing their text lines in one OCR call')
+    parser.add_argument('--save-strategy', choices=SAVE_STRATEGIES, default='full',
+                        help='incremental appends only the annotations to a copy of the drawing, '
+                             'compact rewrites it with the unused objects removed and the streams compressed')
+    parser.add_argument('--atomic-save', action='store_true',
+                        help='write into a temporary file renamed at the end, a failed save leaves no broken pdf')
+    parser.add_argument('--journal', default=None, metavar='PATH',
+                        help='JSON lines file every result is appended to, a crashed run is resumed from it '
+                             '(the workbook name with .journal.jsonl by default)')
+    parser.add_argument('--checkpoint-every', type=int, default=25, metavar='N',
+                        help='save the workbook after every N drawings, and once at the end')
+    parser.add_argument('--metrics-json', default=None, metavar='PATH',
+                        help='JSON lines file with the time of every stage of every drawing')
+    parser.add_argument('--metrics-csv', default=None, metavar='PATH', help='the same as a CSV file')
+    parser.add_argument('--track-memory', action='store_true',
+                        help='measure the peak memory of every stage with tracemalloc, slows the run down')
+    parser.add_argument('--profile', default=None, metavar='PATTERN',
+                        help='run the drawings whose file names match the pattern, i.e. "4000-T-*", under cProfile '
+                             'and write the profiles into the profiles folder')
+    parser.add_argument('--lean-memory', action='store_true',
+                        help='render the page images gray and release them as soon as they are used')
+    parser.add_argument('--memory-budget-mb', type=float, default=None, metavar='MB',
+                        help='the most the page images of one drawing may take, the stamp image gets a lower DPI '
+                             'to fit and a drawing whose crop does not fit fails')
+    parser.add_argument('--pipeline', type=int, default=0, metavar='N',
+                        help='overlap the reading, rendering, OCR, annotating and writing of consecutive drawings, '
+                             'with up to N drawings waiting between the stages; --ocr-batch is not used then')
+    parser.add_argument('--layout-templates', default=None, metavar='PATH',
+                        help='sqlite file to learn where the FCS/NODE texts are on every title block layout in, '
+                             'the drawings of a known layout OCR only those regions')
+    parser.add_argument('--preprocessing', default='', metavar='STEPS',
+                        help=f"comma separated steps to prepare the cropped image with before the OCR, "
+                             f"of {','.join(PREPROCESSING_STEPS)}; gray and trim shrink the OCR input, check the hit "
+                             f"rate of the others with benchmark.py on your drawings first")
+    parser.add_argument('--skip-redlined', action='store_true',
+                        help='check every drawing for the redline annotations, the stamp, FCS14 in the text layer '
+                             'and a newer _annotated.pdf first and skip the ones redlined already without rendering')
+    parser.add_argument('--ocr-backend', choices=OCR_BACKENDS, default=DEFAULT_OCR_BACKEND,
+                        help='paddle_mkldnn runs PaddleOCR on the MKL-DNN kernels, paddle_onnx on ONNX Runtime, '
+                             'rapidocr runs the same models with rapidocr_onnxruntime; compare them with benchmark.py; '
+                             'the ONNX Runtime ones need the optional packages of requirements.txt')
+    parser.add_argument('--ocr-models', default=None, metavar='DIR',
+                        help='folder with the det, cls and rec models of the backend, i.e. the quantized ones, '
+                             'det.onnx, cls.onnx and rec.onnx for the ONNX Runtime backends')
+    parser.add_argument('--threads-per-worker', type=int, default=None, metavar='N',
+                        help='limit the OCR inference, the OpenMP/MKL pools and OpenCV of every worker to N threads, '
+                             '0 divides the cores by --workers; by default every library takes as many as it likes')
+    parser.add_argument('--pin-workers', action='store_true',
+                        help='pin every worker to cores of its own, as many as its threads')
+    parser.add_argument('--memory-limit-mb', type=float, default=None, metavar='MB',
+                        help='the address space a worker may take on top of the loaded OCR model, a drawing going '
+                             'over it fails and the worker goes on (not on Windows)')
+    parser.add_argument('--service', default=None, metavar='URL',
+                        help='send the drawings to a running redline_service.py, i.e. http://127.0.0.1:8765, '
+                             'which has the OCR model loaded already; the links must be valid for the service')
+    args = parser.parse_args()
+    preprocessing = tuple(step for step in args.preprocessing.split(',') if step)
+    if not set(preprocessing) <= set(PREPROCESSING_STEPS):
+        parser.error(f"--preprocessing steps must be of {','.join(PREPROCESSING_STEPS)}")
+    if args.threads_per_worker is not None and args.threads_per_worker < 0:
+        parser.error('--threads-per-worker must not be negative')
+    try:
+        ocr_config = get_backend_config(args.ocr_backend, args.ocr_models)
+    except ValueError as e:
+        parser.error(str(e))
+
+    os.system("cls")
+    wb = xl.load_workbook(args.workbook)
+    journal = ResultsJournal(args.journal or os.path.splitext(args.workbook)[0] + '.journal.jsonl')
+
+    # to compare the save strategies on the real drawings
+    save_times, save_sizes = list(), list()
+    metrics_report = MetricsReport(args.metrics_json, args.metrics_csv)
+    try:
+        sheet = wb['check_sheet']
+        # the rows already redlined by a crashed run get their results and are not redlined again
+        resumed_rows = apply_journal(sheet, journal.load())
+        if resumed_rows:
+            print(f'{resumed_rows} rows are resumed from {journal.get_path()}')
+        adaptive_dpis = None if args.adaptive_dpi is None else tuple(int(d) for d in args.adaptive_dpi.split(','))
+        jobs = collect_jobs(sheet, args.maker, args.dpi, {'stamp_dpi': args.stamp_dpi, 'adaptive_dpis': adaptive_dpis,
+                                                          'min_confidence': args.min_confidence,
+                                                          'ocr_mode': args.ocr_mode,
+                                                          'skip_redlined': args.skip_redlined},
+                            args.lean_memory, args.memory_budget_mb, ocr_config)
+
+        # the results come back in row order, whatever the number of workers is
+        results_since_checkpoint = 0
+        if args.service is not None:
+            # the service has its own settings, only the ones of the jobs are sent
+            results = run_on_service(jobs, args.service)
         else:
-            loop["Result"] = loop_drawing.get_error_description()
-
-        # filling the result in the Excel file
-        sheet.cell(row, 3).value = loop["Result"]
-        sheet.cell(row, 4).value = loop_drawing.get_log()
-
-        try:
-            wb.save('loop_diagrams.xlsx')
-        except Exception as e:
-            print(f'Cannot save the excel file: {str(e)}')
-finally:
-    wb.close()
+            results = run_batch(jobs, workers=args.workers or get_default_workers(), ocr_config=ocr_config,
+                                debug_mode=args.debug, ocr_cache_path=args.ocr_cache,
+                                ocr_cache_size_mb=args.ocr_cache_size_mb,
+                                ocr_batch_size=args.ocr_batch, save_strategy=args.save_strategy,
+                                atomic_save=args.atomic_save, track_memory=args.track_memory,
+                                profile_pattern=args.profile, pipeline_queue_size=args.pipeline,
+                                layout_templates_path=args.layout_templates, preprocessing=preprocessing,
+                                threads_per_worker=args.threads_per_worker, pin_workers=args.pin_workers,
+                                memory_limit_mb=args.memory_limit_mb)
+        for result in results:
+            # the journal keeps the result safe at once, the whole workbook is written only now and then
+            journal.record(result.row, result.pdf_path, result.result, result.log, result.stats)
+            # filling the result in the Excel file
+            sheet.cell(result.row, 3).value = result.result
+            sheet.cell(result.row, 4).value = result.log
+            metrics_report.add(result.pdf_path, result.success, result.metrics)
+            if 'save' in result.stats:
+                save_times.append(result.stats['save']['save_time'])
+                save_sizes.append(result.stats['save']['size'])
+
+            results_since_checkpoint += 1
+            if results_since_checkpoint >= args.checkpoint_every:
+                save_workbook(wb, args.workbook)
+                results_since_checkpoint = 0
+
+        # all the results are in the workbook now, so the journal is not needed any more
+        if save_workbook(wb, args.workbook):
+            journal.clear()
+    finally:
+        journal.flush()
+        for error in journal.get_errors():
+            print(error)
+        wb.close()
+        print(metrics_report.format_summary())
+        if save_times:
+            print(f'{args.save_strategy} save: {len(save_times)} drawings, {sum(save_times) / len(save_times):.3f} s '
+                  f'and {sum(save_sizes) / len(save_sizes) / 1024:.0f} KB on average')
+        # with workers the engines live in the worker processes, so there is nothing to report here
+        for engine_config, engine_stats in get_ocr_registry().get_stats().items():
+            print(f'OCR engine {engine_config}: {engine_stats}')
+        if get_layout_templates() is not None:
+            print(f'Layout templates: {get_layout_templates().get_stats()}')
+
+
+if __name__ == '__main__':
+    main()
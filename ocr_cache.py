@@ -0,0 +1,102 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class OcrCache:
+    # keeps the ocr results on disk, so the unchanged drawings are not ocr-ed again on re-runs
+    #
+    # the key is built from everything the result depends on: the pdf content, page, crop rectangle, DPI,
+    # rotation and ocr model version; the least recently used results are evicted when the cache gets too big
+    def __init__(self, db_path: str = 'ocr_cache.sqlite', max_size_mb: float = 256):
+        self._db_path = db_path
+        self._max_size = int(max_size_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        # several worker processes may share the file, sqlite serializes the writers
+        self._connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS ocr_results (key TEXT PRIMARY KEY, data TEXT NOT NULL, '
+                                 'size INTEGER NOT NULL, last_used REAL NOT NULL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS ocr_results_last_used ON ocr_results (last_used)')
+        self._connection.commit()
+
+    @staticmethod
+    def get_key(content_hash: str, page_number: int, crop_rect: tuple | None, dpi: int, rotation: int,
+                model_version: str) -> str:
+        # crop_rect is None when the whole page is ocr-ed
+        key_data = [content_hash, page_number, None if crop_rect is None else [round(c, 2) for c in crop_rect],
+                    dpi, rotation, model_version]
+        return hashlib.sha256(json.dumps(key_data).encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> list | None:
+        with self._lock:
+            row = self._connection.execute('SELECT data FROM ocr_results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._connection.execute('UPDATE ocr_results SET last_used = ? WHERE key = ?', (time.time(), key))
+            self._connection.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, ocr_result_data: list) -> None:
+        # the ocr scores may be numpy floats, which json does not know
+        data = json.dumps(ocr_result_data, default=float)
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO ocr_results (key, data, size, last_used) '
+                                     'VALUES (?, ?, ?, ?)', (key, data, len(data), time.time()))
+            self._evict()
+            self._connection.commit()
+        return
+
+    def _evict(self) -> None:
+        total_size = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM ocr_results').fetchone()[0]
+        if total_size <= self._max_size:
+            return
+        # removing the least recently used results until the cache fits its size again
+        for key, size in self._connection.execute('SELECT key, size FROM ocr_results '
+                                                  'ORDER BY last_used').fetchall():
+            if total_size <= self._max_size:
+                break
+            self._connection.execute('DELETE FROM ocr_results WHERE key = ?', (key,))
+            total_size -= size
+        return
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            entries, size = self._connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) '
+                                                     'FROM ocr_results').fetchone()
+        return {'hits': self._hits, 'misses': self._misses, 'entries': entries, 'size': size}
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+        return
+
+
+def get_file_hash(file_path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+_cache: OcrCache | None = None
+
+
+def get_ocr_cache() -> OcrCache | None:
+    return _cache
+
+
+def configure_ocr_cache(db_path: str | None, max_size_mb: float = 256) -> OcrCache | None:
+    # sets the process-wide cache used by the annotation makers, None turns the cache off
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = None if db_path is None else OcrCache(db_path, max_size_mb)
+    return _cache
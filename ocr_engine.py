@@ -0,0 +1,329 @@
+import numpy as np
+import cv2
+import importlib.util
+import os
+import threading
+import time
+
+
+# configuration of the engine the annotation makers use by default
+DEFAULT_OCR_CONFIG = {'use_angle_cls': True, 'lang': 'en', 'show_log': False}
+# the 'backend' of the configuration, the default PaddleOCR if there is none:
+#
+# paddle        - PaddleOCR with its default inference settings,
+# paddle_mkldnn - PaddleOCR on the MKL-DNN (oneDNN) kernels, the quantized (slim) models run on them too,
+# paddle_onnx   - PaddleOCR on ONNX Runtime, the models must be converted to ONNX with paddle2onnx,
+# rapidocr      - rapidocr_onnxruntime, the PaddleOCR models on ONNX Runtime without paddle installed at all
+OCR_BACKENDS = ('paddle', 'paddle_mkldnn', 'paddle_onnx', 'rapidocr')
+DEFAULT_OCR_BACKEND = 'paddle'
+_BACKEND_PRESETS = {'paddle': {}, 'paddle_mkldnn': {'enable_mkldnn': True}, 'paddle_onnx': {'use_onnx': True},
+                    'rapidocr': {}}
+# the packages only these backends need, they are not in requirements.txt, so they are checked when the model loads
+_OPTIONAL_PACKAGES = {'paddle_onnx': 'onnxruntime', 'rapidocr': 'rapidocr_onnxruntime'}
+# the models of the detection, angle classification and recognition in the models folder,
+# inference model folders for PaddleOCR and ONNX files for ONNX Runtime
+_MODEL_NAMES = ('det', 'cls', 'rec')
+
+
+# the ocr configuration of the backend, None for the default engine;
+# models_dir has the det, cls and rec inference models, or det.onnx, cls.onnx and rec.onnx for ONNX Runtime,
+# i.e. the quantized ones, without it the default models of the backend are used
+def get_backend_config(backend: str = DEFAULT_OCR_BACKEND, models_dir: str | None = None) -> dict | None:
+    if backend not in OCR_BACKENDS:
+        raise ValueError(f"the OCR backend must be one of {OCR_BACKENDS}")
+    if backend == 'paddle_onnx' and models_dir is None:
+        raise ValueError('paddle_onnx needs the folder with the ONNX models')
+    if backend == DEFAULT_OCR_BACKEND and models_dir is None:
+        return None
+    config = dict(_BACKEND_PRESETS[backend], backend=backend)
+    if models_dir is not None:
+        for model_name in _MODEL_NAMES:
+            if backend == 'rapidocr':
+                config[f'{model_name}_model_path'] = os.path.join(models_dir, f'{model_name}.onnx')
+            elif backend == 'paddle_onnx':
+                config[f'{model_name}_model_dir'] = os.path.join(models_dir, f'{model_name}.onnx')
+            else:
+                config[f'{model_name}_model_dir'] = os.path.join(models_dir, model_name)
+    return config
+
+
+class _TimedPredictor:
+    # stands in for a PaddleOCR predictor and tells the engine how long every inference took;
+    # the full ocr calls the detector, the classifier and the recognizer one by one, so its time is split too
+    def __init__(self, predictor, kind: str, on_inference):
+        self._predictor = predictor
+        self._kind = kind
+        self._on_inference = on_inference
+
+    def __call__(self, *args, **kwargs):
+        started_at = time.perf_counter()
+        result = self._predictor(*args, **kwargs)
+        self._on_inference(self._kind, time.perf_counter() - started_at)
+        return result
+
+    def __getattr__(self, name: str):
+        return getattr(self._predictor, name)
+
+
+class _PaddleBackend:
+    # the PaddleOCR model, its predictors are called by the engine one by one or all together by the full ocr
+    _PREDICTOR_NAMES = {'detection': 'text_detector', 'classification': 'text_classifier',
+                        'recognition': 'text_recognizer'}
+
+    def __init__(self, config: dict):
+        # paddle is imported only when a model is loaded, so the engines replaying recorded results work without it
+        from paddleocr import PaddleOCR
+        self._model = PaddleOCR(**config)
+
+    # the settings limiting the inference to so many threads, PaddleOCR takes 10 by default
+    @staticmethod
+    def get_thread_parameters(threads: int) -> dict:
+        return {'cpu_threads': threads}
+
+    def get_predictor(self, kind: str):
+        return getattr(self._model, self._PREDICTOR_NAMES[kind])
+
+    # the full ocr calls the predictor set here too
+    def set_predictor(self, kind: str, predictor) -> None:
+        setattr(self._model, self._PREDICTOR_NAMES[kind], predictor)
+        return
+
+    def ocr(self, image: np.ndarray, cls: bool) -> list:
+        return self._model.ocr(image, cls=cls)
+
+    @staticmethod
+    def get_package_version() -> str:
+        import paddleocr
+        return f"paddleocr {getattr(paddleocr, '__version__', 'unknown')}"
+
+
+class _RapidOcrBackend(_PaddleBackend):
+    # rapidocr_onnxruntime runs the PaddleOCR models on ONNX Runtime, its predictors take and return the same
+    _PREDICTOR_NAMES = {'detection': 'text_det', 'classification': 'text_cls', 'recognition': 'text_rec'}
+    # the settings of the configuration RapidOCR takes, the PaddleOCR ones are of no use for it
+    _PARAMETERS = ('det_model_path', 'cls_model_path', 'rec_model_path', 'intra_op_num_threads',
+                   'inter_op_num_threads')
+
+    def __init__(self, config: dict):
+        from rapidocr_onnxruntime import RapidOCR
+        self._model = RapidOCR(**{name: value for name, value in config.items() if name in self._PARAMETERS})
+
+    @staticmethod
+    def get_thread_parameters(threads: int) -> dict:
+        return {'intra_op_num_threads': threads, 'inter_op_num_threads': 1}
+
+    def ocr(self, image: np.ndarray, cls: bool) -> list:
+        result, _ = self._model(image, use_cls=cls)
+        # the same as the PaddleOCR result of one image
+        return [[[box, (text, float(score))] for box, text, score in result or []]]
+
+    @staticmethod
+    def get_package_version() -> str:
+        from importlib import metadata
+        try:
+            return f"rapidocr_onnxruntime {metadata.version('rapidocr_onnxruntime')}"
+        except metadata.PackageNotFoundError:
+            return 'rapidocr_onnxruntime unknown'
+
+
+_BACKEND_CLASSES = {'paddle': _PaddleBackend, 'paddle_mkldnn': _PaddleBackend, 'paddle_onnx': _PaddleBackend,
+                    'rapidocr': _RapidOcrBackend}
+
+
+class OcrEngine:
+    # a loaded ocr model shared by all the annotation makers of the process, of the backend of the configuration;
+    # threads limits the inference threads, the results do not depend on it, so it is not a part of the configuration
+    def __init__(self, config: dict, threads: int | None = None):
+        self._config = dict(config)
+        # the predictors are not thread safe, so the inference is serialized
+        self._lock = threading.Lock()
+        self._load_time = 0.0
+        # calls, images and inference time for every kind of inference: full ocr, detection, classification
+        self._stats: dict[str, dict[str, float]] = dict()
+        # the inference time of every predictor, added up for every thread apart
+        self._thread_times = threading.local()
+        backend = self._config.get('backend', DEFAULT_OCR_BACKEND)
+        assert backend in OCR_BACKENDS, f"the OCR backend must be one of {OCR_BACKENDS}"
+        model_config = {name: value for name, value in self._config.items() if name != 'backend'}
+        if threads is not None:
+            # the thread settings of the configuration win
+            model_config = dict(_BACKEND_CLASSES[backend].get_thread_parameters(threads), **model_config)
+        package = _OPTIONAL_PACKAGES.get(backend)
+        if package is not None and importlib.util.find_spec(package) is None:
+            raise ImportError(f"the {backend} OCR backend needs the {package} package, "
+                              f"install it with 'pip install {package}'")
+        started_at = time.perf_counter()
+        self._backend = _BACKEND_CLASSES[backend](model_config)
+        self._load_time = time.perf_counter() - started_at
+        kinds = ('detection', 'recognition', 'classification') if self._config.get('use_angle_cls') else \
+            ('detection', 'recognition')
+        for kind in kinds:
+            self._backend.set_predictor(kind, _TimedPredictor(self._backend.get_predictor(kind), kind,
+                                                              self._add_thread_time))
+
+    def get_config(self) -> dict:
+        return dict(self._config)
+
+    # the results of the same image are the same only for the same package version and configuration
+    def get_model_version(self) -> str:
+        return f'{self._backend.get_package_version()} {sorted(self._config.items())}'
+
+    def _record_call(self, kind: str, elapsed: float, images: int = 1) -> None:
+        stats = self._stats.setdefault(kind, {'calls': 0, 'images': 0, 'inference_time': 0.0})
+        stats['calls'] += 1
+        stats['images'] += images
+        stats['inference_time'] += elapsed
+        return
+
+    def _add_thread_time(self, kind: str, elapsed: float) -> None:
+        if not hasattr(self._thread_times, 'times'):
+            self._thread_times.times = dict()
+        self._thread_times.times[kind] = self._thread_times.times.get(kind, 0.0) + elapsed
+        return
+
+    # the detection, classification and recognition time spent by the calling thread so far,
+    # the difference of two calls tells the time of the ocr between them
+    def get_thread_inference_times(self) -> dict[str, float]:
+        return dict(getattr(self._thread_times, 'times', dict()))
+
+    def ocr(self, image: np.ndarray, cls: bool = True) -> list:
+        with self._lock:
+            started_at = time.perf_counter()
+            result = self._backend.ocr(image, cls)
+            self._record_call('ocr', time.perf_counter() - started_at)
+        return result
+
+    # returns the text boxes found in the image, every box is a list of four [x, y] corners
+    def detect(self, image: np.ndarray) -> list[list[list[float]]]:
+        with self._lock:
+            started_at = time.perf_counter()
+            dt_boxes, _ = self._backend.get_predictor('detection')(image)
+            self._record_call('detect', time.perf_counter() - started_at)
+        return [] if dt_boxes is None else [box.tolist() for box in dt_boxes]
+
+    # returns the angle classifier guess ('0' or '180') and its score for every text line image
+    def classify(self, images: list[np.ndarray]) -> list[tuple[str, float]]:
+        if not images or not self._config.get('use_angle_cls'):
+            return [('0', 0.0)] * len(images)
+        with self._lock:
+            started_at = time.perf_counter()
+            # the classifier turns the upside down images in place, so it gets copies
+            _, cls_result, _ = self._backend.get_predictor('classification')([image.copy() for image in images])
+            self._record_call('classify', time.perf_counter() - started_at, len(images))
+        return [(label, float(score)) for label, score in cls_result]
+
+    # returns the text and its score for every text line image, the upside down lines are turned first if cls is set
+    def recognize(self, images: list[np.ndarray], cls: bool = True) -> list[tuple[str, float]]:
+        if not images:
+            return []
+        with self._lock:
+            started_at = time.perf_counter()
+            if cls and self._config.get('use_angle_cls'):
+                images, _, _ = self._backend.get_predictor('classification')(list(images))
+            rec_result, _ = self._backend.get_predictor('recognition')(list(images))
+            self._record_call('recognize', time.perf_counter() - started_at, len(images))
+        return [(text, float(score)) for text, score in rec_result]
+
+    def get_stats(self) -> dict:
+        stats = {'load_time': self._load_time}
+        for kind, kind_stats in self._stats.items():
+            stats[kind] = dict(kind_stats)
+            stats[kind]['average_inference_time'] = kind_stats['inference_time'] / kind_stats['calls']
+        return stats
+
+
+class OcrEngineRegistry:
+    # loads every configured engine once per process and hands out the same instance afterwards
+    def __init__(self):
+        self._engines: dict[tuple, OcrEngine] = dict()
+        self._lock = threading.Lock()
+        # the inference threads of the engines loaded from now on, None leaves the default of the backend
+        self._threads: int | None = None
+
+    @staticmethod
+    def _get_full_config(config: dict | None) -> dict:
+        full_config = dict(DEFAULT_OCR_CONFIG)
+        if config:
+            full_config.update(config)
+        return full_config
+
+    @staticmethod
+    def _get_key(config: dict) -> tuple:
+        return tuple(sorted(config.items()))
+
+    def set_threads(self, threads: int | None) -> None:
+        self._threads = threads
+        return
+
+    # puts a ready engine in for the configuration, i.e. one replaying recorded results instead of a loaded model
+    def register(self, config: dict | None, engine) -> None:
+        with self._lock:
+            self._engines[self._get_key(self._get_full_config(config))] = engine
+        return
+
+    def get_engine(self, config: dict | None = None) -> OcrEngine:
+        full_config = self._get_full_config(config)
+        key = self._get_key(full_config)
+        # the lock makes sure two threads asking for the same engine do not load the model twice
+        with self._lock:
+            engine = self._engines.get(key)
+            if engine is None:
+                engine = OcrEngine(full_config, self._threads)
+                self._engines[key] = engine
+        return engine
+
+    def warm_up(self, configs: list[dict | None] | None = None) -> None:
+        # loads the models and runs one inference on a blank image, so the first drawing does not pay for it
+        blank_image = np.full((64, 256, 3), 255, dtype=np.uint8)
+        for config in configs or [None]:
+            self.get_engine(config).ocr(blank_image)
+        return
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {str(dict(key)): engine.get_stats() for key, engine in self._engines.items()}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._engines.clear()
+        return
+
+
+_registry = OcrEngineRegistry()
+
+
+def get_ocr_registry() -> OcrEngineRegistry:
+    return _registry
+
+
+def get_ocr_engine(config: dict | None = None) -> OcrEngine:
+    return _registry.get_engine(config)
+
+
+# cuts the text line out of the image and straightens it, the same way PaddleOCR does before the recognition
+def crop_text_box(image: np.ndarray, box: list[list[float]]) -> np.ndarray:
+    points = np.array(box, dtype=np.float32)
+    width = int(max(np.linalg.norm(points[0] - points[1]), np.linalg.norm(points[2] - points[3])))
+    height = int(max(np.linalg.norm(points[0] - points[3]), np.linalg.norm(points[1] - points[2])))
+    target_points = np.array([[0, 0], [width, 0], [width, height], [0, height]], dtype=np.float32)
+    matrix = cv2.getPerspectiveTransform(points, target_points)
+    text_line = cv2.warpPerspective(image, matrix, (max(width, 1), max(height, 1)), borderMode=cv2.BORDER_REPLICATE,
+                                    flags=cv2.INTER_CUBIC)
+    # vertical text lines are turned to be horizontal
+    if text_line.shape[0] / max(text_line.shape[1], 1) >= 1.5:
+        text_line = np.rot90(text_line)
+    return text_line
+
+
+# sorts the text boxes from top to bottom and from left to right, like the PaddleOCR result is sorted
+def sort_text_boxes(boxes: list[list[list[float]]]) -> list[list[list[float]]]:
+    sorted_boxes = sorted(boxes, key=lambda box: (box[0][1], box[0][0]))
+    # the boxes of the same line may differ in y a bit, they are put in the order of x
+    for i in range(len(sorted_boxes) - 1):
+        for j in range(i, -1, -1):
+            if abs(sorted_boxes[j + 1][0][1] - sorted_boxes[j][0][1]) < 10 and \
+                    sorted_boxes[j + 1][0][0] < sorted_boxes[j][0][0]:
+                sorted_boxes[j], sorted_boxes[j + 1] = sorted_boxes[j + 1], sorted_boxes[j]
+            else:
+                break
+    return sorted_boxes
@@ -0,0 +1,161 @@
+from fitz import Document
+import os
+import shutil
+import time
+
+
+SAVE_STRATEGIES = ('full', 'incremental', 'compact')
+
+
+class SaveReport:
+    # how long writing the annotated pdf took and how big it came out
+    def __init__(self, strategy: str, output_path: str, save_time: float, size: int, source_size: int,
+                 fallback: str | None = None):
+        self.strategy = strategy
+        self.output_path = output_path
+        self.save_time = save_time
+        self.size = size
+        self.source_size = source_size
+        # why the strategy could not be used and the whole pdf was written instead
+        self.fallback = fallback
+
+    def as_dict(self) -> dict:
+        return {'strategy': self.strategy, 'save_time': self.save_time, 'size': self.size,
+                'source_size': self.source_size, 'fallback': self.fallback}
+
+    def __str__(self) -> str:
+        fallback = '' if self.fallback is None else f' (fell back to the full save: {self.fallback})'
+        return (f'{self.strategy} save took {self.save_time:.3f} s, {self.size / 1024:.0f} KB '
+                f'from {self.source_size / 1024:.0f} KB{fallback}')
+
+
+class PdfSaver:
+    # writes the annotated documents
+    #
+    # 'full' - the whole pdf is written again, like PyMuPDF does by default,
+    # 'incremental' - the source file is copied byte by byte and only the annotations and the stamp are appended,
+    # 'compact' - the whole pdf is written with the unused objects removed and the streams compressed;
+    # atomic makes a full or compact save go into a temporary file renamed to the output at the end,
+    # so a half-written pdf is never left behind; the incremental save always works this way;
+    # deferred makes a full or compact save keep the pdf in memory until write_pending is called,
+    # so the file is written without holding up PyMuPDF, i.e. on a thread of its own
+    def __init__(self, strategy: str = 'full', atomic: bool = False, deferred: bool = False):
+        assert strategy in SAVE_STRATEGIES, f"save strategy must be one of {SAVE_STRATEGIES}"
+        self._strategy = strategy
+        self._atomic = atomic
+        self._deferred = deferred
+        self._pending_writes: list[tuple[str, bytes]] = list()
+
+    def get_strategy(self) -> str:
+        return self._strategy
+
+    def is_atomic(self) -> bool:
+        return self._atomic
+
+    # a saver of the same strategy which defers writing the files, there must be one per document being saved
+    def get_deferred_copy(self) -> 'PdfSaver':
+        return PdfSaver(self._strategy, self._atomic, deferred=True)
+
+    @staticmethod
+    def _get_temp_path(output_path: str) -> str:
+        # next to the output, so the rename stays on the same drive and is atomic
+        return output_path + '.part'
+
+    # returns the file the document must be opened from, the incremental save appends to a copy of the source
+    def get_open_path(self, pdf_path: str, output_path: str) -> str:
+        if self._strategy != 'incremental':
+            return pdf_path
+        temp_path = self._get_temp_path(output_path)
+        shutil.copyfile(pdf_path, temp_path)
+        return temp_path
+
+    # writes the document to output_path and closes it; when it fails the document is closed too
+    # and the temporary file and the working copy are removed, the output is left as it was
+    def save(self, doc: Document, output_path: str) -> SaveReport:
+        temp_path = self._get_temp_path(output_path)
+        working_copy = doc.name if self._strategy == 'incremental' else None
+        try:
+            return self._save(doc, output_path, temp_path, working_copy)
+        except Exception:
+            self._remove_partial_files(doc, [temp_path, temp_path + '.full', working_copy])
+            raise
+
+    def _save(self, doc: Document, output_path: str, temp_path: str, working_copy: str | None) -> SaveReport:
+        source_size = os.path.getsize(doc.name) if doc.name and os.path.exists(doc.name) else 0
+        fallback = None
+        started_at = time.perf_counter()
+        if self._strategy == 'incremental' and doc.name == temp_path and doc.can_save_incrementally():
+            doc.save(temp_path, incremental=True, encryption=0)
+        else:
+            if self._strategy == 'incremental':
+                # i.e. the file was repaired when opened, then the changes cannot be appended to it
+                fallback = 'the file cannot be saved incrementally'
+                temp_path += '.full'
+            # the unused objects are dropped and the streams are compressed, the scanned images stay as they are
+            options = {'garbage': 3, 'deflate': True} if self._strategy == 'compact' else dict()
+            if self._deferred and self._strategy != 'incremental':
+                data = doc.tobytes(**options)
+                doc.close()
+                self._pending_writes.append((output_path, data))
+                return SaveReport(self._strategy, output_path, time.perf_counter() - started_at, len(data),
+                                  source_size)
+            doc.save(temp_path if self._atomic or fallback else output_path, **options)
+        doc.close()
+        if self._atomic or self._strategy == 'incremental':
+            os.replace(temp_path, output_path)
+        if working_copy is not None and os.path.exists(working_copy):
+            os.remove(working_copy)
+        save_time = time.perf_counter() - started_at
+        return SaveReport(self._strategy, output_path, save_time, os.path.getsize(output_path), source_size,
+                          fallback)
+
+    @staticmethod
+    def _remove_partial_files(doc: Document, paths: list[str | None]) -> None:
+        # the working copy is open until the document is closed, on Windows it cannot be removed before
+        if not doc.is_closed:
+            doc.close()
+        for path in paths:
+            if path and path.endswith(('.part', '.full')) and os.path.exists(path):
+                os.remove(path)
+        return
+
+    def has_pending_writes(self) -> bool:
+        return bool(self._pending_writes)
+
+    # writes the files kept in memory by the deferred saves, returns the time it took
+    def write_pending(self) -> float:
+        started_at = time.perf_counter()
+        while self._pending_writes:
+            output_path, data = self._pending_writes.pop(0)
+            temp_path = self._get_temp_path(output_path) if self._atomic else output_path
+            try:
+                with open(temp_path, 'wb') as file:
+                    file.write(data)
+                if self._atomic:
+                    os.replace(temp_path, output_path)
+            except Exception:
+                # the files still pending are kept, so write_pending may be called again
+                if self._atomic and os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+        return time.perf_counter() - started_at
+
+    # closes the document which is not going to be saved, the copy made for the incremental save is removed
+    def discard(self, doc: Document) -> None:
+        working_copy = doc.name if self._strategy == 'incremental' else None
+        self._remove_partial_files(doc, [working_copy])
+        return
+
+
+_saver = PdfSaver()
+
+
+def get_pdf_saver() -> PdfSaver:
+    return _saver
+
+
+def configure_pdf_saver(strategy: str = 'full', atomic: bool = False) -> PdfSaver:
+    # sets the process-wide saver used by the annotation makers
+    global _saver
+    _saver = PdfSaver(strategy, atomic)
+    return _saver
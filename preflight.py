@@ -0,0 +1,112 @@
+from fitz import Document, Page, PDF_ANNOT_FREE_TEXT
+from PIL import Image
+import functools
+import os
+import time
+
+
+PREFLIGHT_DONE = 'done'
+PREFLIGHT_NEEDS_WORK = 'needs_work'
+PREFLIGHT_UNKNOWN = 'unknown'
+# the embedded images whose width to height ratio is this close to the one of the stamp are taken for the stamp
+_STAMP_ASPECT_TOLERANCE = 0.02
+
+
+class PreflightResult:
+    def __init__(self, state: str, reason: str, check_time: float = 0.0):
+        # done, needs_work or unknown
+        self.state = state
+        self.reason = reason
+        self.check_time = check_time
+
+    def as_dict(self) -> dict:
+        return {'state': self.state, 'reason': self.reason, 'check_time': self.check_time}
+
+    def __str__(self) -> str:
+        return f'{self.state.replace("_", " ")}: {self.reason}'
+
+
+@functools.lru_cache(maxsize=None)
+def _get_image_aspect(image_path: str) -> float | None:
+    try:
+        with Image.open(image_path) as image:
+            return image.width / image.height
+    except OSError:
+        return None
+
+
+class PreflightChecker:
+    # tells whether a drawing is redlined already without rendering it, in milliseconds:
+    #
+    # done       - every page carries the FreeText annotations with done_text or our annotations and the stamp,
+    #              or the annotated pdf is newer than the drawing and carries them, or the text layer
+    #              already says done_text and none of todo_texts,
+    # needs_work - the text layer has one of todo_texts, or the drawing changed after the annotated pdf was written,
+    # unknown    - nothing tells, i.e. a scanned drawing without annotations, the ocr has to look at it
+    def __init__(self, done_text: str, todo_texts: tuple[str, ...], stamp_path: str | None = None):
+        self._done_text = done_text
+        self._todo_texts = todo_texts
+        self._stamp_aspect = None if stamp_path is None else _get_image_aspect(stamp_path)
+
+    def _has_stamp(self, page: Page) -> bool:
+        if self._stamp_aspect is None:
+            return False
+        # the image list comes from the page resources, no image is decoded
+        for image in page.get_images():
+            width, height = image[2], image[3]
+            if height and abs(width / height / self._stamp_aspect - 1) <= _STAMP_ASPECT_TOLERANCE:
+                return True
+        return False
+
+    # the page carries the redlines: the replacement text, or the annotations together with the stamp
+    def _is_page_redlined(self, page: Page) -> bool:
+        contents = [annot.info.get('content', '') for annot in page.annots(types=(PDF_ANNOT_FREE_TEXT,))]
+        if any(content.startswith(self._done_text) for content in contents):
+            return True
+        return bool(contents) and self._has_stamp(page)
+
+    def _is_redlined(self, doc: Document) -> bool:
+        return doc.page_count > 0 and all(self._is_page_redlined(page) for page in doc)
+
+    def check(self, pdf_path: str, annotated_path: str) -> PreflightResult:
+        started_at = time.perf_counter()
+        state, reason = self._check(pdf_path, annotated_path)
+        return PreflightResult(state, reason, time.perf_counter() - started_at)
+
+    def _check(self, pdf_path: str, annotated_path: str) -> tuple[str, str]:
+        try:
+            doc = Document(pdf_path)
+        except Exception as e:
+            # make_redline reports the file which cannot be opened itself
+            return PREFLIGHT_UNKNOWN, f'the drawing cannot be opened: {str(e)}'
+        try:
+            if self._is_redlined(doc):
+                return PREFLIGHT_DONE, 'the drawing carries the redline annotations already'
+            is_annotated_stale = False
+            if os.path.exists(annotated_path):
+                if os.path.getmtime(annotated_path) >= os.path.getmtime(pdf_path):
+                    if self._is_annotated_pdf_redlined(annotated_path):
+                        return PREFLIGHT_DONE, f'{os.path.basename(annotated_path)} is newer and carries the redlines'
+                else:
+                    is_annotated_stale = True
+            texts = [page.get_text('text') for page in doc]
+        finally:
+            doc.close()
+        if any(todo_text in text for text in texts for todo_text in self._todo_texts):
+            return PREFLIGHT_NEEDS_WORK, 'the text layer has the text to replace'
+        if texts and all(self._done_text in text for text in texts):
+            return PREFLIGHT_DONE, f'the text layer says {self._done_text} already'
+        if is_annotated_stale:
+            return PREFLIGHT_NEEDS_WORK, 'the drawing changed after it was annotated'
+        return PREFLIGHT_UNKNOWN, 'nothing tells whether the drawing is redlined'
+
+    def _is_annotated_pdf_redlined(self, annotated_path: str) -> bool:
+        try:
+            doc = Document(annotated_path)
+        except Exception:
+            # i.e. written half by a crashed run, the drawing is redlined again
+            return False
+        try:
+            return self._is_redlined(doc)
+        finally:
+            doc.close()
@@ -0,0 +1,166 @@
+from typing import Callable, Iterable, Iterator
+import queue
+import threading
+from autoRLMU import AnnotationMakerBase
+from pdf_saver import get_pdf_saver
+
+
+# PyMuPDF is not thread safe, even with a document per thread, so every stage which touches it takes this lock
+fitz_lock = threading.Lock()
+
+# the file is read in chunks of this size ahead of opening it
+_READ_CHUNK_SIZE = 1024 * 1024
+# how often the waiting stages check whether the pipeline is stopped
+_POLL_INTERVAL = 0.1
+
+
+class PipelineItem:
+    # a drawing going through the stages of the pipeline
+    def __init__(self, maker: AnnotationMakerBase, pdf_path: str, redline_kwargs: dict | None = None,
+                 tag: object = None):
+        self.maker = maker
+        self.pdf_path = pdf_path
+        self.redline_kwargs = dict() if redline_kwargs is None else redline_kwargs
+        # whatever the caller recognizes the drawing by, i.e. the row of the check sheet
+        self.tag = tag
+        self.is_ocr_needed = False
+        self.ocr_result_data: list | object | None = None
+        self.success = False
+        # the exception a stage failed with, the later stages skip the drawing
+        self.error: str | None = None
+
+
+# the end of the drawings, passed through all the stages after the last one
+_END = object()
+
+
+class RedlinePipeline:
+    # redlines the drawings with the stages of consecutive drawings running at the same time:
+    #
+    # read     - the pdf is read from the disk or the network share, so opening it does not wait for the I/O,
+    # render   - the document is opened and its crop rectangle is rendered for the ocr,
+    # ocr      - the text blocks are recognized,
+    # redline  - make_redline analyzes and annotates the document, taking the ocr result from the previous stage,
+    #            the annotated pdf is kept in memory,
+    # write    - the annotated pdf is written to the disk;
+    #
+    # so drawing N+1 is rendered while drawing N is ocr-ed and drawing N-1 is written; the stages are threads
+    # connected by queues of queue_size drawings, so only so many rendered images wait in memory;
+    # render and redline take fitz_lock, the others do not touch PyMuPDF; make_redline still ocr-s itself
+    # whatever the ocr stage could not do ahead, i.e. the higher adaptive DPIs and the turned pages,
+    # it lets fitz_lock go while that ocr runs, so the next drawings are read and rendered meanwhile;
+    # the document is opened once, by the render stage, and the redline stage goes on with it through the maker,
+    # so the file hash and the debug sampling count every drawing once and in the order the drawings come
+    _STAGES = ('read', 'render', 'ocr', 'redline', 'write')
+
+    def __init__(self, queue_size: int = 2):
+        assert queue_size > 0, "queue_size must be positive"
+        self._queue_size = queue_size
+        self._stopped = threading.Event()
+
+    # yields the drawings in the order they come, each one with success and error set
+    def run(self, items: Iterable[PipelineItem]) -> Iterator[PipelineItem]:
+        self._stopped.clear()
+        queues = [queue.Queue(maxsize=self._queue_size) for _ in range(len(self._STAGES) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]), name='pipeline-feed', daemon=True)]
+        for stage, input_queue, output_queue in zip(self._STAGES, queues, queues[1:]):
+            work = getattr(self, f'_{stage}')
+            threads.append(threading.Thread(target=self._run_stage, args=(work, input_queue, output_queue),
+                                            name=f'pipeline-{stage}', daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if item is _END or item is None:
+                    break
+                yield item
+        finally:
+            # the caller may stop taking the drawings, then the stages must not wait for it forever
+            self._stopped.set()
+            for thread in threads:
+                thread.join()
+        return
+
+    def _put(self, stage_queue: queue.Queue, item: object) -> bool:
+        while not self._stopped.is_set():
+            try:
+                stage_queue.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    # returns None if the pipeline is stopped
+    def _get(self, stage_queue: queue.Queue) -> object:
+        while not self._stopped.is_set():
+            try:
+                return stage_queue.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return None
+
+    def _feed(self, items: Iterable[PipelineItem], output_queue: queue.Queue) -> None:
+        for item in items:
+            if not self._put(output_queue, item):
+                return
+        self._put(output_queue, _END)
+        return
+
+    def _run_stage(self, work: Callable[[PipelineItem], None], input_queue: queue.Queue,
+                   output_queue: queue.Queue) -> None:
+        while True:
+            item = self._get(input_queue)
+            if item is None:
+                return
+            if item is not _END and item.error is None:
+                try:
+                    work(item)
+                except Exception as e:
+                    # one broken drawing must not stop the others
+                    item.error = str(e)
+            if not self._put(output_queue, item) or item is _END:
+                return
+
+    @staticmethod
+    def _read(item: PipelineItem) -> None:
+        # the content goes nowhere, it only gets into the cache of the OS, so the open under the lock is quick
+        try:
+            with open(item.pdf_path, 'rb') as file:
+                while file.read(_READ_CHUNK_SIZE):
+                    pass
+        except OSError:
+            # make_redline reports the file which cannot be read itself
+            pass
+        return
+
+    @staticmethod
+    def _render(item: PipelineItem) -> None:
+        # the annotated pdf is kept in memory by the redline stage and written by the write stage
+        item.maker.set_pdf_saver(get_pdf_saver().get_deferred_copy())
+        # the document stays open in the maker for the redline stage, even if it needs no ocr done ahead
+        with fitz_lock:
+            item.is_ocr_needed = item.maker.prepare_ocr_ahead(item.pdf_path, **item.redline_kwargs)
+        return
+
+    @staticmethod
+    def _ocr(item: PipelineItem) -> None:
+        if item.is_ocr_needed:
+            item.ocr_result_data = item.maker.run_ocr_ahead()
+        return
+
+    @staticmethod
+    def _redline(item: PipelineItem) -> None:
+        item.maker.set_fitz_lock(fitz_lock)
+        with fitz_lock:
+            if item.is_ocr_needed:
+                item.maker.set_ocr_ahead_result(item.ocr_result_data)
+                item.ocr_result_data = None
+            # the same pdf path as the render stage, so the document it opened is redlined
+            item.success = item.maker.make_redline(item.pdf_path, **item.redline_kwargs)
+        return
+
+    @staticmethod
+    def _write(item: PipelineItem) -> None:
+        item.success = item.maker.write_deferred_pdf()
+        return
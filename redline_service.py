@@ -0,0 +1,293 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable, Iterator
+import argparse
+import json
+import os
+import threading
+import time
+import urllib.request
+from batch_runner import MAKER_CHOICES, RedlineJob, RedlineResult, init_worker, redline_job
+from debug_artifacts import DEBUG_MODES
+from image_preprocessing import PREPROCESSING_STEPS
+from ocr_engine import DEFAULT_OCR_BACKEND, OCR_BACKENDS, get_backend_config, get_ocr_registry
+from pdf_saver import SAVE_STRATEGIES
+from resource_governor import ResourceGovernor
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+# how often the spool directory is looked into
+SPOOL_POLL_INTERVAL = 0.5
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_integer(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def parse_job(data: dict, row: int = 0) -> RedlineJob:
+    # a job is {"pdf_path": ..., "maker": "old", "dpi": 150, "crop_rectangle_wh": [x0, y0, w, h], "options": {...}},
+    # only pdf_path is required; options are the other keyword arguments of make_redline, i.e. stamp_dpi;
+    # every field is checked here, so a malformed job is answered with an error and never gets to a worker
+    if not isinstance(data, dict) or not isinstance(data.get('pdf_path'), str) or not data['pdf_path']:
+        raise ValueError('a job must be an object with pdf_path')
+    if not _is_integer(data.get('row', row)):
+        raise ValueError('row must be an integer')
+    if not isinstance(data.get('maker', 'old'), str) or data.get('maker', 'old') not in MAKER_CHOICES:
+        raise ValueError(f"maker must be one of {MAKER_CHOICES}")
+    if not _is_integer(data.get('dpi', 150)):
+        raise ValueError('dpi must be an integer')
+    crop_rectangle_wh = data.get('crop_rectangle_wh')
+    if crop_rectangle_wh is not None and (not isinstance(crop_rectangle_wh, list) or len(crop_rectangle_wh) != 4 or
+                                          not all(_is_number(value) for value in crop_rectangle_wh)):
+        raise ValueError('crop_rectangle_wh must be a list of 4 numbers')
+    ocr_config = data.get('ocr_config')
+    # the configuration is the key of the loaded engine, so its values must be plain ones
+    if ocr_config is not None and (not isinstance(ocr_config, dict) or not all(
+            isinstance(value, (str, int, float, bool)) or value is None for value in ocr_config.values())):
+        raise ValueError('ocr_config must be an object of strings, numbers and booleans')
+    if data.get('options') is not None and not isinstance(data['options'], dict):
+        raise ValueError('options must be an object')
+    if not isinstance(data.get('is_memory_lean', False), bool):
+        raise ValueError('is_memory_lean must be a boolean')
+    if data.get('memory_budget_mb') is not None and not _is_number(data['memory_budget_mb']):
+        raise ValueError('memory_budget_mb must be a number')
+    return RedlineJob(data.get('row', row), data['pdf_path'], maker=data.get('maker', 'old'), dpi=data.get('dpi', 150),
+                      crop_rectangle_wh=None if crop_rectangle_wh is None else tuple(crop_rectangle_wh),
+                      ocr_config=data.get('ocr_config'), options=data.get('options'),
+                      is_memory_lean=data.get('is_memory_lean', False),
+                      memory_budget_mb=data.get('memory_budget_mb'))
+
+
+def _job_to_dict(job: RedlineJob) -> dict:
+    return {'row': job.row, 'pdf_path': job.pdf_path, 'maker': job.maker, 'dpi': job.dpi,
+            'crop_rectangle_wh': job.crop_rectangle_wh, 'ocr_config': job.ocr_config, 'options': job.options,
+            'is_memory_lean': job.is_memory_lean, 'memory_budget_mb': job.memory_budget_mb}
+
+
+class RedlineService:
+    # a long-running process which keeps the ocr engines warm and redlines the jobs it gets
+    # from a spool directory or over HTTP, so a small batch does not pay for the start and the model load
+    #
+    # the spool directory gets a job file, <name>.json holding a job or a list of them, into incoming;
+    # the file is moved to processing while the jobs run and the results go to done/<name>.result.json;
+    # a job file should be written under another name and renamed to .json, so it is never read half-written
+    #
+    # the HTTP endpoint takes a job or a list of them as a POST to /redline and answers with the results,
+    # GET /status tells how many jobs are done and the statistics of the engines
+    #
+    # the jobs run one at a time, whichever way they come, as the engines are not thread safe
+    def __init__(self, spool_dir: str | None = None, host: str = DEFAULT_HOST, port: int | None = DEFAULT_PORT):
+        self._spool_dir = spool_dir
+        self._host = host
+        self._port = port
+        self._job_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._server: ThreadingHTTPServer | None = None
+        self._started_at = time.time()
+        self._jobs_done = 0
+        self._jobs_failed = 0
+
+    def get_status(self) -> dict:
+        return {'uptime': time.time() - self._started_at, 'jobs_done': self._jobs_done,
+                'jobs_failed': self._jobs_failed, 'engines': get_ocr_registry().get_stats()}
+
+    def redline(self, jobs: list[RedlineJob]) -> list[RedlineResult]:
+        results = list()
+        with self._job_lock:
+            for job in jobs:
+                result = redline_job(job)
+                self._jobs_done += 1
+                self._jobs_failed += not result.success
+                results.append(result)
+        return results
+
+    def _get_spool_subdir(self, name: str) -> str:
+        return os.path.join(self._spool_dir, name)
+
+    # the job files left in processing by a crashed service are run again
+    def _recover_spool(self) -> None:
+        for name in ('incoming', 'processing', 'done'):
+            os.makedirs(self._get_spool_subdir(name), exist_ok=True)
+        for file_name in os.listdir(self._get_spool_subdir('processing')):
+            os.replace(os.path.join(self._get_spool_subdir('processing'), file_name),
+                       os.path.join(self._get_spool_subdir('incoming'), file_name))
+        return
+
+    def _run_spool_file(self, file_name: str) -> None:
+        processing_path = os.path.join(self._get_spool_subdir('processing'), file_name)
+        try:
+            os.replace(os.path.join(self._get_spool_subdir('incoming'), file_name), processing_path)
+        except OSError:
+            # taken by another service watching the same directory
+            return
+        try:
+            with open(processing_path, encoding='utf-8') as file:
+                data = json.load(file)
+            jobs = [parse_job(job, row) for row, job in enumerate(data if isinstance(data, list) else [data])]
+            answer = {'results': [result.as_dict() for result in self.redline(jobs)]}
+        except ValueError as e:
+            answer = {'error': f'Cannot read the jobs of {file_name}: {str(e)}'}
+        except Exception as e:
+            answer = {'error': f'Unexpected error in the jobs of {file_name}: {str(e)}'}
+        result_path = os.path.join(self._get_spool_subdir('done'), os.path.splitext(file_name)[0] + '.result.json')
+        with open(result_path + '.part', 'w', encoding='utf-8') as file:
+            json.dump(answer, file, indent=2, default=str)
+        os.replace(result_path + '.part', result_path)
+        os.remove(processing_path)
+        return
+
+    def _watch_spool(self) -> None:
+        self._recover_spool()
+        while not self._stopped.is_set():
+            file_names = sorted(file_name for file_name in os.listdir(self._get_spool_subdir('incoming'))
+                                if file_name.endswith('.json'))
+            for file_name in file_names:
+                if self._stopped.is_set():
+                    break
+                # one bad file must not stop the watcher, the files after it still run
+                try:
+                    self._run_spool_file(file_name)
+                except Exception as e:
+                    print(f'Cannot run the job file {file_name}: {str(e)}')
+            if not file_names:
+                self._stopped.wait(SPOOL_POLL_INTERVAL)
+        return
+
+    def _create_request_handler(self) -> type[BaseHTTPRequestHandler]:
+        service = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def _answer(self, status: int, answer: dict) -> None:
+                body = json.dumps(answer, default=str).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            def do_GET(self) -> None:
+                if self.path == '/status':
+                    self._answer(200, service.get_status())
+                else:
+                    self._answer(404, {'error': f'{self.path} is not found'})
+                return
+
+            def do_POST(self) -> None:
+                if self.path != '/redline':
+                    self._answer(404, {'error': f'{self.path} is not found'})
+                    return
+                try:
+                    data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    jobs = [parse_job(job, row) for row, job in enumerate(data if isinstance(data, list) else [data])]
+                except ValueError as e:
+                    self._answer(400, {'error': f'Cannot read the jobs: {str(e)}'})
+                    return
+                try:
+                    results = service.redline(jobs)
+                except Exception as e:
+                    self._answer(500, {'error': f'Unexpected error: {str(e)}'})
+                    return
+                self._answer(200, {'results': [result.as_dict() for result in results]})
+                return
+
+            def log_message(self, format: str, *args) -> None:
+                # the results are in the answers, the requests are not worth a line each
+                return
+
+        return RequestHandler
+
+    # serves until stop is called or the process is interrupted
+    def serve(self) -> None:
+        threads = list()
+        if self._port is not None:
+            self._server = ThreadingHTTPServer((self._host, self._port), self._create_request_handler())
+            threads.append(threading.Thread(target=self._server.serve_forever, name='redline-http', daemon=True))
+            print(f'Redline service is listening on http://{self._host}:{self._server.server_port}')
+        if self._spool_dir is not None:
+            threads.append(threading.Thread(target=self._watch_spool, name='redline-spool', daemon=True))
+            print(f'Redline service is watching {self._get_spool_subdir("incoming")}')
+        for thread in threads:
+            thread.start()
+        try:
+            while not self._stopped.wait(1):
+                pass
+        except KeyboardInterrupt:
+            self._stopped.set()
+        finally:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+            for thread in threads:
+                thread.join()
+        return
+
+    # makes serve return once the running jobs are finished, may be called from any thread
+    def stop(self) -> None:
+        self._stopped.set()
+        return
+
+    # the port the HTTP endpoint listens on, the one picked by the OS if the port was 0
+    def get_port(self) -> int | None:
+        return None if self._server is None else self._server.server_port
+
+
+# redlines the jobs on a running service one by one, yields the results as they come
+def run_on_service(jobs: Iterable[RedlineJob], url: str = f'http://{DEFAULT_HOST}:{DEFAULT_PORT}',
+                   timeout: float | None = None) -> Iterator[RedlineResult]:
+    for job in jobs:
+        request = urllib.request.Request(url.rstrip('/') + '/redline', method='POST',
+                                         data=json.dumps(_job_to_dict(job)).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            result = json.load(response)['results'][0]
+        yield RedlineResult(job.row, job.pdf_path, result['success'], result['result'], result['log'],
+                            result['stats'], result['metrics'])
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keeps the OCR model loaded and redlines the drawings it is sent')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='0 picks a free port, -1 turns HTTP off')
+    parser.add_argument('--spool', default=None, metavar='DIR',
+                        help='take the job files from DIR/incoming and put the results into DIR/done')
+    parser.add_argument('--debug', choices=DEBUG_MODES, default='off')
+    parser.add_argument('--ocr-cache', default=None, metavar='PATH')
+    parser.add_argument('--ocr-cache-size-mb', type=float, default=256)
+    parser.add_argument('--save-strategy', choices=SAVE_STRATEGIES, default='full')
+    parser.add_argument('--atomic-save', action='store_true')
+    parser.add_argument('--track-memory', action='store_true')
+    parser.add_argument('--layout-templates', default=None, metavar='PATH')
+    parser.add_argument('--preprocessing', default='', metavar='STEPS',
+                        help=f"comma separated steps of {','.join(PREPROCESSING_STEPS)}")
+    parser.add_argument('--ocr-backend', choices=OCR_BACKENDS, default=DEFAULT_OCR_BACKEND,
+                        help='the backend loaded before the first job, the jobs with another ocr_config load theirs')
+    parser.add_argument('--ocr-models', default=None, metavar='DIR')
+    parser.add_argument('--threads', type=int, default=None, metavar='N',
+                        help='limit the OCR inference, the OpenMP/MKL pools and OpenCV to N threads')
+    parser.add_argument('--memory-limit-mb', type=float, default=None, metavar='MB')
+    args = parser.parse_args()
+    preprocessing = tuple(step for step in args.preprocessing.split(',') if step)
+    if not set(preprocessing) <= set(PREPROCESSING_STEPS):
+        parser.error(f"--preprocessing steps must be of {','.join(PREPROCESSING_STEPS)}")
+    try:
+        ocr_config = get_backend_config(args.ocr_backend, args.ocr_models)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # the model is loaded before the first job comes
+    governor = None
+    if args.threads is not None or args.memory_limit_mb is not None:
+        governor = ResourceGovernor(1, args.threads, memory_limit_mb=args.memory_limit_mb)
+    init_worker(ocr_config, args.debug, args.ocr_cache, args.ocr_cache_size_mb, args.save_strategy, args.atomic_save,
+                args.track_memory, None, args.layout_templates, preprocessing, governor)
+    RedlineService(args.spool, args.host, None if args.port < 0 else args.port).serve()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import multiprocessing
+import os
+import cv2
+from ocr_engine import get_ocr_registry
+
+try:
+    import resource
+except ImportError:
+    # there is no resource module on Windows, the memory limit is not set there
+    resource = None
+
+
+# the OpenMP, MKL and BLAS thread pools read these when the library is loaded, so paddle and onnxruntime get them,
+# they are imported only when the model is loaded; numpy is loaded already, threadpoolctl limits it if installed
+_THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS')
+
+
+class ResourceLimits:
+    # what one process redlining the drawings may take, None leaves the defaults of the libraries:
+    #
+    # threads         - the threads of the ocr inference, of the OpenMP/MKL/BLAS pools and of OpenCV,
+    #                   MuPDF has no pool, it renders on the thread calling it,
+    # cores           - the cores the process is pinned to,
+    # memory_limit_mb - the address space the process may take on top of the loaded ocr model; it is not
+    #                   the resident memory, the reservations of the thread pools and the mapped files count too,
+    #                   so it is set only once the model is loaded; a drawing going over it fails with MemoryError,
+    #                   the others go on
+    def __init__(self, threads: int | None = None, cores: tuple[int, ...] | None = None,
+                 memory_limit_mb: float | None = None):
+        assert threads is None or threads > 0, "threads must be positive"
+        self.threads = threads
+        self.cores = cores
+        self.memory_limit_mb = memory_limit_mb
+
+    def as_dict(self) -> dict:
+        return {'threads': self.threads, 'cores': self.cores, 'memory_limit_mb': self.memory_limit_mb}
+
+    def __str__(self) -> str:
+        threads = 'default' if self.threads is None else self.threads
+        cores = 'any' if self.cores is None else ','.join(str(core) for core in self.cores)
+        memory = 'no limit' if self.memory_limit_mb is None else f'{self.memory_limit_mb:.0f} MB'
+        return f'{threads} threads, cores {cores}, memory {memory}'
+
+
+def get_available_cores() -> list[int]:
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _set_affinity(cores: tuple[int, ...]) -> bool:
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+        return True
+    try:
+        import psutil
+    except ImportError:
+        return False
+    # Windows has no sched_setaffinity
+    psutil.Process().cpu_affinity(list(cores))
+    return True
+
+
+# the virtual memory the process takes, None if it cannot be told here
+def _get_address_space_mb() -> float | None:
+    try:
+        import psutil
+        return psutil.Process().memory_info().vms / 1024 / 1024
+    except ImportError:
+        pass
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as file:
+            pages = int(file.read().split()[0])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    return None
+
+
+def _set_memory_limit(memory_limit_mb: float) -> bool:
+    if resource is None or not hasattr(resource, 'RLIMIT_AS'):
+        return False
+    limit = int(memory_limit_mb * 1024 * 1024)
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+    if hard_limit != resource.RLIM_INFINITY:
+        limit = min(limit, hard_limit)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard_limit))
+    return True
+
+
+_limits = ResourceLimits()
+
+
+def get_resource_limits() -> ResourceLimits:
+    return _limits
+
+
+# limits the process, before the ocr model is loaded; returns the messages about the limits which cannot be set here
+def apply_resource_limits(limits: ResourceLimits) -> list[str]:
+    global _limits
+    _limits = limits
+    warnings = list()
+    if limits.threads is not None:
+        for env_var in _THREAD_ENV_VARS:
+            os.environ[env_var] = str(limits.threads)
+        cv2.setNumThreads(limits.threads)
+        get_ocr_registry().set_threads(limits.threads)
+        try:
+            from threadpoolctl import threadpool_limits
+            threadpool_limits(limits.threads)
+        except ImportError:
+            pass
+    if limits.cores is not None and not _set_affinity(limits.cores):
+        warnings.append('the process cannot be pinned to the cores here, install psutil')
+    return warnings
+
+
+# limits the address space of the process to what it takes now, with the ocr model loaded, and memory_limit_mb
+# of the limits applied; a limit set before the model is loaded makes the loading itself fail with MemoryError;
+# returns the messages about the limit
+def apply_memory_limit() -> list[str]:
+    if _limits.memory_limit_mb is None:
+        return []
+    address_space_mb = _get_address_space_mb()
+    if address_space_mb is None or not _set_memory_limit(address_space_mb + _limits.memory_limit_mb):
+        return ['the memory limit cannot be set on this platform']
+    return [f'the process with the ocr model takes {address_space_mb:.0f} MB of address space, the drawings may '
+            f'take {_limits.memory_limit_mb:.0f} MB more']
+
+
+class ResourceGovernor:
+    # shares the machine out among the worker processes of a batch, so they do not oversubscribe the cores:
+    # every worker gets threads_per_worker threads, the cores divided by the workers if it is 0,
+    # and with pin_workers the worker is pinned to cores of its own, as many as its threads;
+    # it is passed to the workers when they start, so they take the slots from the same counter
+    def __init__(self, workers: int, threads_per_worker: int | None = None, pin_workers: bool = False,
+                 memory_limit_mb: float | None = None):
+        self._workers = max(workers, 1)
+        self._threads_per_worker = threads_per_worker
+        if pin_workers and not threads_per_worker:
+            self._threads_per_worker = 0
+        self._pin_workers = pin_workers
+        self._memory_limit_mb = memory_limit_mb
+        self._next_slot = multiprocessing.Value('i', 0) if pin_workers else None
+
+    def get_threads_per_worker(self) -> int | None:
+        if self._threads_per_worker == 0:
+            return max(1, len(get_available_cores()) // self._workers)
+        return self._threads_per_worker
+
+    def _take_slot(self) -> int:
+        with self._next_slot.get_lock():
+            slot = self._next_slot.value
+            self._next_slot.value += 1
+        return slot
+
+    # the limits of the next worker, the workers over the number of cores share them from the first one again
+    def get_worker_limits(self) -> ResourceLimits:
+        threads = self.get_threads_per_worker()
+        cores = None
+        if self._pin_workers:
+            available_cores = get_available_cores()
+            first = self._take_slot() * threads % len(available_cores)
+            cores = tuple(available_cores[(first + i) % len(available_cores)]
+                          for i in range(min(threads, len(available_cores))))
+        return ResourceLimits(threads, cores, self._memory_limit_mb)
+
+    def apply(self) -> list[str]:
+        return apply_resource_limits(self.get_worker_limits())
@@ -0,0 +1,89 @@
+import json
+import os
+import queue
+import threading
+
+
+class ResultsJournal:
+    # keeps the result of every redlined row in a JSON lines file, one line per row as soon as it is finished
+    #
+    # the lines are only ever appended, so a crash loses at most the line being written, and the next run
+    # picks the finished rows up from the journal; the lines are written on a background thread,
+    # so the redlining never waits for the disk
+    def __init__(self, path: str):
+        self._path = path
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._errors: list[str] = list()
+
+    def get_path(self) -> str:
+        return self._path
+
+    # returns the journaled results by row, the later lines win; a broken line, i.e. the last one after a crash,
+    # is skipped
+    def load(self) -> dict[int, dict]:
+        records = dict()
+        if not os.path.exists(self._path):
+            return records
+        with open(self._path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[record['row']] = record
+        return records
+
+    # the line cut by a crash is ended, so the next record starts on a line of its own
+    def _end_broken_line(self) -> None:
+        if not os.path.exists(self._path) or os.path.getsize(self._path) == 0:
+            return
+        with open(self._path, 'rb+') as file:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b'\n':
+                file.write(b'\n')
+        return
+
+    def _start_thread(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._end_broken_line()
+                self._thread = threading.Thread(target=self._write_records, name='results-journal', daemon=True)
+                self._thread.start()
+        return
+
+    def _write_records(self) -> None:
+        while True:
+            record = self._queue.get()
+            try:
+                # the file is closed between the records, so the line reaches the OS at once
+                # and survives the process crashing, and the journal can be removed at the end
+                with open(self._path, 'a', encoding='utf-8') as file:
+                    file.write(json.dumps(record, default=str) + '\n')
+            except Exception as e:
+                self._errors.append(f'Cannot write to {self._path}: {str(e)}')
+            finally:
+                self._queue.task_done()
+
+    def record(self, row: int, pdf_path: str, result: str, log: str, stats: dict | None = None) -> None:
+        self._start_thread()
+        self._queue.put({'row': row, 'pdf_path': pdf_path, 'result': result, 'log': log,
+                         'stats': dict() if stats is None else stats})
+        return
+
+    # waits until all the recorded results are written
+    def flush(self) -> None:
+        if self._thread is not None:
+            self._queue.join()
+        return
+
+    # the journal is removed once all its results are in the workbook, so it does not fill the rows of a later run
+    def clear(self) -> None:
+        self.flush()
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        return
+
+    def get_errors(self) -> list[str]:
+        return list(self._errors)
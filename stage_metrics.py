@@ -0,0 +1,170 @@
+from contextlib import contextmanager
+from typing import Iterator
+import cProfile
+import csv
+import fnmatch
+import json
+import os
+import time
+import tracemalloc
+
+
+# the stages of redlining a document, in the order they usually go
+STAGES = ('preflight', 'open', 'text_layer', 'render', 'crop', 'orientation', 'ocr', 'preprocess', 'ocr_detection',
+          'ocr_recognition', 'analysis', 'annotation', 'stamp_search', 'save', 'write')
+
+
+class StageMetrics:
+    # wall time, CPU time and peak memory of every stage of redlining one document
+    #
+    # the CPU time is the one of the whole process, so it includes the threads the OCR runs its inference on;
+    # the peak memory is measured with tracemalloc, which sees the numpy images and the python objects,
+    # but not the memory PyMuPDF and Paddle allocate themselves; it is only measured if tracking is on
+    def __init__(self):
+        self._stages: dict[str, dict[str, float]] = dict()
+        # the stages being measured, the outer ones get the memory peaks of the inner ones
+        self._running: list[dict[str, float]] = list()
+
+    def _get_stage(self, stage: str) -> dict[str, float]:
+        return self._stages.setdefault(stage, {'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'peak_memory': 0})
+
+    @contextmanager
+    def measure(self, stage: str) -> Iterator[None]:
+        is_tracing = tracemalloc.is_tracing()
+        running = {'start_memory': 0, 'peak': 0}
+        if is_tracing:
+            memory, peak = tracemalloc.get_traced_memory()
+            for outer in self._running:
+                outer['peak'] = max(outer['peak'], peak)
+            tracemalloc.reset_peak()
+            running['start_memory'] = memory
+        self._running.append(running)
+        started_at, cpu_started_at = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self._running.remove(running)
+            self.add(stage, time.perf_counter() - started_at, time.process_time() - cpu_started_at)
+            if is_tracing and tracemalloc.is_tracing():
+                peak = max(running['peak'], tracemalloc.get_traced_memory()[1])
+                for outer in self._running:
+                    outer['peak'] = max(outer['peak'], peak)
+                stats = self._get_stage(stage)
+                stats['peak_memory'] = max(stats['peak_memory'], peak - running['start_memory'])
+
+    # adds the time measured somewhere else, i.e. the inference time the ocr engine tells
+    def add(self, stage: str, wall_time: float, cpu_time: float = 0.0) -> None:
+        stats = self._get_stage(stage)
+        stats['calls'] += 1
+        stats['wall_time'] += wall_time
+        stats['cpu_time'] += cpu_time
+        return
+
+    # adds up the stages measured by another maker, i.e. the one which ocr-ed the next page in the background
+    def merge(self, other: 'StageMetrics') -> None:
+        for stage, other_stats in other._stages.items():
+            stats = self._get_stage(stage)
+            stats['calls'] += other_stats['calls']
+            stats['wall_time'] += other_stats['wall_time']
+            stats['cpu_time'] += other_stats['cpu_time']
+            stats['peak_memory'] = max(stats['peak_memory'], other_stats['peak_memory'])
+        return
+
+    def as_dict(self) -> dict[str, dict[str, float]]:
+        return {stage: dict(stats) for stage, stats in self._stages.items()}
+
+
+def set_memory_tracking(enabled: bool) -> None:
+    # tracemalloc slows every allocation down, so it is off unless the peak memory is asked for
+    if enabled and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not enabled and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return
+
+
+class MetricsReport:
+    # collects the stage metrics of the documents of a batch, writes them as they come and sums them up at the end
+    #
+    # the JSON lines file gets one line per document, the CSV file - one line per stage of every document
+    def __init__(self, json_path: str | None = None, csv_path: str | None = None):
+        self._json_path = json_path
+        self._csv_path = csv_path
+        self._documents = 0
+        self._totals: dict[str, dict[str, float]] = dict()
+        if csv_path is not None:
+            with open(csv_path, 'w', newline='', encoding='utf-8') as file:
+                csv.writer(file).writerow(['pdf_path', 'success', 'stage', 'calls', 'wall_time', 'cpu_time',
+                                           'peak_memory'])
+        if json_path is not None:
+            open(json_path, 'w', encoding='utf-8').close()
+
+    def add(self, pdf_path: str, success: bool, stages: dict[str, dict[str, float]]) -> None:
+        self._documents += 1
+        for stage, stats in stages.items():
+            totals = self._totals.setdefault(stage, {'documents': 0, 'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0,
+                                                     'max_wall_time': 0.0, 'peak_memory': 0})
+            totals['documents'] += 1
+            totals['calls'] += stats['calls']
+            totals['wall_time'] += stats['wall_time']
+            totals['cpu_time'] += stats['cpu_time']
+            totals['max_wall_time'] = max(totals['max_wall_time'], stats['wall_time'])
+            totals['peak_memory'] = max(totals['peak_memory'], stats['peak_memory'])
+        if self._json_path is not None:
+            with open(self._json_path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps({'pdf_path': pdf_path, 'success': success, 'stages': stages}) + '\n')
+        if self._csv_path is not None:
+            with open(self._csv_path, 'a', newline='', encoding='utf-8') as file:
+                writer = csv.writer(file)
+                for stage, stats in stages.items():
+                    writer.writerow([pdf_path, success, stage, stats['calls'], f"{stats['wall_time']:.6f}",
+                                     f"{stats['cpu_time']:.6f}", stats['peak_memory']])
+        return
+
+    # the totals of every stage over all the documents, with the mean time per document having the stage
+    def get_summary(self) -> dict[str, dict[str, float]]:
+        summary = dict()
+        known_stages = [stage for stage in STAGES if stage in self._totals]
+        for stage in known_stages + sorted(set(self._totals) - set(STAGES)):
+            summary[stage] = dict(self._totals[stage])
+            summary[stage]['mean_wall_time'] = self._totals[stage]['wall_time'] / self._totals[stage]['documents']
+        return summary
+
+    def format_summary(self) -> str:
+        lines = [f'Stage metrics of {self._documents} documents:',
+                 f"{'stage':<16}{'docs':>6}{'total s':>10}{'mean s':>10}{'max s':>10}{'cpu s':>10}{'peak MB':>10}"]
+        for stage, stats in self.get_summary().items():
+            lines.append(f"{stage:<16}{stats['documents']:>6}{stats['wall_time']:>10.2f}"
+                         f"{stats['mean_wall_time']:>10.3f}{stats['max_wall_time']:>10.3f}{stats['cpu_time']:>10.2f}"
+                         f"{stats['peak_memory'] / 1024 / 1024:>10.1f}")
+        return '\n'.join(lines)
+
+
+# the documents whose file names match the pattern are run under cProfile, the profiles go to output_dir
+_profile_pattern: str | None = None
+_profile_dir = 'profiles'
+
+
+def configure_profiling(pattern: str | None, output_dir: str = 'profiles') -> None:
+    global _profile_pattern, _profile_dir
+    _profile_pattern = pattern
+    _profile_dir = output_dir
+    return
+
+
+@contextmanager
+def profile_document(pdf_path: str) -> Iterator[str | None]:
+    # yields the file the profile is written to, or None if the document is not profiled;
+    # the profile is read with pstats or snakeviz
+    if _profile_pattern is None or not fnmatch.fnmatch(os.path.basename(pdf_path), _profile_pattern):
+        yield None
+        return
+    os.makedirs(_profile_dir, exist_ok=True)
+    profile_path = os.path.join(_profile_dir, os.path.splitext(os.path.basename(pdf_path))[0] + '.prof')
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profile_path
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
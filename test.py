@@ -1,7 +1,9 @@
 import os
 from autoRLMU import AnnotationMakerNew, AnnotationMakerOld
+from debug_artifacts import configure_debug_artifacts
 
 os.system('cls')
+configure_debug_artifacts('full')
 
 pdf_paths = list()
 